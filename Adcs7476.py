@@ -4,49 +4,134 @@ from migen.fhdl.verilog import convert
 from migen.genlib.misc import timeline
 from litex.soc.interconnect.csr import *
 
+# SDATA of the converters running in lockstep, on the PMOD port
+MISO_PINS = ["PMOD:2", "PMOD:1", "PMOD:4", "PMOD:5", "PMOD:6", "PMOD:7"]
+
 class Adcs7476(Module, AutoCSR):
-    ''' expected to run on a 20 MHz clock '''
+    '''
+    expected to run on a 20 MHz clock (div=1)
+
+    div: SCLK = clock / div. With div = 1, SCLK is the clock itself.
+    With div > 1 all logic is advanced by a clock enable on the falling
+    edges of the divided SCLK, so the core can run in a faster clock
+    domain, e.g. ClockDomainsRenamer("fast")(Adcs7476(div=5)) for a 20 MHz
+    SCLK from the 100 MHz cd_fast.
+    quiet: SCLK periods nCS stays high between conversions. Must cover
+    tQUIET (50 ns) and the track / hold acquisition time.
+
+    With i_trig held high, conversions run back to back: one sample every
+    16 + quiet SCLK periods. That is 1 MSPS with a 20 MHz SCLK and quiet=4.
 
-    def __init__(self):
+    nChannels: converters running in lockstep on the shared nCS and SCLK,
+    each with its own SDATA line (bit n of i_SDATA). Sample n is o_dats[n],
+    o_dat is the first one.
+    '''
+
+    def __init__(self, div=1, quiet=1, nChannels=1):
+        self.nChannels = nChannels
         # Pins
         self.o_nCS = Signal(reset=1)    # A conversion process begins on the falling edge of CS.
-        self.i_SDATA = Signal()         # The output words are clocked out of this pin
+        self.i_SDATA = Signal(nChannels)  # The output words are clocked out of this pin
         self.o_SCLK = Signal()          # guaranteed performance at 20 MHz
 
         # Samples
-        self.o_dat = Signal(12)
+        self.o_dats = [Signal(12, name="o_dat{}".format(i)) for i in range(nChannels)]
+        self.o_dat = self.o_dats[0]
         self.o_valid = Signal()         # Single cycle pulse when o_dat is valid
+        self.o_sampled = Signal()       # Single cycle pulse when the input is sampled (nCS falls)
         self.i_trig = Signal()          # Start a conversion (can be hardwired to 1 for continuous mode)
 
         ###
 
         self.peekReg = CSR(size=12)
-        shiftReg = Signal(12)
+        shiftRegs = [Signal(12, name="shiftReg{}".format(i)) for i in range(nChannels)]
         self.comb += [
-            self.o_SCLK.eq(ClockSignal()),
             self.peekReg.w.eq(self.o_dat)
         ]
         self.sync += [
             self.o_valid.eq(0),
-            shiftReg.eq(Cat(self.i_SDATA, shiftReg[:-1])),
-            timeline(self.i_trig, [
+            self.o_sampled.eq(0)
+        ]
+        if div == 1:
+            events = [
                 ( 0, [
                     self.o_nCS.eq(0),
-                    shiftReg.eq(0)
+                    self.o_sampled.eq(1),
+                    [sr.eq(0) for sr in shiftRegs]
                 ]),
                 (16, [
                     self.o_nCS.eq(1),
-                    self.o_dat.eq(shiftReg),
+                    [d.eq(sr) for d, sr in zip(self.o_dats, shiftRegs)],
                     self.o_valid.eq(1)
                 ])
-            ])
+            ]
+            if quiet > 1:
+                # Keep nCS high for longer before the next conversion
+                events.append((15 + quiet, []))
+            self.comb += self.o_SCLK.eq(ClockSignal())
+            self.sync += [
+                [sr.eq(Cat(self.i_SDATA[i], sr[:-1])) for i, sr in enumerate(shiftRegs)],
+                timeline(self.i_trig, events)
+            ]
+            return
+
+        divCnt = Signal(max=div)
+        ceFall = Signal()           # SCLK falls on the next edge
+        ceRise = Signal()           # SCLK rises on the next edge
+        bitCnt = Signal(max=16 + quiet + 1)
+        self.comb += [
+            ceFall.eq(divCnt == 0),
+            ceRise.eq(divCnt == div // 2)
+        ]
+        self.sync += [
+            If(divCnt == div - 1,
+                divCnt.eq(0)
+            ).Else(
+                divCnt.eq(divCnt + 1)
+            ),
+            If(ceRise,
+                self.o_SCLK.eq(1)
+            ),
+            If(ceFall,
+                self.o_SCLK.eq(0),
+                If(bitCnt == 0,
+                    If(self.i_trig,
+                        self.o_nCS.eq(0),
+                        self.o_sampled.eq(1),
+                        [sr.eq(0) for sr in shiftRegs],
+                        bitCnt.eq(1)
+                    )
+                ).Elif(bitCnt <= 16,
+                    # Sample the bit the ADC put out on the last falling edge
+                    [sr.eq(Cat(self.i_SDATA[i], sr[:-1])) for i, sr in enumerate(shiftRegs)],
+                    bitCnt.eq(bitCnt + 1),
+                    If(bitCnt == 16,
+                        self.o_nCS.eq(1),
+                        [d.eq(Cat(self.i_SDATA[i], sr[:-1])) for i, (d, sr) in enumerate(zip(self.o_dats, shiftRegs))],
+                        self.o_valid.eq(1)
+                    )
+                ).Elif(bitCnt >= 16 + quiet,
+                    # Quiet time is over, next conversion can start
+                    If(self.i_trig,
+                        self.o_nCS.eq(0),
+                        self.o_sampled.eq(1),
+                        [sr.eq(0) for sr in shiftRegs],
+                        bitCnt.eq(1)
+                    ).Else(
+                        bitCnt.eq(0)
+                    )
+                ).Else(
+                    bitCnt.eq(bitCnt + 1)
+                )
+            )
         ]
 
 
     def connectToPmod(self, platform):
+        ''' SDATA of channel n on MISO_PINS[n] '''
         ext = [("Adcs7476", 0,
             Subsignal("SS",   Pins("PMOD:0"), IOStandard("LVCMOS33")),
-            Subsignal("MISO", Pins("PMOD:2"), IOStandard("LVCMOS33")),
+            Subsignal("MISO", Pins(" ".join(MISO_PINS[:self.nChannels])), IOStandard("LVCMOS33")),
             Subsignal("SCK",  Pins("PMOD:3"), IOStandard("LVCMOS33"))
         )]
         platform.add_extension(ext)
@@ -74,11 +159,78 @@ def dut_tb(dut):
         yield
 
 
+@passive
+def adc_model(dut, values, ch=0):
+    '''
+    behaves like the ADCS7476: shifts out 4 zeros and the next 12 bit word
+    of values, MSB first. The first bit on the falling edge of nCS, the
+    others on the falling edges of SCLK. ch: drives that bit of i_SDATA
+    '''
+    nCS0 = SCLK0 = 1
+    word = bitInd = 0
+    while True:
+        nCS = (yield dut.o_nCS)
+        SCLK = (yield dut.o_SCLK)
+        if nCS0 and not nCS:
+            word = values.pop(0)
+            bitInd = 15
+            yield dut.i_SDATA[ch].eq((word >> bitInd) & 1)
+        elif not nCS and SCLK0 and not SCLK and bitInd > 0:
+            bitInd -= 1
+            yield dut.i_SDATA[ch].eq((word >> bitInd) & 1)
+        nCS0, SCLK0 = nCS, SCLK
+        yield
+
+
+def stream_tb(dut, nSamples, res):
+    ''' continuous conversions, records o_dat and the nCS timing '''
+    yield dut.i_trig.eq(1)
+    nCycles = nHigh = 0
+    while len(res["dat"]) < nSamples:
+        yield
+        nCycles += 1
+        if (yield dut.o_nCS):
+            nHigh += 1
+        elif nHigh:
+            res["quiet"].append(nHigh)
+            nHigh = 0
+        if (yield dut.o_sampled):
+            res["sampled"].append(nCycles)
+        if (yield dut.o_valid):
+            dat = []
+            for d in dut.o_dats:
+                dat.append((yield d))
+            res["dat"].append(dat)
+
+
+def check_stream(div, quiet, nSamples=8, nChannels=1):
+    ''' back to back conversions must give the right data at full speed '''
+    dut = Adcs7476(div, quiet, nChannels)
+    values = [[(i * 0x5A7 + c * 0x123) & 0xFFF for i in range(nSamples + 2)] for c in range(nChannels)]
+    res = dict(dat=[], quiet=[], sampled=[])
+    run_simulation(dut, [stream_tb(dut, nSamples, res)] + [
+        adc_model(dut, list(v), c) for c, v in enumerate(values)
+    ])
+    period = set(a - b for a, b in zip(res["sampled"][1:], res["sampled"]))
+    assert res["dat"] == [list(d) for d in zip(*values)][:nSamples], res["dat"]
+    assert period == {(16 + quiet) * div}, period
+    # The first high time is the reset state
+    assert min(res["quiet"][1:]) >= quiet * div, res["quiet"]
+    print("div: {} quiet: {} channels: {} cycles / sample: {} ok".format(
+        div, quiet, nChannels, period.pop()
+    ))
+
+
 def main():
     fName = __file__[:-3]
     convert(Adcs7476()).write(fName + ".v")
     dut = Adcs7476()
     run_simulation(dut, dut_tb(dut), vcd_name=fName+".vcd", clocks={"sys": 50})
+    # SCLK divided by 5 from 100 MHz: 1 MSPS
+    check_stream(5, 4)
+    check_stream(2, 1)
+    check_stream(2, 1, nChannels=3)
+    check_stream(5, 4, nChannels=2)
 
 if __name__ == '__main__':
     main()
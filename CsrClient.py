@@ -0,0 +1,180 @@
+"""
+Control path client with caching and batching on top of RemoteClient.
+
+Every register access over litex_server is a TCP round trip plus a
+UARTWishboneBridge command on a slow UART. This wrapper cuts down on them:
+
+  * write-through cache: registers which only the host changes (CSRStorage,
+    mode "rw") are read from the device once, later reads come from the
+    cache. Status registers (mode "ro") are always read
+  * readMany / writeMany: registers at consecutive addresses go out in one
+    burst command
+  * readMem: memory regions (like the ccd frame memory) are read in bursts
+    of up to 255 words, the length limit of the bridge
+
+Every bus transaction is counted with its latency and the number of bytes
+it takes on the bridge UART. See stats().
+"""
+import time
+from numpy import *
+
+# UARTWishboneBridge command: cmd, length, 4 address bytes, 4 bytes per word
+BRIDGE_HEADER = 6
+BRIDGE_WORD = 4
+
+
+class CsrClient(object):
+    """ wraps an open RemoteClient (or CommUART, same interface) """
+
+    def __init__(self, wb, cached=None, maxBurst=255):
+        self.wb = wb
+        self.maxBurst = maxBurst
+        self.regs = dict(wb.regs.__dict__)
+        if cached is None:
+            cached = [n for n, r in self.regs.items() if r.mode == "rw"]
+        self.cached = set(cached)   # names of the registers which are cached
+        self.cache = {}             # name: last value read / written
+        self.resetStats()
+
+    def resetStats(self):
+        self.nTransactions = 0
+        self.nWords = 0
+        self.nBytes = 0             # on the bridge UART, both directions
+        self.nHits = 0              # reads answered from the cache
+        self.tTotal = 0.0           # [s] spent in bus transactions
+        self.tMax = 0.0
+
+    def _count(self, t0, nWords):
+        dt = time.perf_counter() - t0
+        self.nTransactions += 1
+        self.nWords += nWords
+        self.nBytes += BRIDGE_HEADER + BRIDGE_WORD * nWords
+        self.tTotal += dt
+        self.tMax = dt if dt > self.tMax else self.tMax
+
+    def _read(self, addr, n):
+        """ one burst read of n words """
+        t0 = time.perf_counter()
+        dat = self.wb.read(addr, n)
+        self._count(t0, n)
+        return [dat] if isinstance(dat, int) else list(dat)
+
+    def _write(self, addr, words):
+        """ one burst write """
+        t0 = time.perf_counter()
+        self.wb.write(addr, words)
+        self._count(t0, len(words))
+
+    @staticmethod
+    def _dataWidth(reg):
+        # Attribute name depends on the litex version
+        return getattr(reg, "data_width", None) or getattr(reg, "busword", 8)
+
+    def _toValue(self, reg, words):
+        v = 0
+        w = self._dataWidth(reg)
+        for d in words:
+            v = (v << w) | d
+        return v
+
+    def _toWords(self, reg, value):
+        w = self._dataWidth(reg)
+        return [
+            (value >> ((reg.length - 1 - i) * w)) & ((1 << w) - 1)
+            for i in range(reg.length)
+        ]
+
+    def _runs(self, names):
+        """ group registers into runs of consecutive addresses """
+        regs = sorted([self.regs[n] for n in names], key=lambda r: r.addr)
+        runs = []
+        for r in regs:
+            if runs:
+                last = runs[-1]
+                end = last[-1].addr + 4 * last[-1].length
+                nWords = (end - last[0].addr) // 4 + r.length
+                if r.addr == end and nWords <= self.maxBurst:
+                    last.append(r)
+                    continue
+            runs.append([r])
+        return runs
+
+    def read(self, name):
+        """ value of register `name`, from the cache if possible """
+        if name in self.cache:
+            self.nHits += 1
+            return self.cache[name]
+        return self.readMany([name])[name]
+
+    def write(self, name, value):
+        self.writeMany({name: value})
+
+    def readMany(self, names):
+        """ {name: value}, uncached registers in as few bursts as possible """
+        res = {}
+        todo = []
+        for n in names:
+            if n in self.cache:
+                self.nHits += 1
+                res[n] = self.cache[n]
+            else:
+                todo.append(n)
+        for run in self._runs(todo):
+            nWords = sum([r.length for r in run])
+            words = self._read(run[0].addr, nWords)
+            i = 0
+            for r in run:
+                res[r.name] = self._toValue(r, words[i: i + r.length])
+                i += r.length
+        for n in todo:
+            if n in self.cached:
+                self.cache[n] = res[n]
+        return res
+
+    def writeMany(self, values):
+        """ write {name: value}, consecutive registers in one burst """
+        for run in self._runs(values.keys()):
+            words = []
+            for r in run:
+                words += self._toWords(r, values[r.name])
+            self._write(run[0].addr, words)
+        for n, v in values.items():
+            if n in self.cached:
+                self.cache[n] = v
+
+    def invalidate(self, name=None):
+        """ forget cached values, e.g. after a reset of the FPGA """
+        if name is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(name, None)
+
+    def readMem(self, name, length=None, offset=0):
+        """ `length` words of memory region `name` in bursts, as uint32 """
+        mem = getattr(self.wb.mems, name)
+        if length is None:
+            length = mem.size // 4 - offset
+        out = zeros(length, dtype=uint32)
+        for i in range(0, length, self.maxBurst):
+            n = int(minimum(self.maxBurst, length - i))
+            out[i: i + n] = self._read(mem.base + 4 * (offset + i), n)
+        return out
+
+    def stats(self):
+        """ what the control path cost so far """
+        n = self.nTransactions
+        return {
+            "transactions": n,
+            "words": self.nWords,
+            "bytes": self.nBytes,
+            "bytes_per_transaction": self.nBytes / n if n else 0,
+            "cache_hits": self.nHits,
+            "latency_mean_ms": 1e3 * self.tTotal / n if n else 0,
+            "latency_max_ms": 1e3 * self.tMax
+        }
+
+    def __str__(self):
+        return "transactions: {transactions} bytes: {bytes} " \
+            "({bytes_per_transaction:.1f} / transaction) cache hits: " \
+            "{cache_hits} latency: {latency_mean_ms:.2f} ms " \
+            "(max. {latency_max_ms:.2f} ms)".format(**self.stats())
@@ -0,0 +1,210 @@
+
+# Computes position features of every sensor line while the pixels arrive
+# Sits on the Tsl1401 pixel stream. At the end of each line, the features
+# go out as a short record on an output stream, one word per cycle, which
+# looks like a (short) line to LineAccumulator and ends up in the frame
+# memory instead of the raw pixels. The record fields and their order are
+# defined by Features.recordLayout(), Features.parseRecords() unpacks them
+# on the host. Fields wider than a word are split, least significant first.
+
+from migen import *
+from migen.fhdl.verilog import convert
+from litex.soc.interconnect.csr import *
+from Features import recordLayout
+
+
+class FeatureExtractor(Module, AutoCSR):
+    def __init__(self, nPixels=128, inWidth=12, wordWidth=12):
+        self.i_enable = CSRStorage(1)           # 0: raw lines, 1: feature records
+        self.i_thr = CSRStorage(inWidth, reset=1 << (inWidth - 1))  # Threshold
+        # Pixel stream from the sensor
+        self.i_valid = Signal()
+        self.i_dat = Signal(inWidth)
+        self.i_pixel = Signal(max=nPixels)
+        self.i_eol = Signal()                   # With i_valid of the last pixel
+        # Record stream, one word per cycle after the end of a line
+        self.o_valid = Signal()
+        self.o_dat = Signal(wordWidth)
+        self.o_pixel = Signal(max=nPixels)      # Word index in the record
+        self.o_eol = Signal()                   # With the last word
+
+        ###
+
+        layout = recordLayout(nPixels, inWidth)
+        thr = self.i_thr.storage
+        y = self.i_dat
+        x = self.i_pixel
+        isFirst = Signal()
+        isAbove = Signal()
+        d = Signal(inWidth)                     # y - thr, 0 below
+        prev = Signal(inWidth)                  # y of the previous pixel
+        # Feature registers, cur: so far in this line, nxt: including i_dat
+        cur = {n: Signal(b, name=n) for n, b in layout}
+        nxt = {n: Signal(b, name=n + "_nxt") for n, b in layout}
+        # Start of line values
+        base = {n: Signal(b, name=n + "_base") for n, b in layout}
+        isRise = Signal()
+        isFall = Signal()
+
+        self.comb += [
+            isFirst.eq(x == 0),
+            isAbove.eq(y >= thr),
+            If(y > thr, d.eq(y - thr)),
+            # At the first pixel, start over
+            [base[n].eq(Mux(isFirst, 0, cur[n])) for n, b in layout],
+            If(isFirst,
+                base["rise"].eq(nPixels),
+                base["fall"].eq(nPixels)
+            ),
+            isRise.eq(isAbove & (base["rise"] == nPixels)),
+            isFall.eq(~isAbove & (base["rise"] != nPixels) & (base["fall"] == nPixels)),
+            [nxt[n].eq(base[n]) for n, b in layout],
+            nxt["sum"].eq(base["sum"] + y),
+            nxt["m0"].eq(base["m0"] + d),
+            nxt["m1"].eq(base["m1"] + x * d),
+            nxt["nAbove"].eq(base["nAbove"] + isAbove),
+            If(isFirst | (y > base["peakVal"]),
+                nxt["peakIdx"].eq(x),
+                nxt["peakVal"].eq(y)
+            ),
+            If(isRise,
+                nxt["rise"].eq(x),
+                nxt["riseLo"].eq(Mux(isFirst, 0, prev)),
+                nxt["riseHi"].eq(y)
+            ),
+            If(isFall,
+                nxt["fall"].eq(x),
+                nxt["fallHi"].eq(prev),
+                nxt["fallLo"].eq(y)
+            )
+        ]
+        self.sync += If(self.i_valid,
+            [cur[n].eq(nxt[n]) for n, b in layout],
+            prev.eq(y)
+        )
+
+        # Record words, latched at the end of the line
+        words = []
+        for n, b in layout:
+            for i in range(0, b, wordWidth):
+                words.append(Signal(wordWidth, name="{}_w{}".format(n, i // wordWidth)))
+        self.nWords = len(words)
+        print("FeatureExtractor: {} words per record".format(self.nWords))
+        assert self.nWords <= nPixels
+        self.o_nWords = Signal(max=nPixels + 1, reset=self.nWords)
+        isSending = Signal()
+        wordIdx = Signal(max=nPixels)
+        i = 0
+        latch = []
+        for n, b in layout:
+            for j in range(0, b, wordWidth):
+                latch.append(words[i].eq(nxt[n][j: j + wordWidth]))
+                i += 1
+        self.sync += [
+            If(self.i_valid & self.i_eol,
+                latch,
+                isSending.eq(1),
+                wordIdx.eq(0)
+            ).Elif(isSending,
+                wordIdx.eq(wordIdx + 1),
+                If(wordIdx == self.nWords - 1,
+                    isSending.eq(0)
+                )
+            )
+        ]
+        self.comb += [
+            self.o_valid.eq(isSending),
+            self.o_dat.eq(Array(words)[wordIdx]),
+            self.o_pixel.eq(wordIdx),
+            self.o_eol.eq(isSending & (wordIdx == self.nWords - 1))
+        ]
+
+
+def featureModel(line, thr, nPixels=128):
+    ''' what the gateware computes for one line, as dict '''
+    f = {"sum": 0, "m0": 0, "m1": 0, "nAbove": 0, "peakIdx": 0, "peakVal": line[0],
+         "rise": nPixels, "riseLo": 0, "riseHi": 0, "fall": nPixels, "fallHi": 0, "fallLo": 0}
+    for x, y in enumerate(line):
+        f["sum"] += y
+        f["m0"] += y - thr if y > thr else 0
+        f["m1"] += x * (y - thr) if y > thr else 0
+        f["nAbove"] += y >= thr
+        if y > f["peakVal"]:
+            f["peakIdx"], f["peakVal"] = x, y
+        prev = line[x - 1] if x > 0 else 0
+        if y >= thr and f["rise"] == nPixels:
+            f["rise"], f["riseLo"], f["riseHi"] = x, prev, y
+        elif y < thr and f["rise"] != nPixels and f["fall"] == nPixels:
+            f["fall"], f["fallHi"], f["fallLo"] = x, prev, y
+    return f
+
+
+def dut_tb(dut, thr, nPixels, lines, wordGap=17):
+    ''' sends lines of pixels, one every wordGap cycles like the ADC '''
+    yield dut.i_thr.storage.eq(thr)
+    yield
+    for line in lines:
+        for i, val in enumerate(line):
+            yield dut.i_dat.eq(val)
+            yield dut.i_pixel.eq(i)
+            yield dut.i_eol.eq(i == nPixels - 1)
+            yield dut.i_valid.eq(1)
+            yield
+            yield dut.i_valid.eq(0)
+            for j in range(wordGap - 1):
+                yield
+
+
+@passive
+def record_tb(dut, records):
+    ''' collects the output records '''
+    rec = []
+    while True:
+        if (yield dut.o_valid):
+            rec.append((yield dut.o_dat))
+            if (yield dut.o_eol):
+                records.append(rec)
+                rec = []
+        yield
+
+
+def check(nPixels=128, thr=2000, nLines=4):
+    from numpy import random, exp, arange, clip, around
+    from Features import parseRecords
+    dut = FeatureExtractor(nPixels)
+    rnd = random.RandomState(nPixels)
+    x = arange(nPixels)
+    lines = []
+    for k in range(nLines):
+        pos = rnd.uniform(0, nPixels)
+        y = 100 + 3500 * exp(-(x - pos)**2 / 30) + rnd.randn(nPixels) * 20
+        lines.append([int(v) for v in clip(around(y), 0, 4095)])
+    # All dark and all bright
+    lines += [[10] * nPixels, [4000] * nPixels]
+    records = []
+    run_simulation(dut, [
+        dut_tb(dut, thr, nPixels, lines),
+        record_tb(dut, records)
+    ])
+    assert len(records) == len(lines), "got {} records".format(len(records))
+    res = parseRecords(records, nPixels=nPixels)
+    for k, line in enumerate(lines):
+        want = featureModel(line, thr, nPixels)
+        got = {n: int(res[n][k]) for n in want}
+        assert got == want, "line {}: {} != {}".format(k, got, want)
+    print("nPixels: {} lines: {} record words: {} ok".format(nPixels, len(lines), dut.nWords))
+
+
+def main():
+    fName = __file__[:-3]
+    dut = FeatureExtractor()
+    convert(dut, ios={
+        dut.i_valid, dut.i_dat, dut.i_pixel, dut.i_eol,
+        dut.o_valid, dut.o_dat, dut.o_pixel, dut.o_eol
+    }).write(fName + ".v")
+    check(128)
+    check(16, 1000)
+
+
+if __name__ == '__main__':
+    main()
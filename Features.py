@@ -0,0 +1,209 @@
+"""
+Position features of (N, nWords) blocks of line frames.
+
+All functions work on a whole block at once, from the RingBuffer, a
+FrameRecorder or FrameDecoder, without a Python loop over the frames.
+Positions are sub-pixel, in pixels from the first one. Frames without the
+feature get nan.
+
+  * edges(): first rising and falling crossing of a threshold, linearly
+    interpolated between the 2 pixels around it
+  * centroids(): intensity weighted mean position of everything above a
+    threshold
+  * peaks(): position of the maximum, refined with a parabola or a gaussian
+    through the 3 pixels around it
+
+parseRecords() unpacks the feature records which FeatureExtractor computes
+on the FPGA, instead of sending raw lines.
+"""
+from numpy import *
+
+
+def _rows(frames):
+    return atleast_2d(frames).astype(float32)
+
+
+def edges(frames, threshold):
+    """
+    (rising, falling) positions, where the signal crosses threshold.
+    threshold: scalar or (N,) for one per frame
+    """
+    y = _rows(frames)
+    thr = reshape(asarray(threshold, dtype=float32), (-1, 1))
+    isAbove = y >= thr
+    res = []
+    for cross in (~isAbove[:, :-1] & isAbove[:, 1:], isAbove[:, :-1] & ~isAbove[:, 1:]):
+        i = argmax(cross, 1)
+        rows = arange(y.shape[0])
+        y0 = y[rows, i]
+        y1 = y[rows, i + 1]
+        t = broadcast_to(thr[:, 0], y0.shape)
+        # Frames without a crossing give y0 == y1, they become nan below
+        with errstate(invalid="ignore", divide="ignore"):
+            pos = i + (t - y0) / (y1 - y0)
+        pos[~cross[rows, i]] = nan
+        res.append(pos)
+    return tuple(res)
+
+
+def centroids(frames, threshold=0):
+    """ sum((y - threshold) * x) / sum(y - threshold) over y > threshold """
+    y = _rows(frames)
+    w = y - reshape(asarray(threshold, dtype=float32), (-1, 1))
+    maximum(w, 0, out=w)
+    s = sum(w, 1)
+    with errstate(invalid="ignore", divide="ignore"):
+        c = w.dot(arange(y.shape[1], dtype=float32)) / s
+    c[s <= 0] = nan
+    return c
+
+
+def peaks(frames, method="parabolic", minHeight=None):
+    """
+    (position, height) of the maximum of every frame.
+    method: parabolic or gauss (fits log(y), needs y > 0)
+    minHeight: frames with a lower maximum get nan
+    """
+    y = _rows(frames)
+    n = y.shape[1]
+    rows = arange(y.shape[0])
+    i = argmax(y, 1)
+    # The 3 points around it, clamped at the borders
+    ic = clip(i, 1, n - 2)
+    ym, y0, yp = y[rows, ic - 1], y[rows, ic], y[rows, ic + 1]
+    if method == "gauss":
+        ym, y0, yp = [log(maximum(v, 1e-3)) for v in (ym, y0, yp)]
+    elif method != "parabolic":
+        raise ValueError("method must be parabolic or gauss, not " + str(method))
+    den = ym - 2 * y0 + yp
+    with errstate(invalid="ignore", divide="ignore"):
+        d = where(den < 0, 0.5 * (ym - yp) / den, 0)
+    # Only refine maxima which are not on the border
+    d = where(i == ic, clip(d, -0.5, 0.5), 0)
+    h = y0 - 0.25 * (ym - yp) * d
+    if method == "gauss":
+        h = exp(h)
+    h = where(i == ic, h, y[rows, i])
+    pos = (i + d).astype(float32)
+    if minHeight is not None:
+        pos[h < minHeight] = nan
+    return pos, h
+
+
+def recordLayout(nPixels=128, inWidth=12):
+    """ (name, bits) of the FeatureExtractor record fields, in order """
+    aBits = (nPixels - 1).bit_length()  # address bits
+    iBits = nPixels.bit_length()        # pixel index, nPixels: not found
+    return [
+        ("sum", inWidth + aBits),       # total intensity
+        ("m0", inWidth + aBits),        # sum(y - thr) over y > thr
+        ("m1", inWidth + 2 * aBits),    # sum(x * (y - thr)) over y > thr
+        ("nAbove", iBits),              # pixels with y >= thr
+        ("peakIdx", iBits),             # first maximum
+        ("peakVal", inWidth),
+        ("rise", iBits),                # first pixel with y >= thr
+        ("riseLo", inWidth),            # y of the pixel before, 0 at pixel 0
+        ("riseHi", inWidth),            # y of the rise pixel
+        ("fall", iBits),                # first pixel after rise with y < thr
+        ("fallHi", inWidth),            # y of the pixel before
+        ("fallLo", inWidth),            # y of the fall pixel
+    ]
+
+
+def recordWords(nPixels=128, inWidth=12, wordWidth=12):
+    """ (name, first word, number of words) of every field """
+    res = []
+    i = 0
+    for name, b in recordLayout(nPixels, inWidth):
+        n = (b + wordWidth - 1) // wordWidth
+        res.append((name, i, n))
+        i += n
+    return res
+
+
+def recordLen(nPixels=128, inWidth=12, wordWidth=12):
+    """ words per record """
+    name, i, n = recordWords(nPixels, inWidth, wordWidth)[-1]
+    return i + n
+
+
+def makeRecords(fields, nPixels=128, inWidth=12, wordWidth=12):
+    """ dict of (N,) field values -> (N, nWords) records, for emulating the gateware """
+    n = asarray(fields["sum"]).size
+    w = zeros((n, recordLen(nPixels, inWidth, wordWidth)), dtype=int64)
+    for name, i, nw in recordWords(nPixels, inWidth, wordWidth):
+        v = asarray(fields.get(name, 0), dtype=int64) * ones(n, dtype=int64)
+        for j in range(nw):
+            w[:, i + j] = (v >> (j * wordWidth)) & ((1 << wordWidth) - 1)
+    return w
+
+
+def parseRecords(words, thr=None, nPixels=128, inWidth=12, wordWidth=12):
+    """
+    (N, nWords) records -> dict of (N,) arrays, fields least significant
+    word first. Adds centroid and, if thr is given, sub-pixel edge
+    positions (nan when there is none)
+    """
+    w = atleast_2d(words).astype(int64)
+    res = {}
+    for name, i, n in recordWords(nPixels, inWidth, wordWidth):
+        v = zeros(w.shape[0], dtype=int64)
+        for j in range(n):
+            v |= w[:, i + j] << (j * wordWidth)
+        res[name] = v
+    with errstate(invalid="ignore", divide="ignore"):
+        res["centroid"] = where(res["m0"] > 0, res["m1"] / res["m0"], nan)
+        if thr is not None:
+            for name, y0, y1 in (("rise", "riseLo", "riseHi"), ("fall", "fallHi", "fallLo")):
+                # crossing between pixel i - 1 (y0) and pixel i (y1)
+                y0, y1 = res[y0], res[y1]
+                pos = res[name] - 1 + (thr - y0) / (y1 - y0)
+                res[name + "Pos"] = where(res[name] < nPixels, pos, nan)
+    return res
+
+
+def main():
+    """ self check against synthetic frames with known positions """
+    rnd = random.RandomState(0)
+    N, W = 1000, 128
+    x = arange(W)
+    pos = rnd.uniform(10, W - 10, N)
+    sig = 3.0
+    spots = 200 + 3000 * exp(-(x - pos[:, newaxis])**2 / (2 * sig**2))
+    steps = 200 + 3000 / (1 + exp(-(x - pos[:, newaxis]) / 0.7))
+    for method in ("parabolic", "gauss"):
+        p, h = peaks(spots - 200, method)
+        print("peaks {:9s} rms error: {:.4f} px".format(method, std(p - pos)))
+        assert std(p - pos) < 0.02
+    c = centroids(spots, 200 + 100)
+    print("centroid          rms error: {:.4f} px".format(std(c - pos)))
+    assert std(c - pos) < 0.02
+    # A rising step has no falling edge and the other way round, that must
+    # give nan without a warning
+    with errstate(all="raise"):
+        r, f = edges(steps, 200 + 1500)
+        r2, f2 = edges(steps[:, ::-1], 200 + 1500)
+    # The reversed step falls at W - 1 - pos
+    print("edge rising       rms error: {:.4f} px".format(std(r - pos)))
+    print("edge falling      rms error: {:.4f} px".format(std(f2 - (W - 1 - pos))))
+    assert std(r - pos) < 0.05 and std(f2 - (W - 1 - pos)) < 0.05
+    assert all(isnan(f)) and all(isnan(r2))
+
+    # Records through the wire format: opened mid-record, bytes dropped
+    from FrameDecoder import FrameDecoder
+    fields = {n: rnd.randint(0, 1 << int(minimum(b, 30)), N) for n, b in recordLayout()}
+    fields["sum"] = arange(N)   # identifies the records which made it
+    words = makeRecords(fields)
+    stream = hstack((full((N, 1), 0x42, uint8), words.astype(">u2").view(uint8))).ravel()
+    stream = delete(stream[5:], arange(3000, 3007))
+    dec = FrameDecoder(recordLen())
+    res = parseRecords(vstack([dec.decode(c.tobytes()) for c in array_split(stream, 9)]))
+    k = res["sum"]
+    assert k.size >= N - 3 and all(diff(k) > 0), k
+    for n, b in recordLayout():
+        assert array_equal(res[n], fields[n][k]), n
+    print("records: {} / {} parsed, {}".format(k.size, N, dec))
+
+
+if __name__ == '__main__':
+    main()
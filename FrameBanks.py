@@ -0,0 +1,197 @@
+
+# N-buffered frame memory
+# The memory is split into nBanks banks of nWords each.
+# A writer (Tsl1401) fills one bank while a reader (MemoryDumper) sends
+# the last completed one. Banks are swapped at the end of each frame,
+# so the reader never sees a frame which is still being written.
+# With 2 banks the writer is stalled while no bank is free, o_wr_stall
+# already goes high with the i_wr_done pulse. With 3 or more banks the
+# writer never waits and the reader gets the newest frame.
+# Each bank keeps metaWidth bits of the frame in it (e.g. FrameHeader),
+# taken from i_wr_meta with i_wr_done.
+
+from migen import *
+from migen.fhdl.verilog import convert
+from litex.soc.cores import uart
+from UartMemoryDumper import UartMemoryDumper, FrameHeader, monitor_tb
+from HeaderLayout import HEADER_BITS, headerLen
+
+
+class FrameBanks(Module):
+    def __init__(self, nBanks=2, nWords=128, metaWidth=0):
+        # Writer side
+        self.i_wr_done = Signal()   # Pulse: writer completed its bank
+        self.i_wr_meta = Signal(metaWidth or 1)
+        self.o_wr_stall = Signal()  # Writer must not start a new frame
+        self.o_wr_offset = Signal(max=nBanks * nWords)
+        # Reader side
+        self.o_rd_valid = Signal()  # A completed, unread frame is waiting
+        self.i_rd_start = Signal()  # Pulse: reader takes the waiting frame
+        self.i_rd_done = Signal()   # Pulse: reader is done with its bank
+        self.o_rd_offset = Signal(max=nBanks * nWords)
+        self.o_rd_meta = Signal(metaWidth or 1)  # Of the bank being read
+
+        ###
+
+        wrBank = Signal(max=nBanks)         # Being written
+        readyBank = Signal(max=nBanks)      # Newest completed frame
+        rdBank = Signal(max=nBanks)         # Being read
+        rdBusy = Signal()
+        freeBank = Signal(max=nBanks)
+        hasFree = Signal()
+        stalled = Signal()
+
+        # A bank is free when nobody is writing, reading or about to read it
+        for b in reversed(range(nBanks)):
+            self.comb += If(
+                (wrBank != b) &
+                ~(rdBusy & (rdBank == b)) &
+                ~(self.i_rd_start & (readyBank == b)),
+                freeBank.eq(b),
+                hasFree.eq(1)
+            )
+        self.comb += [
+            self.o_wr_stall.eq(stalled | (self.i_wr_done & ~hasFree)),
+            self.o_wr_offset.eq(wrBank * nWords),
+            self.o_rd_offset.eq(rdBank * nWords)
+        ]
+        if metaWidth > 0:
+            metas = Array(Signal(metaWidth, name="meta{}".format(b)) for b in range(nBanks))
+            self.sync += If(self.i_wr_done,
+                metas[wrBank].eq(self.i_wr_meta)
+            )
+            self.comb += self.o_rd_meta.eq(metas[rdBank])
+        self.sync += [
+            If(self.i_rd_done,
+                rdBusy.eq(0)
+            ),
+            If(self.i_rd_start,
+                rdBank.eq(readyBank),
+                rdBusy.eq(1),
+                self.o_rd_valid.eq(0)
+            ),
+            If(self.i_wr_done,
+                readyBank.eq(wrBank),
+                self.o_rd_valid.eq(1),
+                If(hasFree,
+                    wrBank.eq(freeBank)
+                ).Else(
+                    stalled.eq(1)
+                )
+            ).Elif(stalled & hasFree,
+                wrBank.eq(freeBank),
+                stalled.eq(0)
+            )
+        ]
+
+
+class BanksTestbench(Module):
+    ''' frame writer port + FrameBanks + UartMemoryDumper [+ FrameHeader] '''
+    def __init__(self, nBanks=2, nWords=8, header=False):
+        self.nWords = nWords
+        self.specials.mem = mem = Memory(16, nBanks * nWords)
+        self.specials.wp = wp = mem.get_port(write_capable=True)
+        self.submodules.banks = banks = FrameBanks(nBanks, nWords, HEADER_BITS if header else 0)
+        self.submodules.dump = dump = UartMemoryDumper(
+            uart.UARTPads(), mem, nWords=nWords, header=header
+        )
+        if header:
+            self.submodules.hdr = hdr = FrameHeader()
+            self.comb += [
+                hdr.i_done.eq(banks.i_wr_done),
+                banks.i_wr_meta.eq(hdr.o_header),
+                dump.i_header.eq(banks.o_rd_meta)
+            ]
+        self.wr_adr = Signal(max=nWords)
+        self.comb += [
+            wp.adr.eq(banks.o_wr_offset + self.wr_adr),
+            dump.i_adrOffset.eq(banks.o_rd_offset),
+            dump.i_trig.eq(banks.o_rd_valid),
+            banks.i_rd_start.eq(dump.o_start),
+            banks.i_rd_done.eq(dump.o_done)
+        ]
+
+
+def writer_tb(dut, nFrames, gaps, wordGap=17):
+    '''
+    writes frame k with all words = k, one word every wordGap cycles
+    (like the ADC does), waits gaps[k] cycles between frames
+    '''
+    yield dut.dump.tuneWord.storage.eq(0x80000000)
+    for k in range(1, nFrames + 1):
+        while (yield dut.banks.o_wr_stall):
+            yield
+        for i in range(dut.nWords):
+            yield dut.wr_adr.eq(i)
+            yield dut.wp.dat_w.eq(k)
+            yield dut.wp.we.eq(1)
+            yield
+            yield dut.wp.we.eq(0)
+            for j in range(wordGap - 1):
+                yield
+        yield dut.banks.i_wr_done.eq(1)
+        yield
+        yield dut.banks.i_wr_done.eq(0)
+        for i in range(gaps[k % len(gaps)]):
+            yield
+    # Let the dumper finish
+    for i in range(3000):
+        yield
+
+
+def check_tearing(nBanks, gaps, nFrames=40, header=False):
+    '''
+    raises if any frame received by the dumper is torn. With header, the
+    sequence number must belong to the frame and the timestamps increase
+    '''
+    from FrameDecoder import parseHeader
+    dut = BanksTestbench(nBanks, header=header)
+    nHeader = headerLen(16) if header else 0
+    frames = []
+    run_simulation(dut, [
+        writer_tb(dut, nFrames, gaps),
+        monitor_tb(dut.dump.uart, 1 + 2 * (nHeader + dut.nWords), frames)
+    ])
+    seqs = []
+    times = []
+    hdrSeqs = []
+    for f in frames:
+        assert f[0] == 0x42, "lost sync"
+        words = [(f[i] << 8) | f[i + 1] for i in range(1, len(f), 2)]
+        hdr, words = words[:nHeader], words[nHeader:]
+        assert len(set(words)) == 1, "torn frame: {}".format(words)
+        seqs.append(words[0])
+        if header:
+            h = parseHeader([hdr], 16)
+            # Frame k is written with k, k - 1 frames were completed before
+            assert h["seq"][0] == words[0] - 1, (h, words[0])
+            hdrSeqs.append(int(h["seq"][0]))
+            times.append(int(h["time"][0]))
+    assert seqs == sorted(set(seqs)), "frames out of order: {}".format(seqs)
+    if nBanks == 2:
+        # The writer waits for the reader, nothing is lost
+        assert seqs == list(range(1, nFrames + 1)), "lost frames: {}".format(seqs)
+        if header:
+            assert hdrSeqs == list(range(nFrames)), "sequence gaps: {}".format(hdrSeqs)
+    assert times == sorted(set(times)), "timestamps out of order: {}".format(times)
+    print("nBanks: {} header: {} sent: {} received: {} torn: 0".format(
+        nBanks, header, nFrames, len(seqs)
+    ))
+
+
+def main():
+    fName = __file__[:-3]
+    dut = FrameBanks()
+    convert(dut, ios={
+        dut.i_wr_done, dut.o_wr_stall, dut.o_wr_offset,
+        dut.o_rd_valid, dut.i_rd_start, dut.i_rd_done, dut.o_rd_offset
+    }).write(fName + ".v")
+    # Writer faster than, comparable to and slower than the reader
+    for nBanks in (2, 3):
+        check_tearing(nBanks, [0, 13, 300, 1, 700, 50])
+    for nBanks in (2, 3):
+        check_tearing(nBanks, [0, 13, 300, 1, 700, 50], header=True)
+
+
+if __name__ == '__main__':
+    main()
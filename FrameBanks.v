@@ -0,0 +1,83 @@
+/* Machine-generated using Migen */
+module top(
+	input framebanks,
+	output framebanks_1,
+	output [7:0] framebanks_2,
+	output reg framebanks_3,
+	input framebanks_4,
+	input framebanks_5,
+	output [7:0] framebanks_6,
+	input sys_clk,
+	input sys_rst
+);
+
+reg framebanks7 = 1'd0;
+reg framebanks8 = 1'd0;
+reg framebanks9 = 1'd0;
+reg framebanks10 = 1'd0;
+reg framebanks11;
+reg framebanks12;
+reg framebanks13 = 1'd0;
+
+// synthesis translate_off
+reg dummy_s;
+initial dummy_s <= 1'd0;
+// synthesis translate_on
+
+
+// synthesis translate_off
+reg dummy_d;
+// synthesis translate_on
+always @(*) begin
+	framebanks11 <= 1'd0;
+	framebanks12 <= 1'd0;
+	if ((((framebanks7 != 1'd1) & (~(framebanks10 & (framebanks9 == 1'd1)))) & (~(framebanks_4 & (framebanks8 == 1'd1))))) begin
+		framebanks11 <= 1'd1;
+		framebanks12 <= 1'd1;
+	end
+	if ((((framebanks7 != 1'd0) & (~(framebanks10 & (framebanks9 == 1'd0)))) & (~(framebanks_4 & (framebanks8 == 1'd0))))) begin
+		framebanks11 <= 1'd0;
+		framebanks12 <= 1'd1;
+	end
+// synthesis translate_off
+	dummy_d <= dummy_s;
+// synthesis translate_on
+end
+assign framebanks_1 = (framebanks13 | (framebanks & (~framebanks12)));
+assign framebanks_2 = (framebanks7 * 8'd128);
+assign framebanks_6 = (framebanks9 * 8'd128);
+
+always @(posedge sys_clk) begin
+	if (framebanks_5) begin
+		framebanks10 <= 1'd0;
+	end
+	if (framebanks_4) begin
+		framebanks9 <= framebanks8;
+		framebanks10 <= 1'd1;
+		framebanks_3 <= 1'd0;
+	end
+	if (framebanks) begin
+		framebanks8 <= framebanks7;
+		framebanks_3 <= 1'd1;
+		if (framebanks12) begin
+			framebanks7 <= framebanks11;
+		end else begin
+			framebanks13 <= 1'd1;
+		end
+	end else begin
+		if ((framebanks13 & framebanks12)) begin
+			framebanks7 <= framebanks11;
+			framebanks13 <= 1'd0;
+		end
+	end
+	if (sys_rst) begin
+		framebanks_3 <= 1'd0;
+		framebanks7 <= 1'd0;
+		framebanks8 <= 1'd0;
+		framebanks9 <= 1'd0;
+		framebanks10 <= 1'd0;
+		framebanks13 <= 1'd0;
+	end
+end
+
+endmodule
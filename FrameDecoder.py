@@ -0,0 +1,471 @@
+"""
+Bulk decoder for the byte stream sent by UartMemoryDumper.
+
+Each frame is a sync byte followed by `nWords` big-endian 16 bit words.
+The ADC only delivers 12 bit samples, so the upper 4 bits of every word are
+always zero. This is used to check and re-find frame boundaries, as the sync
+byte itself can show up anywhere in the pixel data.
+
+In packed mode (MemoryDumper(packed=True)) the words are sent back to back
+with nBits each. As there are no padding bits to check, a frame is only
+accepted once the sync byte of the following frame has been seen.
+
+RiceFrameDecoder handles the variable length, Rice coded frames of
+MemoryDumper(riceK=...). Those are checked the same way.
+
+Frames of a sensor with several colour channels (LinearCcd.nChannels) hold
+nChannels words per pixel, interleaved or planar. With nChannels > 1 the
+decoders return (N, nChannels, nPixels) arrays, see splitChannels().
+
+With MemoryDumper(header=True), every frame starts with the header words
+(HEADER_LAYOUT): sequence number, cycle count of the sys clock when the
+frame was complete and ccd_i_tau. They are coded like the pixels, so the
+checks above cover them too. The decoders strip them off and keep the
+fields of the last decoded block in .header, see FrameStats.
+"""
+from numpy import *
+from Profiler import NULL_PROFILER
+from HeaderLayout import HEADER_LAYOUT, headerWords, headerLen
+
+
+def parseHeader(words, nBits=12):
+    """ (N, headerLen) words -> dict of (N,) int64 arrays """
+    w = atleast_2d(words).astype(int64)
+    res = {}
+    for name, i, n in headerWords(nBits):
+        v = zeros(w.shape[0], dtype=int64)
+        for j in range(n):
+            v |= w[:, i + j] << (j * nBits)
+        res[name] = v
+    return res
+
+
+def makeHeader(nBits=12, **fields):
+    """ header words of one frame, for emulating the gateware """
+    words = []
+    for name, b in HEADER_LAYOUT:
+        v = int(fields.get(name, 0)) & ((1 << b) - 1)
+        for j in range(0, b, nBits):
+            words.append((v >> j) & ((1 << nBits) - 1))
+    return array(words, dtype=uint16)
+
+
+def unpackWords(raw, nWords, nBits=12):
+    """
+    raw: (N, nBytes) uint8 array of packed, MSB first words
+    returns (N, nWords) array of unsigned ints
+    """
+    N = raw.shape[0]
+    if nBits == 12 and nWords % 2 == 0:
+        # 3 bytes -> 2 words
+        b = raw[:, :nWords // 2 * 3].reshape(N, nWords // 2, 3).astype(uint16)
+        words = empty((N, nWords), dtype=uint16)
+        words[:, 0::2] = (b[:, :, 0] << 4) | (b[:, :, 1] >> 4)
+        words[:, 1::2] = ((b[:, :, 1] & 0x0F) << 8) | b[:, :, 2]
+        return words
+    bits = unpackbits(raw, axis=1)[:, :nWords * nBits]
+    bits = bits.reshape(N, nWords, nBits)
+    return bits.dot(1 << arange(nBits - 1, -1, -1)).astype(
+        uint16 if nBits <= 16 else uint32
+    )
+
+
+def packWords(words, nBits=12):
+    """ (N, nWords) ints -> (N, nBytes) uint8. What MemoryDumper sends """
+    words = asarray(words, dtype=uint32)
+    bits = (words[:, :, newaxis] >> arange(nBits - 1, -1, -1)) & 1
+    return packbits(bits.reshape(words.shape[0], -1).astype(uint8), axis=1)
+
+
+def splitChannels(frames, nChannels=1, planar=False):
+    """
+    (N, nWords) frames with nChannels words per pixel -> (N, nChannels,
+    nWords // nChannels) view. planar: all pixels of channel 0 come first
+    (LinearCcd.i_planar), else the channels of a pixel are next to each other
+    """
+    frames = asarray(frames)
+    n, nPixels = frames.shape[0], frames.shape[1] // nChannels
+    if planar:
+        return frames.reshape(n, nChannels, nPixels)
+    return frames.reshape(n, nPixels, nChannels).transpose(0, 2, 1)
+
+
+def riceEncode(frames, k=3, qMax=8, nBits=12, syncWord=0x42):
+    """
+    (N, nWords) ints -> bytes. What MemoryDumper(riceK=k) sends,
+    including the sync bytes
+    """
+    frames = atleast_2d(frames).astype(int64)
+    d = diff(frames, axis=1, prepend=0)
+    u = where(d < 0, -2 * d - 1, 2 * d)
+    q = minimum(u >> k, qMax)
+    isEsc = q >= qMax
+    # Code words and their lengths, MSB first
+    codes = where(
+        isEsc,
+        (((1 << qMax) - 1) << (nBits + 1)) | u,
+        (((1 << q) - 1) << (k + 1)) | (u & ((1 << k) - 1))
+    )
+    lens = where(isEsc, qMax + nBits + 1, q + 1 + k)
+    L = qMax + nBits + 1
+    bits = (codes[:, :, newaxis] >> arange(L - 1, -1, -1)) & 1
+    isUsed = arange(L) >= L - lens[:, :, newaxis]
+    out = []
+    for fBits, fUsed in zip(bits, isUsed):
+        out.append(bytes([syncWord]))
+        out.append(packbits(fBits[fUsed].astype(uint8)).tobytes())
+    return b"".join(out)
+
+
+class FrameDecoder(object):
+    """
+    split a UartMemoryDumper byte stream into (N, nWords) frames, or
+    (N, nChannels, nWords // nChannels) with nChannels > 1
+    """
+
+    def __init__(self, nWords=128, syncWord=0x42, nBits=12, packed=False, nChannels=1, planar=False, header=False):
+        self.nWords = nWords
+        self.syncWord = syncWord
+        self.nBits = nBits
+        self.packed = packed
+        self.nChannels = nChannels
+        self.planar = planar
+        self.nHeader = headerLen(nBits) if header else 0
+        self.nWire = nWords + self.nHeader  # words per frame on the wire
+        self.header = None      # header fields of the last decoded frames
+        nWords = self.nWire
+        if packed:
+            self.frameLen = 1 + (nWords * nBits + 7) // 8
+            self.hiMask = 0
+        else:
+            self.frameLen = 1 + 2 * nWords      # bytes per frame, incl. sync
+            # Bits in the high byte of each word which must be zero
+            self.hiMask = (0xFF00 >> int(maximum(nBits - 8, 0))) & 0xFF
+        self.tail = b""                     # unprocessed bytes
+        # Statistics
+        self.nBytes = 0         # bytes received
+        self.nFrames = 0        # good frames decoded
+        self.nDropped = 0       # frames lost to corruption / misalignment
+        self.nResync = 0        # how often framing was lost
+        self.nSkipped = 0       # bytes thrown away while re-syncing
+
+    def _rowsValid(self, rows, nxt):
+        """
+        rows: (N, frameLen) uint8 array, nxt: the byte after each row.
+        Which ones are good frames?
+        """
+        isValid = rows[:, 0] == self.syncWord
+        if self.hiMask:
+            isValid &= ~any(rows[:, 1::2] & self.hiMask, 1)
+        else:
+            isValid &= nxt == self.syncWord
+        return isValid
+
+    def _findSync(self, arr, start):
+        """ index of the next valid frame in arr[start:], or None """
+        # Without padding bits, require 3 sync bytes in a row
+        nCheck = 1 if self.hiMask else 3
+        stop = arr.size - (nCheck - 1) * self.frameLen - self.frameLen + 1
+        if stop <= start:
+            return None
+        cands = flatnonzero(arr[start:stop] == self.syncWord) + start
+        if self.hiMask:
+            # Check the high bytes of all candidates. Most bad ones fail
+            # in the first few words already, only the others are checked
+            # over the whole frame. Keeps long frames from needing a
+            # (candidates, frameLen) array
+            n0 = int(minimum(65, self.frameLen))
+            for i0, i1 in ((1, n0), (n0, self.frameLen)):
+                if i1 <= i0:
+                    continue
+                his = arr[cands[:, newaxis] + arange(i0, i1, 2)]
+                cands = cands[~any(his & self.hiMask, 1)]
+        else:
+            for i in range(1, nCheck):
+                cands = cands[arr[cands + i * self.frameLen] == self.syncWord]
+        return cands[0] if cands.size else None
+
+    def decode(self, dat):
+        """
+        Feed bytes from the serial port, return all complete frames as
+        (N, nWords) array of big endian uint16. The result is a view into
+        the received data, no copy is made. Packed frames are unpacked into
+        a new native uint16 array.
+        """
+        self.nBytes += len(dat)
+        buf = self.tail + dat if self.tail else bytes(dat)
+        arr = frombuffer(buf, dtype=uint8)
+        starts = []         # (index, n_frames) of runs of good frames
+        pos = 0
+        # Packed frames need the next sync byte to be checked
+        nExtra = 0 if self.hiMask else 1
+        while arr.size - pos >= self.frameLen + nExtra:
+            nRows = (arr.size - pos - nExtra) // self.frameLen
+            rows = arr[pos: pos + nRows * self.frameLen]
+            rows = rows.reshape(nRows, self.frameLen)
+            nxt = arr[pos + self.frameLen::self.frameLen][:nRows]
+            bad = flatnonzero(~self._rowsValid(rows, nxt))
+            nGood = bad[0] if bad.size else nRows
+            if nGood > 0:
+                starts.append((pos, nGood))
+                pos += nGood * self.frameLen
+                continue
+            # Lost framing, search for the next good frame
+            nxt = self._findSync(arr, pos + 1)
+            isFound = nxt is not None
+            if not isFound:
+                # Keep the last frames, they might still be good
+                nKeep = self.frameLen - 1 if self.hiMask else 3 * self.frameLen
+                nxt = int(maximum(arr.size - nKeep, pos + 1))
+            self.nResync += 1
+            self.nSkipped += nxt - pos
+            self.nDropped += int(maximum(1, round((nxt - pos) / self.frameLen)))
+            pos = nxt
+            if not isFound:
+                break
+        self.tail = buf[pos:]
+        if len(starts) == 1:
+            p, n = starts[0]
+            frames = self._wordView(buf, p, n)
+        elif len(starts) > 1:
+            frames = vstack([self._wordView(buf, p, n) for p, n in starts])
+        else:
+            frames = zeros((0, self.nWire), dtype=uint16 if self.packed else ">u2")
+        self.nFrames += frames.shape[0]
+        return self._output(frames)
+
+    def _output(self, frames):
+        """ strip the header words, split the channels """
+        if self.nHeader:
+            self.header = parseHeader(frames[:, :self.nHeader], self.nBits)
+            frames = frames[:, self.nHeader:]
+        if self.nChannels == 1:
+            return frames
+        return splitChannels(frames, self.nChannels, self.planar)
+
+    def _wordView(self, buf, pos, n):
+        """ n frames starting at byte pos of buf as (n, nWords) words """
+        if self.packed:
+            raw = ndarray(
+                (n, self.frameLen - 1),
+                dtype=uint8,
+                buffer=buf,
+                offset=pos + 1,
+                strides=(self.frameLen, 1)
+            )
+            return unpackWords(raw, self.nWire, self.nBits)
+        return ndarray(
+            (n, self.nWire),
+            dtype=">u2",
+            buffer=buf,
+            offset=pos + 1,
+            strides=(self.frameLen, 2)
+        )
+
+    def read(self, ser, minFrames=1, prof=NULL_PROFILER):
+        """
+        Read everything waiting on the serial port ser (at least enough bytes
+        for minFrames frames) and return the decoded frames.
+        prof: Profiler for the stages "read" and "decode" and the gauge
+        "backlog" (bytes waiting in the serial buffer)
+        """
+        nWaiting = ser.in_waiting
+        prof.gauge("backlog", nWaiting)
+        nBytes = int(maximum(nWaiting, minFrames * self.frameLen - len(self.tail)))
+        with prof.stage("read"):
+            raw = ser.read(nBytes)
+        with prof.stage("decode"):
+            return self.decode(raw)
+
+    def __str__(self):
+        return "frames: {} dropped: {} resync: {} skipped bytes: {}".format(
+            self.nFrames, self.nDropped, self.nResync, self.nSkipped
+        )
+
+
+class RiceFrameDecoder(FrameDecoder):
+    """
+    split a MemoryDumper(riceK=k) byte stream into (N, nWords) frames.
+    k, qMax and nBits must match riceK, riceQMax and wordWidth.
+    Deltas are coded along the frame, planar colour frames compress better
+    """
+
+    def __init__(self, nWords=128, syncWord=0x42, nBits=12, k=3, qMax=8, nChannels=1, planar=False, header=False):
+        FrameDecoder.__init__(self, nWords, syncWord, nBits, nChannels=nChannels, planar=planar, header=header)
+        self.k = k
+        self.qMax = qMax
+        nWords = self.nWire
+        # Shortest and longest possible frame in bytes, incl. sync
+        self.frameLen = 1 + (nWords * (k + 1) + 7) // 8
+        self.maxLen = 1 + (nWords * (qMax + nBits + 1) + 7) // 8
+        self.avgLen = self.maxLen   # of the frames received so far
+
+    def _codeTables(self, bits):
+        """
+        For a Rice code starting at each bit position p, return the position
+        of its first zero bit and jump tables J, where J[j][p] is the start
+        of the 2**j th code after p. bits.size marks 'beyond the data'.
+        """
+        nb = bits.size
+        # Positions fit in int32, halves the memory traffic of the lookups
+        p = arange(nb, dtype=int32)
+        nz = where(bits == 0, p, int32(nb))
+        nz = minimum.accumulate(nz[::-1])[::-1]
+        isEsc = nz - p >= self.qMax
+        nxt = where(isEsc, p + self.qMax + self.nBits + 1, nz + 1 + self.k)
+        J = [append(minimum(nxt, nb), int32(nb))]
+        while (1 << len(J)) <= self.nWire:
+            J.append(J[-1][J[-1]])
+        return nz, J
+
+    def _jump(self, J, p, n):
+        """ start of the n th code after bit positions p """
+        for j in range(len(J)):
+            if (n >> j) & 1:
+                p = J[j][p]
+        return p
+
+    def _codePositions(self, J, p):
+        """ (N,) code start bits -> (N, nWire) start bits of all codes """
+        P = p[:, newaxis]
+        for j in range(len(J)):
+            if P.shape[1] >= self.nWire:
+                break
+            P = hstack((P, J[j][P]))
+        return P[:, :self.nWire]
+
+    def _readBits(self, bits, p, n):
+        """ n bit unsigned ints starting at bit positions p """
+        if n == 0:
+            return zeros_like(p)
+        idx = minimum(p[..., newaxis] + arange(n), bits.size - 1)
+        return bits[idx].dot(1 << arange(n - 1, -1, -1))
+
+    def decode(self, dat):
+        """
+        Feed bytes from the serial port, return all complete frames as
+        (N, nWords) array of uint16.
+        """
+        self.nBytes += len(dat)
+        buf = self.tail + dat if self.tail else bytes(dat)
+        arr = frombuffer(buf, dtype=uint8)
+        bits = unpackbits(arr)
+        nb = bits.size
+        nz, J = self._codeTables(bits)
+        # Where does the frame end, for every sync byte candidate
+        cands = flatnonzero(arr == self.syncWord)
+        e = self._jump(J, minimum(8 * cands + 8, nb), self.nWire)
+        eb = (e + 7) // 8
+        isDone = zeros(arr.size, dtype=bool)    # enough data to check
+        isDone[cands] = eb < arr.size
+        ends = zeros(arr.size, dtype=int)
+        ends[cands] = minimum(eb, arr.size - 1)
+        # Good: padding bits are zero and the next frame starts with sync
+        padMask = (1 << (8 * eb - e)) - 1
+        isGood = zeros(arr.size, dtype=bool)
+        isGood[cands] = isDone[cands] & (arr[ends[cands]] == self.syncWord) & \
+            (arr[ends[cands] - 1] & padMask == 0)
+        # Resync needs 2 good frames in a row
+        isChain = zeros(arr.size, dtype=bool)
+        isChain[cands] = isGood[cands] & isGood[ends[cands]]
+
+        starts = []
+        pos = 0
+        while pos < arr.size:
+            if isGood[pos]:
+                starts.append(pos)
+                pos = ends[pos]
+                continue
+            if arr[pos] == self.syncWord and not isDone[pos]:
+                break   # Need more data to check this one
+            # Lost framing, search for the next good frame
+            nxt = flatnonzero(isChain[pos + 1:])
+            isFound = nxt.size > 0
+            if isFound:
+                nxt = pos + 1 + nxt[0]
+            else:
+                # Keep the last frames, they might still be good
+                nxt = int(maximum(arr.size - 3 * self.maxLen, pos + 1))
+            self.nResync += 1
+            self.nSkipped += nxt - pos
+            self.nDropped += int(maximum(1, round((nxt - pos) / self.avgLen)))
+            pos = nxt
+            if not isFound:
+                break
+        self.tail = buf[pos:]
+        if not starts:
+            return self._output(zeros((0, self.nWire), dtype=uint16))
+        starts = array(starts)
+        lens = ends[starts] - starts
+        self.avgLen += (mean(lens) - self.avgLen) * minimum(1, lens.size / 16)
+        # Decode all codes of all frames at once
+        P = self._codePositions(J, 8 * starts + 8)
+        Z = nz[P]
+        isEsc = Z - P >= self.qMax
+        u = where(
+            isEsc,
+            self._readBits(bits, P + self.qMax, self.nBits + 1),
+            ((Z - P) << self.k) | self._readBits(bits, Z + 1, self.k)
+        )
+        d = (u >> 1) ^ -(u & 1)
+        frames = cumsum(d, axis=1)
+        # Corrupted frames are likely to leave the range of the ADC
+        isValid = all((frames >= 0) & (frames < (1 << self.nBits)), 1)
+        self.nDropped += int(sum(~isValid))
+        frames = frames[isValid].astype(uint16)
+        self.nFrames += frames.shape[0]
+        return self._output(frames)
+
+
+def main():
+    """ decode a simulated stream with some bit errors in it """
+    frames = random.randint(0, 4096, (1000, 128)).astype(">u2")
+    frames[:, 5] = 0x0042   # Trap for naive sync detection
+    for packed in (False, True):
+        dec = FrameDecoder(packed=packed)
+        raw = packWords(frames) if packed else frames.view(uint8)
+        stream = hstack((full((1000, 1), 0x42, uint8), raw)).ravel()
+        stream[1000:1010] = 0xFF    # Corrupt a frame
+        stream = delete(stream, arange(100000, 100007))  # Drop some bytes
+        res = vstack([dec.decode(c.tobytes()) for c in array_split(stream, 77)])
+        print("packed: {} bytes: {} {}".format(packed, stream.size, dec))
+        print("decoded {} / {} frames".format(res.shape[0], frames.shape[0]))
+    # Short frames (shorter than the first sync check window), opened
+    # mid-frame and with dropped bytes
+    dec = FrameDecoder(16)
+    stream = hstack((full((1000, 1), 0x42, uint8), frames[:, :16].view(uint8))).ravel()
+    stream = delete(stream[3:], arange(10000, 10005))
+    res = vstack([dec.decode(c.tobytes()) for c in array_split(stream, 13)])
+    # Frame 0 is cut, the one with the dropped bytes is lost
+    isLost = zeros(1000, bool)
+    isLost[[0, (10000 + 3) // 33]] = True
+    assert array_equal(res, frames[~isLost, :16]), res.shape
+    print("16 words: decoded {} {}".format(res.shape, dec))
+    # 3 colour channels of 40 pixels
+    for planar in (False, True):
+        dec = FrameDecoder(120, nChannels=3, planar=planar)
+        stream = hstack((full((1000, 1), 0x42, uint8), frames[:, :120].view(uint8)))
+        res = dec.decode(stream.tobytes())
+        want = frames[:, :120].reshape((1000, 3, 40) if planar else (1000, 40, 3))
+        assert array_equal(res, want if planar else want.transpose(0, 2, 1))
+        print("planar: {} decoded {} {}".format(planar, res.shape, dec))
+    # Frame headers, sequence numbers wrap around
+    hdrs = vstack([makeHeader(seq=k + 65000, time=k * 9000, tau=77) for k in range(1000)])
+    words = hstack((hdrs, frames[:, :64]))
+    for dec in (FrameDecoder(64, header=True), RiceFrameDecoder(64, header=True)):
+        if isinstance(dec, RiceFrameDecoder):
+            stream = frombuffer(riceEncode(words), uint8)
+        else:
+            stream = hstack((full((1000, 1), 0x42, uint8), words.astype(">u2").view(uint8))).ravel()
+        res, seq = [], []
+        for c in array_split(stream, 7):
+            res.append(dec.decode(c.tobytes()))
+            seq.append(dec.header["seq"])
+        res = vstack(res)
+        assert array_equal(res, frames[:res.shape[0], :64])
+        assert array_equal(hstack(seq), (arange(res.shape[0]) + 65000) & 0xFFFF)
+        print("{} with header: decoded {} {}".format(type(dec).__name__, res.shape, dec))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+"""
+Append-only recording of CCD frames into memory mapped files.
+
+A recording `name` consists of 3 files:
+  * name.dat: raw frames, (N, width) array of dtype, row after row
+  * name.idx: one (t, seq) record per frame. t is the host receive time [s],
+    seq the frame sequence number
+  * name.json: width, dtype and number of frames recorded so far
+
+The files are preallocated in chunks and grown when full, frames are copied
+straight into the mapping. Dirty pages are written back by the OS, so the
+RAM use stays constant no matter how long the recording runs and push() does
+not wait for the disk.
+
+FrameReader gives random access to a recording without loading it, all
+slices are views into the mapping. It also works on a recording which is
+still being written, call refresh() to see new frames.
+"""
+import json
+import os
+import time
+import threading
+from numpy import *
+
+INDEX_DTYPE = dtype([("t", "<f8"), ("seq", "<i8")])
+
+
+def _fileNames(name):
+    return name + ".dat", name + ".idx", name + ".json"
+
+
+class FrameRecorder(object):
+    """ appends (N, width) blocks of frames to the recording `name` """
+
+    def __init__(self, name, width=128, dtype=uint16, chunk=1 << 16, metaInterval=1.0):
+        self.name = name
+        self.width = width
+        self.dtype = zeros(0, dtype).dtype
+        self.chunk = chunk                  # frames added on every grow
+        self.metaInterval = metaInterval    # [s] between updates of name.json
+        self.nFrames = 0                    # frames recorded so far
+        self.nAlloc = 0                     # frames the files can hold
+        self.nextSeq = 0                    # seq of the next frame if not given
+        self.tMeta = 0
+        self.lock = threading.Lock()
+        self.fDat, self.fIdx, self.fMeta = _fileNames(name)
+        for f in (self.fDat, self.fIdx):
+            open(f, "wb").close()
+        self.dat = None
+        self.idx = None
+        self._grow(chunk)
+        self._writeMeta()
+
+    def _grow(self, nAlloc):
+        """ resize both files to nAlloc frames and map them again """
+        # No flush needed, the shared mapping is written back on unmap
+        self.dat = self.idx = None
+        frameBytes = self.width * self.dtype.itemsize
+        for f, n in ((self.fDat, frameBytes), (self.fIdx, INDEX_DTYPE.itemsize)):
+            with open(f, "r+b") as fd:
+                fd.truncate(nAlloc * n)
+        self.dat = memmap(self.fDat, self.dtype, "r+", shape=(nAlloc, self.width))
+        self.idx = memmap(self.fIdx, INDEX_DTYPE, "r+", shape=(nAlloc,))
+        self.nAlloc = nAlloc
+
+    def _flushMaps(self):
+        if self.dat is not None:
+            self.dat.flush()
+            self.idx.flush()
+
+    def _writeMeta(self):
+        """ atomically replace name.json """
+        tmp = self.fMeta + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({
+                "width": self.width,
+                "dtype": self.dtype.str,
+                "nFrames": self.nFrames
+            }, f)
+        os.replace(tmp, self.fMeta)
+        self.tMeta = time.time()
+
+    def push(self, frames, t=None, seq=None):
+        """
+        Append a (N, width) block of frames.
+        t: receive time, scalar for the whole block or (N,). Default: now
+        seq: sequence numbers (N,). Default: counting up from the last one
+        Returns the index of the first frame in the recording.
+        """
+        frames = atleast_2d(frames)
+        n = frames.shape[0]
+        if n == 0:
+            return self.nFrames
+        if t is None:
+            t = time.time()
+        if seq is None:
+            seq = self.nextSeq + arange(n)
+        with self.lock:
+            i0 = self.nFrames
+            if self.dat is None:
+                return i0   # Closed already
+            if i0 + n > self.nAlloc:
+                nChunks = (i0 + n - self.nAlloc + self.chunk - 1) // self.chunk
+                self._grow(self.nAlloc + nChunks * self.chunk)
+            self.dat[i0: i0 + n] = frames
+            self.idx["t"][i0: i0 + n] = t
+            self.idx["seq"][i0: i0 + n] = seq
+            self.nFrames = i0 + n
+            self.nextSeq = int(self.idx["seq"][i0 + n - 1]) + 1
+            if time.time() - self.tMeta >= self.metaInterval:
+                self._writeMeta()
+        return i0
+
+    def flush(self):
+        """ write everything to disk """
+        with self.lock:
+            self._flushMaps()
+            self._writeMeta()
+
+    def close(self):
+        """ flush and cut off the preallocated space """
+        with self.lock:
+            self._flushMaps()
+            self.dat = self.idx = None
+            self.nAlloc = 0
+            self._writeMeta()
+            frameBytes = self.width * self.dtype.itemsize
+            for f, n in ((self.fDat, frameBytes), (self.fIdx, INDEX_DTYPE.itemsize)):
+                with open(f, "r+b") as fd:
+                    fd.truncate(self.nFrames * n)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FrameReader(object):
+    """ random access to the frames of the recording `name` """
+
+    def __init__(self, name):
+        self.name = name
+        self.fDat, self.fIdx, self.fMeta = _fileNames(name)
+        self.refresh()
+
+    def refresh(self):
+        """ map the files again to see frames which were recorded since """
+        with open(self.fMeta) as f:
+            meta = json.load(f)
+        self.width = meta["width"]
+        self.dtype = dtype(meta["dtype"])
+        n = meta["nFrames"]
+        if n > 0:
+            self._dat = memmap(self.fDat, self.dtype, "r", shape=(n, self.width))
+            self._idx = memmap(self.fIdx, INDEX_DTYPE, "r", shape=(n,))
+        else:
+            self._dat = zeros((0, self.width), dtype=self.dtype)
+            self._idx = zeros(0, dtype=INDEX_DTYPE)
+        return n
+
+    @property
+    def frames(self):
+        """ all frames as (N, width) array, not loaded """
+        return self._dat
+
+    @property
+    def t(self):
+        """ host receive time of every frame [s] """
+        return self._idx["t"]
+
+    @property
+    def seq(self):
+        """ sequence number of every frame """
+        return self._idx["seq"]
+
+    def __len__(self):
+        return self._dat.shape[0]
+
+    def __getitem__(self, item):
+        return self._dat[item]
+
+    def atTime(self, t):
+        """ index of the first frame received at or after t """
+        return int(searchsorted(self.t, t))
+
+    def timeSlice(self, t0, t1):
+        """ frames received in [t0, t1) """
+        return self._dat[self.atTime(t0): self.atTime(t1)]
+
+    def bySeq(self, seq):
+        """ index of the frame with sequence number seq, -1 if not recorded """
+        i = int(searchsorted(self.seq, seq))
+        if i < len(self) and self.seq[i] == seq:
+            return i
+        return -1
+
+    def nMissing(self):
+        """ frames lost on the way, from gaps in the sequence numbers """
+        if len(self) == 0:
+            return 0
+        return int(self.seq[-1] - self.seq[0] + 1 - len(self))
+
+
+def main():
+    """ record frames from emulator.py or the hardware """
+    import argparse
+    from serial import Serial
+    from FrameDecoder import FrameDecoder
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("name", help="Recording name, without extension")
+    parser.add_argument("--tty_dump", default="/dev/ttyUSB2", help="UartMemoryDumper for data")
+    parser.add_argument("--br_dump", default=115200, type=int, help="UartMemoryDumper baudrate")
+    parser.add_argument("--seconds", default=10, type=float, help="Length of the recording")
+    parser.add_argument("--n_words", default=128, type=int, help="Words per frame, ccd_o_nPixels of the gateware")
+    args = parser.parse_args()
+    dec = FrameDecoder(args.n_words)
+    ser = Serial(args.tty_dump, args.br_dump)
+    with FrameRecorder(args.name, args.n_words) as rec:
+        tEnd = time.time() + args.seconds
+        while time.time() < tEnd:
+            frames = dec.read(ser)
+            n = frames.shape[0]
+            # Frames lost before this block count, this keeps seq gaps honest
+            rec.push(frames, seq=dec.nFrames + dec.nDropped - n + arange(n))
+    r = FrameReader(args.name)
+    print("{}: {} frames, {} missing, {:.1f} fps".format(
+        args.name, len(r), r.nMissing(), len(r) / (r.t[-1] - r.t[0] + 1e-9)
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""
+Frame loss and latency accounting from the frame headers of
+MemoryDumper(header=True), see HeaderLayout.py.
+
+  * drops: gaps in the sequence number. These are frames the FPGA completed
+    but which never made it into the application: corrupted on the link,
+    or replaced by a newer one in FrameBanks
+  * latency: from the moment the FPGA completed a frame to the moment it
+    reached a stage of the application. received() records "receive",
+    the applications add their own ("display", "audio") with latency()
+
+The FPGA timestamps count sys clock cycles, which have no common reference
+with the host clock (time.perf_counter). The offset between the two is
+taken from the fastest frame within the last `window` seconds, which is
+assumed to have needed tMin (its time on the wire). That also follows the
+drift of the crystal. So latencies are exact up to the jitter of the
+fastest frame.
+"""
+from numpy import *
+from collections import deque
+import threading
+import time
+from HeaderLayout import HEADER_LAYOUT
+
+
+class LatencyHistogram(object):
+    """ counts latencies in bins of binWidth [s], the last bin takes all above """
+
+    def __init__(self, binWidth=0.5e-3, maxLatency=2.0):
+        self.binWidth = binWidth
+        self.counts = zeros(int(ceil(maxLatency / binWidth)) + 1, dtype=int64)
+
+    def add(self, latencies):
+        i = clip(atleast_1d(latencies) / self.binWidth, 0, self.counts.size - 1).astype(int)
+        self.counts += bincount(i, minlength=self.counts.size)
+
+    @property
+    def n(self):
+        return int(self.counts.sum())
+
+    @property
+    def edges(self):
+        """ lower end of every bin [s] """
+        return arange(self.counts.size) * self.binWidth
+
+    def percentile(self, q):
+        """ upper end of the bin holding the q th percentile [s] """
+        c = cumsum(self.counts)
+        if c[-1] == 0:
+            return nan
+        return (searchsorted(c, q / 100 * c[-1]) + 1) * self.binWidth
+
+    def __str__(self):
+        return "n: {} p50: {:.1f} p99: {:.1f} max: {:.1f} ms".format(
+            self.n, *[self.percentile(q) * 1e3 for q in (50, 99, 100)]
+        )
+
+
+class FrameStats(object):
+    """ drop counts and latency histograms of a stream of frames """
+
+    def __init__(self, fclk=10e6, tMin=0.0, window=10.0, binWidth=0.5e-3, maxLatency=2.0):
+        """
+        fclk: sys clock of the FPGA [Hz]
+        tMin: shortest possible latency [s], e.g. the time to send a frame
+        window: the clock offset comes from the frames of the last window [s]
+        """
+        self.fclk = fclk
+        self.tMin = tMin
+        self.window = window
+        self.binWidth = binWidth
+        self.maxLatency = maxLatency
+        self.bits = dict(HEADER_LAYOUT)
+        self.last = {}          # last raw and unwrapped value of seq and time
+        self.offsets = deque()  # (host time, smallest host - device time) per block
+        self.hists = {}         # stage: LatencyHistogram
+        self.nFrames = 0        # received
+        self.nDropped = 0       # sequence numbers which did not show up
+        self.lock = threading.Lock()
+
+    def _unwrap(self, name, v):
+        """ undo the wrap around of a header field, continuing the last block """
+        prev, unwrapped = self.last.get(name, (v[0], v[0]))
+        d = diff(concatenate(([prev], v))) % (1 << self.bits[name])
+        res = unwrapped + cumsum(d)
+        self.last[name] = (v[-1], res[-1])
+        return res
+
+    def _add(self, stage, latencies):
+        if stage not in self.hists:
+            self.hists[stage] = LatencyHistogram(self.binWidth, self.maxLatency)
+        self.hists[stage].add(latencies)
+
+    def received(self, header, t=None):
+        """
+        header: FrameDecoder.header of the frames it just returned
+        t: when they were received, default: now
+        Returns the unwrapped sequence numbers (N,) and when the FPGA
+        completed each frame, on the host clock (N,). Pass the latter to
+        latency() further down the pipeline
+        """
+        seq, cycles = header["seq"], header["time"]
+        n = seq.size
+        if n == 0:
+            return zeros(0, dtype=int64), zeros(0)
+        if t is None:
+            t = time.perf_counter()
+        with self.lock:
+            prev = self.last.get("prevSeq")
+            seq = self._unwrap("seq", seq)
+            tDev = self._unwrap("time", cycles) / self.fclk
+            # Gaps within the block and to the last one
+            d = diff(seq if prev is None else concatenate(([prev], seq)))
+            self.nDropped += int(maximum(d - 1, 0).sum())
+            self.last["prevSeq"] = seq[-1]
+            self.nFrames += n
+            self.offsets.append((t, amin(t - tDev)))
+            while self.offsets[0][0] < t - self.window:
+                self.offsets.popleft()
+            offset = amin([o for _, o in self.offsets])
+            tDev = tDev + offset - self.tMin
+            self._add("receive", t - tDev)
+        return seq, tDev
+
+    def latency(self, stage, tDev, t=None):
+        """ frames completed at tDev (from received()) reached stage at t (default: now) """
+        if t is None:
+            t = time.perf_counter()
+        with self.lock:
+            self._add(stage, t - asarray(tDev))
+
+    def save(self, fName):
+        """ histograms of all stages to a .npz file, for plotting """
+        with self.lock:
+            dat = {s: h.counts for s, h in self.hists.items()}
+            savez(fName, binWidth=self.binWidth, nFrames=self.nFrames, nDropped=self.nDropped, **dat)
+
+    def __str__(self):
+        with self.lock:
+            return "frames: {} dropped: {}{}".format(self.nFrames, self.nDropped, "".join(
+                "\n  {}: {}".format(s, h) for s, h in self.hists.items()
+            ))
+
+
+def main():
+    """ self check with frames of known latency, sent through wrap arounds """
+    fclk = 10e6
+    # Frames lost within the first block count too
+    stats = FrameStats(fclk)
+    stats.received({"seq": array([5, 6, 8, 11]), "time": arange(4) * 1000, "tau": zeros(4)})
+    stats.received({"seq": array([13, 14]), "time": arange(4, 6) * 1000, "tau": zeros(2)})
+    assert stats.nDropped == 1 + 2 + 1, stats.nDropped
+    rnd = random.RandomState(0)
+    stats = FrameStats(fclk, tMin=1e-3)
+    period = 0.01
+    tHost0 = 1234.5
+    nFrames = 200000
+    isLost = rnd.rand(nFrames) < 0.01
+    truth = []
+    k = 0
+    while k < nFrames:
+        n = rnd.randint(1, 8)
+        idx = arange(k, int(minimum(k + n, nFrames)))
+        k += n
+        idx = idx[~isLost[idx]]
+        if idx.size == 0:
+            continue
+        # The last one of a block arrives 1 .. 3 ms after it was completed
+        tRecv = tHost0 + idx[-1] * period + 1e-3 + rnd.rand() * 2e-3
+        header = {
+            "seq": (idx + 60000) % (1 << 16),
+            "time": (around(idx * period * fclk).astype(int64) + 4000000000) % (1 << 32),
+            "tau": zeros(idx.size, dtype=int64)
+        }
+        seq, tDev = stats.received(header, tRecv)
+        assert array_equal(seq - seq[0], idx - idx[0])
+        stats.latency("display", tDev, tRecv + 0.02)
+        truth.append(tRecv + 0.02 - (tHost0 + idx * period))
+    print(stats)
+    iGood = flatnonzero(~isLost)
+    assert stats.nDropped == isLost[iGood[0]: iGood[-1]].sum()
+    for q in (50, 99):
+        err = stats.hists["display"].percentile(q) - percentile(hstack(truth), q)
+        assert abs(err) <= 2 * stats.binWidth, (q, err)
+
+
+if __name__ == '__main__':
+    main()
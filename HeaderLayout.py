@@ -0,0 +1,32 @@
+"""
+Frame header of MemoryDumper(header=True), shared by the gateware and the
+host side (FrameDecoder.parseHeader(), FrameStats).
+
+Sent before the pixels, every field split into words, least significant
+first.
+"""
+
+# (name, bits)
+HEADER_LAYOUT = [
+    ("seq", 16),        # counts completed frames
+    ("time", 32),       # sys clock cycles, free running
+    ("tau", 32),        # ccd_i_tau when the frame was complete
+]
+HEADER_BITS = sum(b for n, b in HEADER_LAYOUT)
+
+
+def headerWords(nBits=12):
+    """ (name, first word, number of words) of every header field """
+    res = []
+    i = 0
+    for name, b in HEADER_LAYOUT:
+        n = (b + nBits - 1) // nBits
+        res.append((name, i, n))
+        i += n
+    return res
+
+
+def headerLen(nBits=12):
+    """ words per header """
+    name, i, n = headerWords(nBits)[-1]
+    return i + n
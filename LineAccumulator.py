@@ -0,0 +1,233 @@
+
+# Sums N consecutive sensor lines and optionally bins adjacent pixels
+# Sits between the Tsl1401 pixel stream and the frame memory.
+# Every line is added into an internal accumulator (read-modify-write on
+# each pixel), only the result of the last one is written to the frame
+# memory, so the dumper sends 1 frame for every N sensor lines.
+# The sum is divided by 2**shift and saturated to the frame memory width.
+
+from migen import *
+from migen.fhdl.verilog import convert
+from litex.soc.interconnect.csr import *
+from Tsl1401 import Tsl1401
+from Adcs7476 import adc_model
+
+
+class LineAccumulator(Module, AutoCSR):
+    def __init__(self, mem, nPixels=128, inWidth=12, maxLinesLog2=8, maxBinLog2=3):
+        self.i_nLines = CSRStorage(maxLinesLog2 + 1, reset=1)  # Lines per frame
+        self.i_shift = CSRStorage(5)            # Output = sum >> shift
+        self.i_binLog2 = CSRStorage(bits_for(maxBinLog2))  # Sum 2**binLog2 pixels
+        # Pixel stream from the sensor
+        self.i_valid = Signal()
+        self.i_dat = Signal(inWidth)
+        self.i_pixel = Signal(max=nPixels)
+        self.i_eol = Signal()                   # With i_valid of the last pixel
+        # Write the stream unchanged: 1 line, no binning, no shift.
+        # For records of FeatureExtractor
+        self.i_bypass = Signal()
+        # Frame memory side
+        self.i_adrOffset = Signal(max=mem.depth)  # Where to put the frame in mem
+        self.o_eof = Signal()                   # Pulses when the last word is written
+        self.o_nWords = Signal(max=nPixels + 1)  # Words per output frame
+
+        ###
+
+        accWidth = inWidth + maxLinesLog2 + maxBinLog2
+        outWidth = mem.width
+        print("LineAccumulator: accWidth={} outWidth={}".format(accWidth, outWidth))
+        self.specials.acc = acc = Memory(accWidth, nPixels)
+        self.specials.rp = rp = acc.get_port()
+        self.specials.ap = ap = acc.get_port(write_capable=True)
+        self.specials.p = p = mem.get_port(write_capable=True)
+
+        binLog2 = Signal(bits_for(maxBinLog2))
+        shift = Signal(5)
+        binMask = Signal(maxBinLog2)
+        lineCnt = Signal(maxLinesLog2 + 1)
+        isLastLine = Signal()
+        # Stage 1, one cycle after i_valid: accumulator word has been read
+        valid1 = Signal()
+        dat1 = Signal(inWidth)
+        bin1 = Signal(max=nPixels)
+        isFresh1 = Signal()     # First pixel of this bin: ignore old value
+        isFinal1 = Signal()     # Last pixel of this bin in the last line
+        eol1 = Signal()
+        isLast1 = Signal()
+        sum1 = Signal(accWidth)
+        out1 = Signal(accWidth)
+
+        self.comb += [
+            If(~self.i_bypass,
+                binLog2.eq(self.i_binLog2.storage),
+                shift.eq(self.i_shift.storage)
+            ),
+            binMask.eq((1 << binLog2) - 1),
+            isLastLine.eq(self.i_bypass | (lineCnt + 1 >= self.i_nLines.storage)),
+            self.o_nWords.eq(nPixels >> binLog2),
+            rp.adr.eq(self.i_pixel >> binLog2),
+            sum1.eq(Mux(isFresh1, 0, rp.dat_r) + dat1),
+            out1.eq(sum1 >> shift),
+            ap.adr.eq(bin1),
+            ap.dat_w.eq(sum1),
+            ap.we.eq(valid1 & ~isFinal1),
+            p.adr.eq(self.i_adrOffset + bin1),
+            If(out1 >> outWidth,
+                p.dat_w.eq((1 << outWidth) - 1)
+            ).Else(
+                p.dat_w.eq(out1)
+            ),
+            p.we.eq(valid1 & isFinal1),
+            self.o_eof.eq(valid1 & eol1 & isLast1)
+        ]
+        self.sync += [
+            valid1.eq(self.i_valid),
+            If(self.i_valid,
+                dat1.eq(self.i_dat),
+                bin1.eq(self.i_pixel >> binLog2),
+                isFresh1.eq(((lineCnt == 0) | self.i_bypass) & ((self.i_pixel & binMask) == 0)),
+                isFinal1.eq(isLastLine & ((self.i_pixel & binMask) == binMask)),
+                eol1.eq(self.i_eol),
+                isLast1.eq(isLastLine),
+                If(self.i_eol,
+                    If(isLastLine,
+                        lineCnt.eq(0)
+                    ).Else(
+                        lineCnt.eq(lineCnt + 1)
+                    )
+                )
+            )
+        ]
+
+
+def dut_tb(dut, nLines, shift, binLog2, nPixels, lines, wordGap=17):
+    ''' sends lines of pixels, one every wordGap cycles like the ADC '''
+    yield dut.i_nLines.storage.eq(nLines)
+    yield dut.i_shift.storage.eq(shift)
+    yield dut.i_binLog2.storage.eq(binLog2)
+    yield
+    for line in lines:
+        for i, val in enumerate(line):
+            yield dut.i_dat.eq(val)
+            yield dut.i_pixel.eq(i)
+            yield dut.i_eol.eq(i == nPixels - 1)
+            yield dut.i_valid.eq(1)
+            yield
+            yield dut.i_valid.eq(0)
+            for j in range(wordGap - 1):
+                yield
+
+
+@passive
+def eof_tb(dut, mem, frames):
+    ''' copies the frame memory on every o_eof pulse '''
+    while True:
+        if (yield dut.o_eof):
+            yield
+            frame = []
+            for i in range(mem.depth):
+                frame.append((yield mem[i]))
+            frames.append(frame)
+        yield
+
+
+def getDut(nPixels):
+    mem = Memory(16, nPixels)
+    dut = LineAccumulator(mem, nPixels)
+    dut.specials += mem
+    return dut, mem
+
+
+class SensorTestbench(Module):
+    ''' Tsl1401 pixel stream into LineAccumulator, wired like target_cmodA7 '''
+    def __init__(self):
+        # The ADC model needs a divided SCLK
+        self.submodules.ccd = ccd = Tsl1401(adcDiv=2)
+        self.specials.mem = mem = Memory(16, 128)
+        self.submodules.acc = acc = LineAccumulator(mem, 128)
+        self.comb += [
+            acc.i_valid.eq(ccd.o_valid),
+            acc.i_dat.eq(ccd.o_dat),
+            acc.i_pixel.eq(ccd.o_pixel),
+            acc.i_eol.eq(ccd.o_eof)
+        ]
+
+
+def expected(lines, nLines, shift, binLog2, nPixels):
+    ''' frames the accumulator must write for lines (list of pixel lists) '''
+    frames = []
+    for k in range(len(lines) // nLines):
+        ls = lines[k * nLines: (k + 1) * nLines]
+        frames.append([
+            min(sum(sum(l[b << binLog2: (b + 1) << binLog2]) for l in ls) >> shift, 0xFFFF)
+            for b in range(nPixels >> binLog2)
+        ])
+    return frames
+
+
+def check(nLines, shift, binLog2, nPixels=16, nFrames=3):
+    dut, mem = getDut(nPixels)
+    lines = [
+        [(37 * k + 113 * i) % 4096 for i in range(nPixels)]
+        for k in range(nLines * nFrames)
+    ]
+    frames = []
+    run_simulation(dut, [
+        dut_tb(dut, nLines, shift, binLog2, nPixels, lines),
+        eof_tb(dut, mem, frames)
+    ])
+    assert len(frames) == nFrames, "got {} frames".format(len(frames))
+    nBins = nPixels >> binLog2
+    for k, (f, want) in enumerate(zip(frames, expected(lines, nLines, shift, binLog2, nPixels))):
+        assert f[:nBins] == want, "frame {}: {} != {}".format(k, f[:nBins], want)
+    print("nLines: {} shift: {} binLog2: {} frames: {} ok".format(
+        nLines, shift, binLog2, len(frames)
+    ))
+
+
+def check_sensor(nLines, shift, binLog2, nFrames=2):
+    '''
+    like check(), but the pixel stream and its end of line come from the
+    actual sensor core, converting known values
+    '''
+    dut = SensorTestbench()
+    values = [(37 * k + 5) % 4096 for k in range((nLines * nFrames + 1) * 128)]
+    frames = []
+
+    def tb():
+        yield dut.acc.i_nLines.storage.eq(nLines)
+        yield dut.acc.i_shift.storage.eq(shift)
+        yield dut.acc.i_binLog2.storage.eq(binLog2)
+        yield dut.ccd.i_tau.storage.eq(0)
+        yield dut.ccd.i_trig.eq(1)
+        while len(frames) < nFrames:
+            yield
+
+    run_simulation(dut, [
+        tb(), eof_tb(dut.acc, dut.mem, frames), adc_model(dut.ccd.adc, list(values))
+    ])
+    lines = [values[k * 128: (k + 1) * 128] for k in range(nLines * nFrames)]
+    nBins = 128 >> binLog2
+    for k, (f, want) in enumerate(zip(frames, expected(lines, nLines, shift, binLog2, 128))):
+        assert f[:nBins] == want, "frame {}: {} != {}".format(k, f[nBins - 4: nBins], want[-4:])
+    print("Tsl1401 -> nLines: {} shift: {} binLog2: {} frames: {} ok".format(
+        nLines, shift, binLog2, len(frames)
+    ))
+
+
+def main():
+    fName = __file__[:-3]
+    dut, mem = getDut(128)
+    convert(dut, ios={
+        dut.i_valid, dut.i_dat, dut.i_pixel, dut.i_eol, dut.o_eof
+    }).write(fName + ".v")
+    check(1, 0, 0)      # Pass through
+    check(4, 2, 0)      # Average of 4 lines
+    check(3, 0, 2)      # Sum of 3 lines, 4 pixel bins
+    check(32, 0, 1)     # Saturates
+    check_sensor(1, 0, 0)
+    check_sensor(2, 0, 1)   # The last bin needs the last pixel of the line
+
+
+if __name__ == '__main__':
+    main()
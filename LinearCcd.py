@@ -0,0 +1,350 @@
+from functools import reduce
+from operator import or_
+from migen import *
+from migen.fhdl.verilog import convert
+from litex.build.generic_platform import *
+from litex.soc.interconnect.csr import *
+from Adcs7476 import Adcs7476, adc_model
+from Sensors import getSensor, nElements, SENSORS
+
+# Cmod A7 DIP pins of the sensor outputs
+CMOD_PINS = {"CLK": "M3", "SI": "L3", "SH": "L3", "ICG": "K3", "RS": "C15", "CLKn": "H1"}
+
+
+class LinearCcd(Module, AutoCSR):
+    '''
+    Driver for line sensors, one element is read per ADC conversion.
+    A line starts with the shift sequence (ICG, SH / SI), then all
+    elements are clocked out and converted. Only the effective pixels go
+    out on the pixel stream, dummy elements are dropped.
+    Sensors with several analog outputs (colours) get one ADC per output,
+    converting in lockstep. The words of a pixel go out on the stream in
+    the following cycles, o_pixel puts them in the frame as
+    interleaved (i_planar = 0, RGBRGB..) or planar (i_planar = 1, RR..GG..BB..)
+    sensor: name in Sensors.SENSORS or a dict with the same keys
+    mem: pixels are written there. When None, only the pixel stream
+    (o_valid, o_dat, o_pixel) is provided, e.g. for LineAccumulator
+    adcDiv, adcQuiet: see Adcs7476
+    nChannels: ADCs to read, default: all outputs of the sensor
+    '''
+    def __init__(self, sensor="tsl1401", mem=None, adcDiv=1, adcQuiet=1, nChannels=None):
+        s = getSensor(sensor)
+        self.sensor = s
+        self.nPixels = nPixels = s["nPixels"]
+        self.nChannels = nChannels = nChannels or s.get("nChannels", 1)
+        self.nWords = nWords = nPixels * nChannels   # per frame
+        nDummy = s["nDummy"]
+        nElem = nElements(s)
+        nShift = s["icgLead"] + s["shCycles"] + s["icgLag"]
+        assert nShift >= 2, "shift sequence must be at least 2 cycles"
+        # Cycles between 2 ADC conversions, one element each
+        P = (16 + adcQuiet) * adcDiv
+        # Element clock pulses, in cycles after the previous conversion
+        clkStarts = [s["clkDelay"] + j * P // s["clkPerElement"] for j in range(s["clkPerElement"])]
+        assert clkStarts[-1] + s["clkHigh"] <= P, "element clock does not fit in {} cycles".format(P)
+        assert nChannels <= P, "{} channels do not fit in {} cycles".format(nChannels, P)
+
+        self.i_tau = CSRStorage(32, reset=128)  # Integration cycles
+        # 0: wait i_tau after readout. 1: integrate during readout,
+        # i_tau counts from element intStart (where the sensor starts to
+        # integrate) to the next shift pulse. Line period = max(readout, i_tau)
+        self.i_overlap = CSRStorage(1)
+        self.o_linePeriod = CSRStatus(32)       # Cycles between the last 2 shift pulses
+        self.o_nPixels = CSRStatus(bits_for(nPixels), reset=nPixels)  # Pixels per line
+        self.o_nChannels = CSRStatus(bits_for(nChannels), reset=nChannels)  # Words per pixel
+        if nChannels > 1:
+            self.i_planar = CSRStorage(1)       # Frame layout, see above
+        self.i_trig = Signal()                  # Trigger an acquisition
+        self.o_CLK = Signal()                   # Element clock (CLK, phiM, phi1)
+        self.o_CLKn = Signal()                  # Inverted element clock (phi2)
+        self.o_SH = Signal()                    # Shift pulse (SI, SH)
+        self.o_ICG = Signal()                   # Integration clear gate, low active
+        self.o_RS = Signal()                    # Reset gate of the output amplifier
+        self.o_eof = Signal()                   # Pulses when the last pixel is written
+        # Pixel stream
+        self.o_valid = Signal()                 # Single cycle pulse when o_dat is valid
+        self.o_dat = Signal(12)
+        self.o_pixel = Signal(max=nWords)       # Index of the word in the frame
+
+        ###
+
+        tauCnt = Signal(32)
+        isIntegrating = Signal()
+        isLastClk = Signal()    # Last element clock of the readout has been sent
+        isClkDone = Signal()    # and is over
+        lpCnt = Signal(32)
+        trig0 = Signal()
+        shCnt = Signal(max=nShift)  # Cycle of the shift sequence, after the first
+        shPos = Signal(max=nShift)  # Cycle of the shift sequence
+        isShifting = Signal()
+        isFirstClk = Signal()   # Last cycle of the shift sequence
+        # Cycles since the last conversion, saturates at P
+        phase = Signal(max=P + 1, reset=P)
+        ph = Signal(max=P + 1)
+        self.submodules.adc = Adcs7476(adcDiv, adcQuiet, nChannels)
+        # All channels of a pixel, from the ADCs
+        pxValid = Signal()
+        pxIndex = Signal(max=nPixels)
+        pxLast = Signal()
+
+        # 0: idle or shifting, 1 .. nElem: converting element n - 1
+        elemIndex = Signal(max=nElem + 1)
+        # With a divided SCLK, keep CLK high until the ADC samples again
+        clkHold = Signal()
+        if adcDiv > 1:
+            self.sync += If(self.adc.o_valid,
+                clkHold.eq(1)
+            ).Elif(self.adc.o_sampled | ~self.adc.i_trig,
+                clkHold.eq(0)
+            )
+        if mem is not None:
+            self.i_adrOffset = Signal(max=mem.depth)  # Where to put the frame in mem
+            self.specials.p = p = mem.get_port(write_capable=True)
+            self.comb += [
+                p.adr.eq(self.i_adrOffset + self.o_pixel),
+                p.dat_w.eq(self.o_dat),
+                p.we.eq(self.o_valid)
+            ]
+
+        def inWindows(width):
+            return reduce(or_, [(ph >= a) & (ph < a + width) for a in clkStarts])
+
+        self.comb += [
+            pxValid.eq(self.adc.o_valid & (elemIndex > nDummy) & (elemIndex <= nDummy + nPixels)),
+            pxIndex.eq(elemIndex - 1 - nDummy),
+            pxLast.eq(elemIndex == nDummy + nPixels),
+            trig0.eq(self.i_trig & (elemIndex == 0) & (shCnt == 0)),
+            isShifting.eq(trig0 | (shCnt != 0)),
+            shPos.eq(Mux(trig0, 0, shCnt)),
+            isFirstClk.eq(isShifting & (shPos == nShift - 1)),
+            self.o_SH.eq(isShifting & (shPos >= s["icgLead"]) & (shPos < s["icgLead"] + s["shCycles"])),
+            self.o_ICG.eq(~isShifting if s["icgLead"] + s["icgLag"] > 0 else 1),
+            # Element clock restarts with the first one and with every conversion
+            If(isFirstClk,
+                ph.eq(clkStarts[0])
+            ).Elif(self.adc.o_valid,
+                ph.eq(0)
+            ).Else(
+                ph.eq(phase)
+            ),
+            self.o_CLK.eq(inWindows(s["clkHigh"]) | clkHold),
+            self.o_CLKn.eq(~self.o_CLK),
+            self.o_RS.eq(inWindows(s["rsCycles"]) if s["rsCycles"] else 0),
+            isClkDone.eq(ph >= clkStarts[-1] + max(s["clkHigh"], s["rsCycles"])),
+            # With a divided SCLK, the ADC starts the next conversion after
+            # elemIndex moved on, so the last one starts at nElem
+            self.adc.i_trig.eq((elemIndex > 0) & (
+                (elemIndex < nElem) if adcDiv == 1 else ((elemIndex <= nElem) & ~isLastClk)
+            )),
+            If(self.i_overlap.storage,
+                isIntegrating.eq(elemIndex >= s["intStart"])
+            ).Else(
+                isIntegrating.eq(elemIndex == nElem)
+            )
+        ]
+        self.sync += [
+            If(ph < P,
+                phase.eq(ph + 1)
+            ),
+            If(isShifting,
+                If(shPos == nShift - 1,
+                    shCnt.eq(0)
+                ).Else(
+                    shCnt.eq(shPos + 1)
+                )
+            ),
+            If(trig0,
+                tauCnt.eq(0)
+            ).Elif(isIntegrating & (tauCnt < self.i_tau.storage),
+                tauCnt.eq(tauCnt + 1)
+            ),
+            lpCnt.eq(lpCnt + 1),
+            If(trig0,
+                self.o_linePeriod.status.eq(lpCnt),
+                lpCnt.eq(1)
+            ),
+            Case(elemIndex, {
+                0:
+                    # The first element clock comes with the last cycle
+                    # of the shift sequence
+                    If(isShifting & (shPos == nShift - 2),
+                        elemIndex.eq(1)
+                    ),
+                "default":
+                    If(self.adc.o_valid,
+                        elemIndex.eq(elemIndex + 1)
+                    ),
+                nElem: [
+                    If(self.adc.o_valid,
+                        isLastClk.eq(1)
+                    ),
+                    If((tauCnt >= self.i_tau.storage) & isLastClk & isClkDone,
+                        isLastClk.eq(0),
+                        elemIndex.eq(0)
+                    )
+                ]
+            })
+        ]
+
+        if nChannels == 1:
+            self.comb += [
+                self.o_valid.eq(pxValid),
+                self.o_dat.eq(self.adc.o_dat),
+                self.o_pixel.eq(pxIndex),
+                self.o_eof.eq(pxValid & pxLast)
+            ]
+            return
+
+        # One word per cycle, until the next conversion
+        dats = [Signal(12, name="dat{}".format(i)) for i in range(nChannels)]
+        pixel = Signal(max=nPixels)
+        isLast = Signal()
+        isSending = Signal()
+        chIdx = Signal(max=nChannels)
+        self.sync += [
+            If(pxValid,
+                [d.eq(a) for d, a in zip(dats, self.adc.o_dats)],
+                pixel.eq(pxIndex),
+                isLast.eq(pxLast),
+                isSending.eq(1),
+                chIdx.eq(0)
+            ).Elif(isSending,
+                chIdx.eq(chIdx + 1),
+                If(chIdx == nChannels - 1,
+                    isSending.eq(0)
+                )
+            )
+        ]
+        self.comb += [
+            self.o_valid.eq(isSending),
+            self.o_dat.eq(Array(dats)[chIdx]),
+            If(self.i_planar.storage,
+                self.o_pixel.eq(chIdx * nPixels + pixel)
+            ).Else(
+                self.o_pixel.eq(pixel * nChannels + chIdx)
+            ),
+            self.o_eof.eq(isSending & isLast & (chIdx == nChannels - 1))
+        ]
+
+    def connectToCmod(self, platform):
+        self.adc.connectToPmod(platform)
+        sigs = {
+            "CLK": self.o_CLK, "CLKn": self.o_CLKn, "SI": self.o_SH,
+            "SH": self.o_SH, "ICG": self.o_ICG, "RS": self.o_RS
+        }
+        outs = self.sensor["outputs"]
+        platform.add_extension([("CCD", 0, *[
+            Subsignal(n, Pins(CMOD_PINS[n]), IOStandard("LVCMOS33")) for n in outs
+        ])])
+        r = platform.request("CCD")
+        self.comb += [getattr(r, n).eq(sigs[n]) for n in outs]
+
+
+@passive
+def line_tb(dut, res):
+    ''' records the cycles of the control edges and the pixel stream '''
+    prev = {}
+    i = 0
+    while True:
+        for n in ("SH", "CLK", "ICG", "RS"):
+            v = (yield getattr(dut, "o_" + n))
+            if v and not prev.get(n, v):
+                res[n].append(i)
+            if n == "ICG" and not v and prev.get(n, 1):
+                res["ICG_fall"].append(i)
+            prev[n] = v
+        if (yield dut.o_valid):
+            res["pixel"].append((yield dut.o_pixel))
+            res["dat"].append((yield dut.o_dat))
+            if (yield dut.o_eof):
+                res["eof"].append(len(res["pixel"]))
+        i += 1
+        yield
+
+
+def check(sensor, nLines=2, **kwargs):
+    '''
+    free running sensor with a reduced number of pixels (to keep the
+    simulation short). Checks the shift sequence, the number of element
+    clocks and that only the effective pixels come out
+    '''
+    s = dict(getSensor(sensor), **kwargs)
+    dut = LinearCcd(s)
+    res = dict(SH=[], CLK=[], ICG=[], ICG_fall=[], RS=[], pixel=[], dat=[], eof=[])
+
+    def tb():
+        yield dut.i_tau.storage.eq(0)
+        yield dut.i_trig.eq(1)
+        while len(res["SH"]) <= nLines:
+            yield
+
+    run_simulation(dut, [tb(), line_tb(dut, res)])
+    SH, CLK = res["SH"], res["CLK"]
+    nPixels, nWords = dut.nPixels, dut.nWords
+    # Interleaved channels: in order
+    assert res["pixel"] == list(range(nWords)) * (len(res["pixel"]) // nWords), res["pixel"]
+    assert res["eof"] == [nWords * (k + 1) for k in range(len(res["eof"]))], res["eof"]
+    clks = [[c for c in CLK if a < c < b] for a, b in zip(SH, SH[1:])]
+    nClk = s["clkPerElement"] * (nElements(s) + 1)
+    # The first one comes with the last cycle of the shift sequence
+    nShift = s["icgLead"] + s["shCycles"] + s["icgLag"]
+    assert all(len(c) == nClk for c in clks), ([len(c) for c in clks], nClk)
+    assert all(c[0] == a + nShift - 1 - s["icgLead"] for c, a in zip(clks, SH)), (clks[0][:3], SH)
+    if s["icgLead"] + s["icgLag"] > 0:
+        assert [a - f for a, f in zip(SH, res["ICG_fall"])] == [s["icgLead"]] * len(SH)
+        assert [r - a for a, r in zip(SH, res["ICG"])] == [s["shCycles"] + s["icgLag"]] * len(res["ICG"])
+    if s["rsCycles"]:
+        assert len(res["RS"]) == len(CLK), (len(res["RS"]), len(CLK))
+    print("{}: {} pixels, {} elements, {} clocks / line, line period: {} ok".format(
+        sensor, nPixels, nElements(s), nClk, SH[-1] - SH[-2]
+    ))
+
+
+def check_channels(sensor, planar, nLines=2, **kwargs):
+    '''
+    every ADC converts its own values, these must end up at the right
+    place in the interleaved or planar frame. With a divided SCLK, which
+    the ADC model needs
+    '''
+    s = dict(getSensor(sensor), **kwargs)
+    dut = LinearCcd(s, adcDiv=2)
+    nPixels, nCh, nElem = dut.nPixels, dut.nChannels, nElements(s)
+    nConv = (nLines + 1) * nElem
+    values = [[(k * 37 + c * 1000) & 0xFFF for k in range(nConv)] for c in range(nCh)]
+    res = dict(SH=[], CLK=[], ICG=[], ICG_fall=[], RS=[], pixel=[], dat=[], eof=[])
+
+    def tb():
+        yield dut.i_planar.storage.eq(planar)
+        yield dut.i_tau.storage.eq(0)
+        yield dut.i_trig.eq(1)
+        while len(res["eof"]) < nLines:
+            yield
+
+    run_simulation(dut, [tb(), line_tb(dut, res)] + [
+        adc_model(dut.adc, list(v), c) for c, v in enumerate(values)
+    ])
+    for k in range(nLines):
+        frame = [None] * dut.nWords
+        for i in range(k * dut.nWords, (k + 1) * dut.nWords):
+            frame[res["pixel"][i]] = res["dat"][i]
+        for c in range(nCh):
+            want = values[c][k * nElem + s["nDummy"]:][:nPixels]
+            got = frame[c * nPixels:][:nPixels] if planar else frame[c::nCh]
+            assert got == want, (k, c, got, want)
+    print("{}: {} channels, planar: {} ok".format(sensor, nCh, planar))
+
+
+def main():
+    fName = __file__[:-3]
+    dut = LinearCcd("tcd1254")
+    convert(dut, ios={
+        dut.i_trig, dut.o_CLK, dut.o_CLKn, dut.o_SH, dut.o_ICG, dut.o_RS
+    }).write(fName + ".v")
+    for name in SENSORS:
+        check(name, nPixels=16)
+    for planar in (0, 1):
+        check_channels("tcd2964", planar, nPixels=8)
+
+
+if __name__ == '__main__':
+    main()
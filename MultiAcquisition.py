@@ -0,0 +1,326 @@
+"""
+Reads the frame streams of several CCD heads at once and merges them.
+
+Every head (CmodA7 + TSL1401) has its own UartMemoryDumper port. All ports
+are served from one asyncio event loop in one thread: the file descriptors
+are watched with loop.add_reader(), incoming bytes are only collected
+there. Every `period` seconds each port's bytes are decoded in one bulk
+FrameDecoder call, then the frames of all ports are lined up into merged
+sets of one frame per head, keyed by
+
+  * "seq": the frame sequence number, counted on the host from the decoder's
+    frame and drop counters. Good when all heads run from the same trigger
+  * "time": the host receive time. Frames which arrived in one block are
+    spread back in time by the measured frame period of the port. A set
+    holds the last frame each port received up to the newest frame in it,
+    when they are less than `tol` seconds apart
+
+Per port, rate (frames / s), lag (age of the oldest frame waiting to be
+merged) and drops are tracked.
+
+Example, with 3 emulators:
+    python MultiAcquisition.py /dev/pts/1 /dev/pts/3 /dev/pts/5 --key time
+"""
+import argparse
+import asyncio
+import collections
+import time
+from numpy import *
+from serial import Serial
+from FrameDecoder import FrameDecoder
+
+
+class Port(object):
+    """ one UartMemoryDumper port and its queue of decoded frames """
+
+    def __init__(self, name, baudrate=115200, dec=None):
+        self.name = name
+        self.ser = Serial(name, baudrate, timeout=0)
+        self.dec = dec if dec else FrameDecoder()
+        self.raw = bytearray()      # received, not decoded yet
+        self.tRecv = 0              # host time of the last received bytes
+        # Decoded blocks waiting to be merged: (t (N,), seq (N,), frames)
+        self.blocks = collections.deque()
+        self.iHead = 0              # frames of blocks[0] which were used
+        self.fd = self.ser.fileno()
+        self.period = 0             # frame period estimate [s]
+        self.tLast = None           # receive time of the last decoded block
+        self.nLast = 0              # frames counted at tLast
+        self.rate = 0               # [frames / s]
+        self.tRef = None            # frame time model: t(seqRef) = tRef
+        self.seqRef = 0
+        self.nMerged = 0            # frames which went into a merged set
+        self.nDiscarded = 0         # frames without partners in other ports
+
+    def onReadable(self):
+        """ event loop callback, only collects the bytes """
+        self.raw += self.ser.read(self.ser.in_waiting or 1)
+        self.tRecv = time.time()
+
+    def decode(self):
+        """ bulk decode everything collected since the last call """
+        if not self.raw:
+            return 0
+        dat = bytes(self.raw)
+        self.raw.clear()
+        frames = self.dec.decode(dat)
+        n = frames.shape[0]
+        # Frame rate from the decoder counters, averaged over >= 0.5 s
+        nTotal = self.dec.nFrames + self.dec.nDropped
+        if self.tLast is None:
+            self.tLast, self.nLast = self.tRecv, nTotal
+        elif self.tRecv - self.tLast >= 0.5:
+            self.rate = (nTotal - self.nLast) / (self.tRecv - self.tLast)
+            self.tLast, self.nLast = self.tRecv, nTotal
+            self.period = 1 / self.rate if self.rate > 0 else 0
+        if n > 0:
+            seq = nTotal - n + arange(n)
+            self.blocks.append((self._frameTimes(seq), seq, frames))
+        return n
+
+    def _frameTimes(self, seq):
+        """
+        receive times of a block of frames. Follows the earliest arrivals
+        at once and late ones only slowly, as OS and USB delays only ever
+        make them late
+        """
+        s = int(seq[-1])
+        if self.tRef is None or self.period <= 0:
+            self.tRef = self.tRecv
+        else:
+            tPred = self.tRef + (s - self.seqRef) * self.period
+            if self.tRecv < tPred:
+                self.tRef = self.tRecv
+            else:
+                self.tRef = tPred + (self.tRecv - tPred) * 0.01
+        self.seqRef = s
+        return self.tRef - (s - seq) * self.period
+
+    def nWaiting(self):
+        return sum([b[1].size for b in self.blocks]) - self.iHead
+
+    def head(self):
+        """ (t, seq) of the oldest waiting frame, None if there is none """
+        if not self.blocks:
+            return None
+        t, seq, _ = self.blocks[0]
+        return t[self.iHead], seq[self.iHead]
+
+    def nextTime(self):
+        """ t of the 2nd oldest waiting frame, None if there is none """
+        if not self.blocks:
+            return None
+        t = self.blocks[0][0]
+        if self.iHead + 1 < t.size:
+            return t[self.iHead + 1]
+        if len(self.blocks) > 1:
+            return self.blocks[1][0][0]
+        return None
+
+    def pop(self):
+        """ remove the oldest waiting frame and return it """
+        t, seq, frames = self.blocks[0]
+        fr = frames[self.iHead]
+        self.iHead += 1
+        if self.iHead >= seq.size:
+            self.blocks.popleft()
+            self.iHead = 0
+        return fr
+
+    def lag(self, now):
+        """ age of the oldest waiting frame [s] """
+        h = self.head()
+        return now - h[0] if h else 0
+
+    def close(self):
+        self.ser.close()
+
+
+class MultiAcquisition(object):
+    """ merges the frames of several ports into (nPorts, nWords) sets """
+
+    def __init__(self, ports, key="seq", tol=None, period=0.01, maxWait=1.0):
+        if not ports:
+            raise ValueError("need at least one port")
+        self.ports = ports
+        self.key = key          # "seq" or "time"
+        self.tol = tol          # [s], for key="time". Default: 1 frame period
+        self.period = period    # [s] between bulk decodes
+        self.maxWait = maxWait  # [s] give up on a set after this
+        self.nSets = 0
+        self.sets = asyncio.Queue()
+
+    def _isComplete(self):
+        """ every port has a frame waiting """
+        for p in self.ports:
+            if not p.blocks:
+                return False
+        return True
+
+    def _mergeSeq(self):
+        """ sets of frames with the same sequence number """
+        out = []
+        while self._isComplete():
+            heads = [p.head()[1] for p in self.ports]
+            sMax = int(amax(heads))
+            if all([h == sMax for h in heads]):
+                t = amax([p.head()[0] for p in self.ports])
+                out.append((t, sMax, array([p.pop() for p in self.ports])))
+                for p in self.ports:
+                    p.nMerged += 1
+                continue
+            # Missing in some port, drop the older ones
+            for p, h in zip(self.ports, heads):
+                if h < sMax:
+                    p.pop()
+                    p.nDiscarded += 1
+        return out
+
+    def _mergeTime(self):
+        """
+        for the newest head time tRef, the last frame every port received
+        up to tRef. Waits until each port has a frame after tRef, so it
+        is known that there is no closer one
+        """
+        out = []
+        tol = self.tol
+        if tol is None:
+            # Wait for the frame period estimates
+            tol = amax([p.period for p in self.ports])
+            if amin([p.period for p in self.ports]) <= 0:
+                return out
+        while self._isComplete():
+            heads = [p.head()[0] for p in self.ports]
+            tRef = amax(heads)
+            # Skip frames which have a newer one up to tRef
+            isPopped = False
+            for p in self.ports:
+                tNext = p.nextTime()
+                if tNext is not None and tNext <= tRef:
+                    p.pop()
+                    p.nDiscarded += 1
+                    isPopped = True
+            if isPopped:
+                continue
+            # A port without a frame after tRef might still get a closer one
+            if any([p.nextTime() is None and h < tRef for p, h in zip(self.ports, heads)]):
+                break
+            if tRef - amin(heads) <= tol:
+                out.append((tRef, self.nSets + len(out), array([p.pop() for p in self.ports])))
+                for p in self.ports:
+                    p.nMerged += 1
+            else:
+                # Nothing close to the oldest one
+                p = self.ports[argmin(heads)]
+                p.pop()
+                p.nDiscarded += 1
+        return out
+
+    def _expire(self, now):
+        """ a dead port must not hold back the others forever """
+        for p in self.ports:
+            while p.blocks and p.lag(now) > self.maxWait:
+                p.pop()
+                p.nDiscarded += 1
+
+    def step(self):
+        """ bulk decode all ports and merge, returns the new sets """
+        for p in self.ports:
+            p.decode()
+        if self.key == "seq":
+            out = self._mergeSeq()
+        else:
+            out = self._mergeTime()
+        self._expire(time.time())
+        self.nSets += len(out)
+        return out
+
+    async def run(self):
+        """ read all ports until cancelled, merged sets go to self.sets """
+        loop = asyncio.get_running_loop()
+        for p in self.ports:
+            loop.add_reader(p.fd, p.onReadable)
+        try:
+            while True:
+                await asyncio.sleep(self.period)
+                for s in self.step():
+                    self.sets.put_nowait(s)
+        except Exception as e:
+            # Don't leave the consumer waiting forever
+            self.sets.put_nowait(e)
+            raise
+        finally:
+            for p in self.ports:
+                loop.remove_reader(p.fd)
+
+    async def __aiter__(self):
+        """ merged sets (t, seq, frames (nPorts, nWords)) as they come """
+        while True:
+            s = await self.sets.get()
+            if isinstance(s, Exception):
+                raise s
+            yield s
+
+    def metrics(self, now=None):
+        """ per port statistics """
+        if now is None:
+            now = time.time()
+        return [{
+            "port": p.name,
+            "rate": float(around(p.rate, 1)),
+            "lag": float(around(p.lag(now), 4)),
+            "waiting": int(p.nWaiting()),
+            "merged": p.nMerged,
+            "discarded": p.nDiscarded,
+            "dropped": p.dec.nDropped
+        } for p in self.ports]
+
+
+async def printSets(acq, seconds):
+    """ consume merged sets and print the metrics once a second """
+    tEnd = time.time() + seconds
+    tPrint = time.time() + 1
+    nSets = 0
+    async for t, seq, frames in acq:
+        nSets += 1
+        if t >= tPrint:
+            print("sets: {} ({} / s) shape: {}".format(acq.nSets, nSets, frames.shape))
+            for m in acq.metrics():
+                print("  ", m)
+            nSets = 0
+            tPrint += 1
+        if t >= tEnd:
+            break
+
+
+async def amain(args):
+    ports = [Port(name, args.br_dump, FrameDecoder(args.n_words)) for name in args.tty_dump]
+    acq = MultiAcquisition(ports, args.key, args.tol, args.period)
+    task = asyncio.create_task(acq.run())
+    try:
+        await printSets(acq, args.seconds)
+    finally:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        for p in ports:
+            p.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("tty_dump", nargs="+", help="UartMemoryDumper ports, one per head")
+    parser.add_argument("--br_dump", default=115200, type=int, help="UartMemoryDumper baudrate")
+    parser.add_argument("--n_words", default=128, type=int, help="Words per frame, ccd_o_nPixels of the gateware")
+    parser.add_argument("--key", default="seq", choices=["seq", "time"], help="Merge frames by sequence number or receive time")
+    parser.add_argument("--tol", type=float, help="Max. time difference within a set [s]. Default: 1 frame period")
+    parser.add_argument("--period", default=0.01, type=float, help="Time between bulk decodes [s]")
+    parser.add_argument("--seconds", default=10, type=float, help="Stop after this time")
+    args = parser.parse_args()
+    asyncio.run(amain(args))
+
+
+if __name__ == '__main__':
+    main()
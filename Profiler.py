@@ -0,0 +1,229 @@
+"""
+Per-stage timing and counters for the host pipelines.
+
+    prof = Profiler(enabled=True, period=1.0, fName="prof.jsonl")
+    with prof.stage("decode"):
+        ...
+    prof.count("underrun")
+    prof.gauge("backlog", ser.in_waiting)
+
+Disabled (the default), stage() hands out a shared do-nothing context and
+count() / gauge() return right away, so the calls can stay in the hot loops.
+
+Enabled, every `period` seconds a summary is printed: per stage the number
+of calls, mean, 99th percentile and max duration and the share of the wall
+time it took (> 100 % for a stage running in several threads), the
+counters and the largest value of each gauge. The same goes as one JSON
+record per line to fName. close() adds the totals since start.
+
+A stage times one thread at a time, don't nest it in itself.
+"""
+from numpy import *
+import threading
+import json
+import time
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NULL_STAGE = _NullStage()
+
+
+class _Stage(object):
+    """ collects the durations of the with blocks [s] """
+    __slots__ = ("times", "t0", "n", "total", "max")
+
+    def __init__(self):
+        self.times = []     # of the current period
+        self.t0 = 0.0
+        self.n = 0          # since start
+        self.total = 0.0
+        self.max = 0.0
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.times.append(time.perf_counter() - self.t0)
+        return False
+
+
+class Profiler(object):
+    """ stage timing, counters and gauges, summarized periodically """
+
+    def __init__(self, enabled=False, period=1.0, fName=None):
+        """
+        enabled: False makes all calls no-ops
+        period: print / save a summary every period [s], 0: only on close()
+        fName: append the summaries to this file as JSON lines
+        """
+        self.enabled = enabled
+        self.period = period
+        self.fName = fName
+        self.stages = {}
+        self.counts = {}        # of the current period
+        self.totals = {}        # counts since start
+        self.gauges = {}        # largest value of the current period
+        self.lock = threading.Lock()
+        self.t0 = self.tLast = time.perf_counter()
+        self.thread = None
+        if enabled and fName:
+            # Start a new file
+            open(fName, "w").close()
+
+    def stage(self, name):
+        """ context which times the code of a with block """
+        if not self.enabled:
+            return NULL_STAGE
+        st = self.stages.get(name)
+        if st is None:
+            with self.lock:
+                st = self.stages.setdefault(name, _Stage())
+        return st
+
+    def count(self, name, n=1):
+        """ add n to counter name """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def gauge(self, name, value):
+        """ a level like a buffer fill, the largest one per period is kept """
+        if not self.enabled:
+            return
+        with self.lock:
+            self.gauges[name] = maximum(self.gauges.get(name, value), value)
+
+    def summary(self):
+        """ statistics since the last call as a dict, resets the period """
+        t = time.perf_counter()
+        with self.lock:
+            dt = t - self.tLast
+            self.tLast = t
+            stages = {}
+            for name, st in self.stages.items():
+                times, st.times = array(st.times), []
+                if times.size == 0:
+                    continue
+                st.n += times.size
+                st.total += times.sum()
+                st.max = float(maximum(st.max, amax(times)))
+                stages[name] = {
+                    "n": times.size,
+                    "mean_ms": float(mean(times)) * 1e3,
+                    "p99_ms": float(percentile(times, 99)) * 1e3,
+                    "max_ms": float(amax(times)) * 1e3,
+                    "load": float(times.sum() / dt)
+                }
+            counts, self.counts = self.counts, {}
+            for name, n in counts.items():
+                self.totals[name] = self.totals.get(name, 0) + n
+            gauges, self.gauges = self.gauges, {}
+        return {
+            "t": t - self.t0,
+            "dt": dt,
+            "stages": stages,
+            "counts": counts,
+            "gauges": {k: float(v) for k, v in gauges.items()}
+        }
+
+    def total(self):
+        """ statistics since start as a dict """
+        s = self.summary()
+        dt = s["t"]
+        with self.lock:
+            stages = {
+                name: {
+                    "n": st.n,
+                    "mean_ms": st.total / st.n * 1e3,
+                    "max_ms": st.max * 1e3,
+                    "load": st.total / dt
+                } for name, st in self.stages.items() if st.n > 0
+            }
+            counts = dict(self.totals)
+        return {"t": dt, "dt": dt, "stages": stages, "counts": counts, "gauges": {}}
+
+    @staticmethod
+    def format(s):
+        """ a summary() / total() dict as text, one line per stage """
+        lines = ["{:.1f} s:".format(s["t"])]
+        for name, st in sorted(s["stages"].items()):
+            lines.append("  {:12s} n: {:6d} mean: {:7.3f}{} max: {:7.3f} ms load: {:5.1f} %".format(
+                name, st["n"], st["mean_ms"],
+                " p99: {:7.3f}".format(st["p99_ms"]) if "p99_ms" in st else "",
+                st["max_ms"], st["load"] * 100
+            ))
+        other = ["{}: {}".format(k, v) for k, v in sorted(s["counts"].items())]
+        other += ["max. {}: {:g}".format(k, v) for k, v in sorted(s["gauges"].items())]
+        if other:
+            lines.append("  " + "  ".join(other))
+        return "\n".join(lines)
+
+    def _write(self, s, isTotal=False):
+        print(("total " if isTotal else "profile ") + self.format(s))
+        if self.fName:
+            with open(self.fName, "a") as f:
+                f.write(json.dumps(dict(s, total=isTotal)) + "\n")
+
+    def _run(self):
+        while True:
+            time.sleep(self.period)
+            self._write(self.summary())
+
+    def start(self):
+        """ print / save summaries every period from a background thread """
+        if self.enabled and self.period > 0 and self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        return self
+
+    def close(self):
+        """ print / save the totals since start """
+        if self.enabled:
+            self._write(self.total(), True)
+
+
+# Default for code which takes an optional profiler
+NULL_PROFILER = Profiler()
+
+
+def main():
+    """ self check: known durations, overhead of disabled and enabled calls """
+    prof = Profiler(True, period=0)
+    t0 = time.perf_counter()
+    for i in range(20):
+        with prof.stage("sleep"):
+            time.sleep(2e-3)
+        prof.count("loops")
+        prof.gauge("level", i)
+    tWall = time.perf_counter() - t0
+    s = prof.summary()
+    print(Profiler.format(s))
+    st = s["stages"]["sleep"]
+    # Sleeps take longer on a busy machine, but not longer than the loop
+    assert st["n"] == 20 and 2.0 <= st["mean_ms"] <= tWall / 20 * 1e3, (st, tWall)
+    assert s["counts"] == {"loops": 20} and s["gauges"] == {"level": 19}, s
+    assert prof.summary()["stages"] == {}
+    assert prof.total()["stages"]["sleep"]["n"] == 20
+
+    N = 100000
+    for enabled in (False, True):
+        p = Profiler(enabled, period=0)
+        t0 = time.perf_counter()
+        for i in range(N):
+            with p.stage("x"):
+                pass
+            p.count("y")
+        print("enabled: {} {:.2f} us per stage + count".format(enabled, (time.perf_counter() - t0) / N * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Fixed size circular store for the most recent CCD frames.
+
+Frames are written in place at a moving write index, nothing is shifted or
+reallocated. Readers get views in chronological order and can ask which rows
+changed since they last looked.
+"""
+from numpy import *
+import threading
+
+
+class RingBuffer(object):
+    """ keeps the last `depth` frames of `width` pixels """
+
+    def __init__(self, depth=1024, width=128, dtype=uint16):
+        self.buf = zeros((depth, width), dtype=dtype)
+        self.depth = depth
+        self.wInd = 0           # next row to be written
+        self.nTotal = 0         # number of frames pushed so far
+        self.lock = threading.Lock()
+
+    def push(self, frames):
+        """
+        Append a (N, width) block of frames.
+        Returns the indices of the rows which have been written.
+        """
+        frames = atleast_2d(frames)
+        n = frames.shape[0]
+        with self.lock:
+            if n > self.depth:
+                # Only the newest frames fit
+                self.wInd = (self.wInd + n - self.depth) % self.depth
+                self.nTotal += n - self.depth
+                frames = frames[-self.depth:]
+                n = self.depth
+            rows = (self.wInd + arange(n)) % self.depth
+            n0 = int(minimum(n, self.depth - self.wInd))
+            self.buf[self.wInd: self.wInd + n0] = frames[:n0]
+            self.buf[:n - n0] = frames[n0:]
+            self.wInd = (self.wInd + n) % self.depth
+            self.nTotal += n
+        return rows
+
+    def ordered(self):
+        """ all rows as (oldest, newest) pair of views, no copy made """
+        with self.lock:
+            return self.buf[self.wInd:], self.buf[:self.wInd]
+
+    def latest(self, n=1):
+        """ copy of the newest n frames in chronological order """
+        n = int(amin((n, self.depth, self.nTotal)))
+        with self.lock:
+            iStart = self.wInd - n
+            if iStart >= 0:
+                return self.buf[iStart: self.wInd].copy()
+            return vstack((self.buf[iStart:], self.buf[:self.wInd]))
+
+    def rowsSince(self, nTotal):
+        """
+        indices of the rows written after the buffer held nTotal frames.
+        Returns (rows, self.nTotal), pass the latter in on the next call.
+        """
+        with self.lock:
+            n = int(minimum(self.nTotal - nTotal, self.depth))
+            rows = (self.wInd - n + arange(n)) % self.depth
+            return rows, self.nTotal
+
+    def get(self, rows):
+        """ copy of the given rows, e.g. from rowsSince(), taken under the lock """
+        with self.lock:
+            return self.buf[rows]
+
+
+def main():
+    """ self check: wrap around, blocks larger than the buffer, concurrent access """
+    import time
+    rb = RingBuffer(5, 3, int64)
+    frames = arange(36).reshape(12, 3)     # frame k holds 3k .. 3k + 2
+    assert array_equal(rb.push(frames[:3]), [0, 1, 2])
+    rows, n = rb.rowsSince(0)
+    assert n == 3 and array_equal(rb.get(rows), frames[:3])
+    # Wraps around
+    assert array_equal(rb.push(frames[3:7]), [3, 4, 0, 1])
+    rows, n = rb.rowsSince(n)
+    assert n == 7 and array_equal(rb.get(rows), frames[3:7])
+    assert array_equal(vstack(rb.ordered()), frames[2:7])
+    assert array_equal(rb.latest(3), frames[4:7])
+    assert array_equal(rb.latest(100), frames[2:7])
+    # Larger than the buffer: only the newest frames are kept
+    rb.push(frames[7:])
+    rows, n = rb.rowsSince(n)
+    assert n == 12 and array_equal(rb.get(rows), frames[7:])
+    assert array_equal(vstack(rb.ordered()), frames[7:])
+    print("wrap around ok")
+
+    # A writer thread pushes blocks of frames with all pixels = frame number,
+    # rows read through get() must never be torn. Long rows, numpy copies
+    # them without holding the GIL
+    rb = RingBuffer(64, 1 << 16, int64)
+    isDone = threading.Event()
+
+    def writer():
+        k = 0
+        while not isDone.is_set():
+            n = k % 8 + 1
+            rb.push(arange(k, k + n)[:, newaxis] * ones(1 << 16, int64))
+            k += n
+    threading.Thread(target=writer, daemon=True).start()
+    nSeen = nRows = 0
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < 0.5:
+        rows, nSeen = rb.rowsSince(nSeen)
+        f = rb.get(rows)
+        assert all(f == f[:, :1]), "torn row"
+        nRows += rows.size
+    isDone.set()
+    print("concurrent: {} rows read of {} written, none torn".format(nRows, rb.nTotal))
+
+
+if __name__ == '__main__':
+    main()
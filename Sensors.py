@@ -0,0 +1,90 @@
+"""
+Readout parameters of the supported line sensors, for LinearCcd.
+
+Numbers of elements are from the datasheets in pdf/, per output channel.
+Timing is in cycles of the 10 MHz system clock of the cmodA7
+target, where one element is read out per ADC conversion (17 cycles).
+
+  * nPixels: effective pixels, what ends up in the frame memory
+  * nDummy: elements clocked out (and converted) before the first effective
+    pixel: dummy and light shielded ones. nTrail: the ones after the last
+  * icgLead, shCycles, icgLag: the shift pulse (SI / SH) is high for
+    shCycles. ICG (integration clear gate) goes low icgLead cycles before
+    and back high icgLag cycles after it. No ICG output when both are 0
+  * clkPerElement, clkHigh, clkDelay: the element clock (CLK / phiM /
+    phi1) pulses clkPerElement times per element, clkHigh cycles each, the
+    first one clkDelay cycles after the ADC got the previous element.
+    CLKn is the inverted clock (phi2)
+  * rsCycles: reset gate pulse of a CCD output amplifier, with every
+    element clock pulse
+  * intStart: with i_overlap, the sensor integrates from this element on
+  * nChannels: analog outputs read at the same time (colours), one ADC each
+  * outputs: pins driven by connectToCmod()
+"""
+
+SENSORS = {
+    # TAOS 128 x 1 photodiode array. SI overlaps the first CLK
+    "tsl1401": dict(
+        nPixels=128, nDummy=0, nTrail=0,
+        icgLead=0, shCycles=2, icgLag=0,
+        clkPerElement=1, clkHigh=1, clkDelay=0, rsCycles=0,
+        intStart=18, nChannels=1,
+        outputs=("CLK", "SI")
+    ),
+    # Toshiba 2500 pixel CCD with electronic shutter. Data rate is half
+    # the master clock phiM. SH >= 1 us, ICG low >= 1 us before it and
+    # 100 .. 1000 ns after it
+    "tcd1254": dict(
+        nPixels=2500, nDummy=32, nTrail=14,
+        icgLead=20, shCycles=20, icgLag=5,
+        clkPerElement=2, clkHigh=4, clkDelay=4, rsCycles=0,
+        intStart=0, nChannels=1,
+        outputs=("CLK", "SH", "ICG")
+    ),
+    # Toshiba 5400 x 6 line color CCD, 600 DPI mode (SW low), the 3 color
+    # outputs OS1 .. OS3. 2 phase clock, SH 3 .. 5 us, CP tied high
+    "tcd2905": dict(
+        nPixels=5400, nDummy=32, nTrail=7,
+        icgLead=0, shCycles=40, icgLag=2,
+        clkPerElement=1, clkHigh=8, clkDelay=8, rsCycles=2,
+        intStart=0, nChannels=3,
+        outputs=("CLK", "CLKn", "SH", "RS")
+    ),
+    # Toshiba 21360 x 6 line color CCD, 2400 DPI mode, the 3 color outputs.
+    # SH1 .. SH4 driven together, SH 3 .. 5 us
+    "tcd2964": dict(
+        nPixels=5340, nDummy=17, nTrail=7,
+        icgLead=0, shCycles=40, icgLag=2,
+        clkPerElement=1, clkHigh=8, clkDelay=8, rsCycles=2,
+        intStart=0, nChannels=3,
+        outputs=("CLK", "CLKn", "SH", "RS")
+    ),
+}
+
+
+def getSensor(sensor):
+    """ parameter dict of a sensor name, or the dict itself """
+    if isinstance(sensor, dict):
+        return sensor
+    try:
+        return SENSORS[sensor]
+    except KeyError:
+        raise ValueError("unknown sensor {}, one of {}".format(sensor, ", ".join(SENSORS)))
+
+
+def nElements(sensor):
+    """ elements read out (and converted) per line """
+    s = getSensor(sensor)
+    return s["nDummy"] + s["nPixels"] + s["nTrail"]
+
+
+def nWords(sensor):
+    """ words per frame: pixels of all channels """
+    s = getSensor(sensor)
+    return s["nPixels"] * s.get("nChannels", 1)
+
+
+def readoutCycles(sensor, adcPeriod=17):
+    """ cycles from the shift pulse to the last conversion, about """
+    s = getSensor(sensor)
+    return s["icgLead"] + s["shCycles"] + s["icgLag"] + nElements(s) * adcPeriod
@@ -1,69 +1,22 @@
 from migen import *
+from numpy import array
 from migen.fhdl.verilog import convert
-from litex.build.generic_platform import *
-from litex.soc.interconnect.csr import *
-from Adcs7476 import Adcs7476
-
-
-class Tsl1401(Module, AutoCSR):
-    ''' expected to run on a 20 MHz clock '''
-    def __init__(self, mem):
-        self.i_tau = CSRStorage(32, reset=128)  # Integration cycles
-        self.i_trig = Signal()                  # Trigger an acquisition
-        self.o_CLK = Signal()
-        self.o_SI = Signal()
-
-        ###
-
-        tauCnt = Signal(32)
-        trig0 = Signal()
-        trig1 = Signal()
-        self.submodules.adc = Adcs7476()
-
-        pixelIndex = Signal(8)
-        self.specials.p = p = mem.get_port(write_capable=True)
-        self.comb += [
-            p.adr.eq(pixelIndex-1),
-            p.dat_w.eq(self.adc.o_dat),
-            # p.dat_w.eq(pixelIndex-1),
-            p.we.eq(self.adc.o_valid),
-            self.o_CLK.eq(self.adc.o_valid | trig1),
-            trig0.eq(self.i_trig & (pixelIndex == 0)),
-            self.o_SI.eq(trig0 | trig1),
-            self.adc.i_trig.eq((pixelIndex > 0) & (pixelIndex < 128))
-        ]
-        self.sync += [
-            trig1.eq(trig0),
-            Case(pixelIndex, {
-                0:
-                    If(trig0,
-                        tauCnt.eq(0),
-                        pixelIndex.eq(1)
-                    ),
-                "default":
-                    If(self.adc.o_valid,
-                        pixelIndex.eq(pixelIndex + 1)
-                    ),
-                128:
-                    If(tauCnt < self.i_tau.storage,
-                        tauCnt.eq(tauCnt + 1),
-                    ).Else(
-                        pixelIndex.eq(0)
-                    )
-            })
-        ]
-
-    def connectToCmod(self, platform):
-        self.adc.connectToPmod(platform)
-        platform.add_extension([("TSL", 0,
-            Subsignal("CLK", Pins("M3"), IOStandard("LVCMOS33")),
-            Subsignal("SI",  Pins("L3"), IOStandard("LVCMOS33"))
-        )])
-        r = platform.request("TSL")
-        self.comb += [
-            r.CLK.eq(self.o_CLK),
-            r.SI.eq(self.o_SI)
-        ]
+from LinearCcd import LinearCcd
+from Adcs7476 import adc_model
+
+
+class Tsl1401(LinearCcd):
+    '''
+    expected to run on a 20 MHz clock
+    LinearCcd with the TSL1401 preset: 128 pixels, SI and CLK only.
+    The first CLK comes with SI, there are 129 per line
+    mem: pixels are written there. When None, only the pixel stream
+    (o_valid, o_dat, o_pixel) is provided, e.g. for LineAccumulator
+    adcDiv, adcQuiet: see Adcs7476
+    '''
+    def __init__(self, mem=None, adcDiv=1, adcQuiet=1):
+        LinearCcd.__init__(self, "tsl1401", mem, adcDiv, adcQuiet)
+        self.o_SI = self.o_SH
 
 
 def dut_tb(dut):
@@ -82,10 +35,102 @@ def dut_tb(dut):
             yield dut.adc.i_SDATA.eq(0)
         yield
 
-def getDut():
+@passive
+def timing_tb(dut, res):
+    ''' records the cycle of each SI and CLK rising edge '''
+    SI0 = CLK0 = 0
+    i = 0
+    while True:
+        SI = (yield dut.o_SI)
+        CLK = (yield dut.o_CLK)
+        if SI and not SI0:
+            res["SI"].append(i)
+        if CLK and not CLK0:
+            res["CLK"].append(i)
+            if SI:
+                res["CLK_SI"] += 1
+        SI0, CLK0 = SI, CLK
+        i += 1
+        yield
+
+
+def check_timing(tau, overlap, nLines=4):
+    '''
+    free running sensor. Checks SI / CLK timing, integration time,
+    line period and the o_linePeriod CSR
+    '''
+    dut = getDut()
+    res = dict(SI=[], CLK=[], CLK_SI=0, linePeriod=[])
+
+    def tb():
+        yield dut.i_tau.storage.eq(tau)
+        yield dut.i_overlap.storage.eq(overlap)
+        yield dut.i_trig.eq(1)
+        while len(res["SI"]) <= nLines:
+            yield
+        yield
+        res["linePeriod"] = (yield dut.o_linePeriod.status)
+
+    run_simulation(dut, [tb(), timing_tb(dut, res)])
+    SI, CLK = res["SI"], array(res["CLK"])
+    periods = set(b - a for a, b in zip(SI[1:], SI[2:]))
+    assert len(periods) == 1, periods
+    period = periods.pop()
+    assert res["linePeriod"] == period, (res["linePeriod"], period)
+    # Every SI comes with a CLK, which is the first of 129 per line
+    assert res["CLK_SI"] == len(SI), res["CLK_SI"]
+    clks = [CLK[(CLK >= a) & (CLK < b)] for a, b in zip(SI, SI[1:])]
+    assert all(c.size == 129 and c[0] == a + 1 for c, a in zip(clks, SI)), \
+        [c.size for c in clks]
+    # Integration: 18th CLK to the next SI
+    tInt = set(b - c[17] for c, b in zip(clks, SI[1:]))
+    readout = clks[0][-1] - SI[0]
+    print("tau: {} overlap: {} period: {} readout: {} integration: {}".format(
+        tau, overlap, period, readout, tInt
+    ))
+    if overlap:
+        assert period == max(readout + 2, clks[0][17] - SI[0] + tau + 2), period
+        if tau > readout:
+            assert tInt == {tau + 2}, tInt
+    else:
+        assert period == max(readout + 2, clks[0][127] - SI[0] + tau + 2), period
+    return period
+
+
+def check_frame(nLines=3):
+    '''
+    every conversion must be in the memory when o_eof pulses, pixel 127
+    included. o_eof swaps the FrameBanks, a late pixel would tear the frame.
+    With a divided SCLK, which the ADC model needs
+    '''
+    dut = getDut(adcDiv=2)
+    values = [(k * 37 + 5) & 0xFFF for k in range((nLines + 1) * 128)]
+    lines = []
+
+    def tb():
+        yield dut.i_tau.storage.eq(0)
+        yield dut.i_trig.eq(1)
+        while len(lines) < nLines:
+            if (yield dut.o_eof):
+                # The last pixel is written on this edge
+                yield
+                line = []
+                for i in range(128):
+                    line.append((yield dut.mem[i]))
+                lines.append(line)
+            yield
+
+    run_simulation(dut, [tb(), adc_model(dut.adc, list(values))])
+    for k, line in enumerate(lines):
+        assert line == values[k * 128: (k + 1) * 128], (k, line[-3:], values[(k + 1) * 128 - 3:][:3])
+    print("{} lines complete on o_eof".format(nLines))
+
+
+def getDut(**kwargs):
     mem = Memory(12, 128)
-    dut = Tsl1401(mem)
+    dut = Tsl1401(mem, **kwargs)
     dut.specials += mem
+    dut.mem = mem
     return dut
 
 def main():
@@ -94,6 +139,11 @@ def main():
     convert(dut, ios={dut.i_trig, dut.o_CLK, dut.o_SI}).write(fName + ".v")
     dut = getDut()
     run_simulation(dut, dut_tb(dut), vcd_name=fName+".vcd", clocks={"sys": 50} )
+    for tau in (0, 100, 5000):
+        t0 = check_timing(tau, 0)
+        t1 = check_timing(tau, 1)
+        assert t1 <= t0
+    check_frame()
 
 if __name__ == '__main__':
     main()
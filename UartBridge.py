@@ -0,0 +1,145 @@
+"""
+Talks to the UARTWishboneBridge directly from the application process.
+
+Same interface as RemoteClient (regs, mems, constants, read, write), but
+without litex_server: no extra process to start and kill, no TCP hop on
+every access. csr.csv is parsed once into a register map.
+
+Protocol of one bridge command, all big endian:
+    host -> FPGA: cmd (0x01 write, 0x02 read), length (words),
+                  word address (4 bytes), [length x 4 data bytes for writes]
+    FPGA -> host: length x 4 data bytes for reads
+"""
+import csv
+import time
+from types import SimpleNamespace
+from serial import Serial
+
+CMD_WRITE = 0x01
+CMD_READ = 0x02
+
+
+class Register(object):
+    """ one CSR, split into `length` bus words of `data_width` bits """
+
+    def __init__(self, bridge, name, addr, length, data_width, mode):
+        self.bridge = bridge
+        self.name = name
+        self.addr = addr
+        self.length = length
+        self.data_width = data_width
+        self.mode = mode
+        self.mask = (1 << data_width) - 1
+        self.shifts = [(length - 1 - i) * data_width for i in range(length)]
+
+    def read(self):
+        v = 0
+        for d in self.bridge.read(self.addr, self.length):
+            v = (v << self.data_width) | d
+        return v
+
+    def write(self, value):
+        self.bridge.write(self.addr, [(value >> s) & self.mask for s in self.shifts])
+
+
+def readCsrCsv(fName):
+    """ csr.csv -> (registers, constants, memory regions) as dicts """
+    regs = {}
+    constants = {}
+    mems = {}
+    with open(fName) as f:
+        for row in csv.reader(f):
+            if not row or row[0].startswith("#"):
+                continue
+            group, name, val = row[:3]
+            if group == "csr_register":
+                regs[name] = (int(val, 0), int(row[3]), row[4])
+            elif group == "constant":
+                try:
+                    constants[name] = int(val)
+                except ValueError:
+                    constants[name] = None if val == "None" else val
+            elif group == "memory_region":
+                mems[name] = SimpleNamespace(base=int(val, 0), size=int(row[3]))
+    return regs, constants, mems
+
+
+class UartBridge(object):
+    """ in process replacement for litex_server + RemoteClient """
+
+    def __init__(self, port, baudrate=115200, csr_csv="./build/csr.csv", csr_data_width=None, timeout=0.5):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        regs, constants, mems = readCsrCsv(csr_csv)
+        if csr_data_width is None:
+            # The cmodA7 target is built with 32 bit CSRs
+            csr_data_width = constants.get("config_csr_data_width", 32)
+        self.constants = SimpleNamespace(**constants)
+        self.mems = SimpleNamespace(**mems)
+        self.regs = SimpleNamespace(**{
+            name: Register(self, name, addr, length, csr_data_width, mode)
+            for name, (addr, length, mode) in regs.items()
+        })
+        self.ser = None
+        self.nCommands = 0
+
+    def open(self, readyTimeout=2.0):
+        """ open the port and wait until the bridge answers """
+        self.ser = Serial(self.port, self.baudrate, timeout=self.timeout)
+        self.waitReady(readyTimeout)
+
+    def close(self):
+        if self.ser:
+            self.ser.close()
+            self.ser = None
+
+    def _command(self, cmd, addr, n):
+        return bytes((cmd, n)) + (addr // 4).to_bytes(4, "big")
+
+    def read(self, addr, length=None):
+        """ burst read of `length` 32 bit words, one word if None """
+        n = 1 if length is None else length
+        self.ser.write(self._command(CMD_READ, addr, n))
+        dat = self.ser.read(4 * n)
+        self.nCommands += 1
+        if len(dat) < 4 * n:
+            raise IOError("UARTWishboneBridge: read of 0x{:08x} timed out".format(addr))
+        words = [int.from_bytes(dat[i: i + 4], "big") for i in range(0, 4 * n, 4)]
+        return words[0] if length is None else words
+
+    def write(self, addr, data):
+        """ burst write of a word or a list of words """
+        if isinstance(data, int):
+            data = [data]
+        # length is a single byte
+        for i in range(0, len(data), 255):
+            chunk = data[i: i + 255]
+            self.ser.write(self._command(CMD_WRITE, addr + 4 * i, len(chunk)) + b"".join(
+                (d & 0xFFFFFFFF).to_bytes(4, "big") for d in chunk
+            ))
+            self.nCommands += 1
+
+    def waitReady(self, timeout=2.0):
+        """
+        Flip all bits of ctrl_scratch and read them back, until it works or
+        timeout [s] is over. The bridge drops half received commands after
+        a short pause, so waiting between tries gets it back in sync.
+        """
+        scratch = self.regs.ctrl_scratch
+        full = (1 << (scratch.length * scratch.data_width)) - 1
+        tEnd = time.time() + timeout
+        while True:
+            self.ser.reset_input_buffer()
+            try:
+                v = scratch.read()
+                scratch.write(v ^ full)
+                isOk = scratch.read() == v ^ full
+                scratch.write(v)
+                if isOk:
+                    return
+            except IOError:
+                pass
+            if time.time() > tEnd:
+                raise IOError("UARTWishboneBridge on {} does not answer".format(self.port))
+            time.sleep(0.1)
@@ -2,54 +2,129 @@
 # Source is a memory of certain size
 # Receiver must know the size of the memory
 # A sync byte is sent first to mark start of transmission
+# Words are sent MSB first, either padded to whole bytes or packed
+# or Rice coded (lossless, variable length, see riceK below)
+# Optionally a header (sequence number, timestamp, tau) goes before the
+# words, see FrameHeader and HeaderLayout.py
 
 from migen import *
 from math import ceil
 from litex.soc.interconnect.csr import *
 from migen.fhdl.verilog import convert
 from litex.soc.cores import uart
-from migen.genlib.misc import chooser
+from HeaderLayout import HEADER_LAYOUT, HEADER_BITS, headerLen
 
 
 class MemoryDumper(Module):
-    def __init__(self, phy, mem, syncWord=0x42):
+    def __init__(self, phy, mem, syncWord=0x42, nWords=None, wordWidth=None,
+                 packed=False, riceK=None, riceQMax=8, header=False):
+        """
+        nWords: how many words to send per frame, starting at i_adrOffset.
+        Defaults to the whole memory. Can be lowered at run time with i_nWords.
+        wordWidth: how many LSBs of each word to send. Defaults to mem.width
+        packed: when False, each word is zero padded to whole bytes.
+        When True, words are sent back to back without padding
+        (two 12 bit words in 3 bytes). Only the last byte of a frame is padded.
+        Words are always sent MSB first.
+        riceK: when not None, send the difference to the previous word
+        (zigzag mapped to u >= 0) as Rice code: u >> riceK in unary (ones,
+        terminated by a zero), then the riceK LSBs of u.
+        If the unary part would be >= riceQMax, riceQMax ones are sent
+        followed by u in wordWidth + 1 bits.
+        The first word of a frame is coded against 0, so every frame can be
+        decoded on its own. Frames have variable length, padded to bytes.
+        header: send the fields of i_header (HEADER_LAYOUT) as the first
+        words of every frame, split into wordWidth bits, least significant
+        first. i_header must not change while the frame is sent.
+        """
         self.o_done = Signal()
         self.o_tx = Signal()
         self.i_trig = Signal()
+        self.o_start = Signal()     # Single cycle pulse when i_trig is accepted
+        self.i_adrOffset = Signal(max=mem.depth)
+        self.i_nWords = Signal(max=(nWords or mem.depth) + 1, reset=nWords or mem.depth)
+        self.i_header = Signal(HEADER_BITS)
 
         ###
 
         self.specials.p = p = mem.get_port(write_capable=False)
-        dataByte = Signal(8)
-        wordIndMax = mem.depth - 1
-        byteIndMax = ceil(mem.width / 8) - 1
-        print("MemoryDumper: byteIndMax={} wordIndMax={}".format(byteIndMax, wordIndMax))
-        byteInd = Signal(max=byteIndMax+1)
-        byteInd_ce = Signal()       # Pulse to increment byte / addr pointer
-        is_last_byte = Signal()     # Latches high when last byte was sent
-
-        self.sync += [
-            # Logic for incrementing data pointers: byteInd / p.adr
-            If(byteInd_ce,
-                If(byteInd >= byteIndMax,
-                    byteInd.eq(0),
-                    If(p.adr >= wordIndMax,
-                        is_last_byte.eq(1),
-                        p.adr.eq(0)
-                    ).Else(
-                        p.adr.eq(p.adr + 1),
-                    )
+        wordWidth = wordWidth or mem.width
+        nHeader = headerLen(wordWidth) if header else 0
+        wordIndMax = nHeader + (nWords or mem.depth) - 1
+        wordInd = Signal(max=wordIndMax + 1)
+        # The word to send, from the header or the memory
+        dat = Signal(wordWidth)
+        if header:
+            hdrWords = []
+            i = 0
+            for name, b in HEADER_LAYOUT:
+                for j in range(0, b, wordWidth):
+                    hdrWords.append(self.i_header[i + j: i + min(j + wordWidth, b)])
+                i += b
+            self.comb += If(wordInd < nHeader,
+                Case(wordInd, {k: dat.eq(w) for k, w in enumerate(hdrWords)})
+            ).Else(
+                dat.eq(p.dat_r)
+            )
+        else:
+            self.comb += dat.eq(p.dat_r)
+        # Bits per word on the wire (maximum)
+        W = wordWidth if packed else 8 * ceil(wordWidth / 8)
+        if riceK is not None:
+            W = riceQMax + wordWidth + 1
+        print("MemoryDumper: bitsPerWord={} wordIndMax={}".format(W, wordIndMax))
+        # Bits waiting to be sent are right aligned in bitBuf
+        bitBuf = Signal(W + 7)
+        nBits = Signal(max=W + 8)
+        is_last_word = Signal()     # Latches high when last word was loaded
+        sendShift = Signal(max=W)   # nBits - 8
+        padShift = Signal(3)        # 8 - nBits
+        if riceK is None:
+            word = [dat]
+            if W > wordWidth:
+                word.append(Constant(0, W - wordWidth))
+            codeLen = W
+            bitBufNext = Cat(*word, bitBuf)
+            resetPrev = loadPrev = []
+        else:
+            prev = Signal(wordWidth)            # Previous word of the frame
+            delta = Signal((wordWidth + 1, True))
+            u = Signal(wordWidth + 1)           # zigzag mapped delta
+            q = Signal(wordWidth + 1 - riceK)
+            ones = Signal(riceQMax)             # q ones, right aligned
+            onesShift = Signal(max=riceQMax + 1)
+            code = Signal(W)
+            codeLen = Signal(max=W + 1)
+            self.comb += [
+                delta.eq(dat - prev),
+                u.eq(Cat(0, delta[:-1]) ^ Replicate(delta[-1], wordWidth + 1)),
+                q.eq(u >> riceK),
+                If(q < riceQMax,
+                    onesShift.eq(riceQMax - q),
+                    ones.eq(Constant(2**riceQMax - 1, riceQMax) >> onesShift),
+                    code.eq(Cat(u[:riceK], Constant(0, 1), ones)),
+                    codeLen.eq(q + 1 + riceK)
                 ).Else(
-                    byteInd.eq(byteInd + 1)
+                    code.eq(Cat(u, Constant(2**riceQMax - 1, riceQMax))),
+                    codeLen.eq(W)
                 )
-            ),
-            self.o_done.eq(0),
-            byteInd_ce.eq(0)
+            ]
+            bitBufNext = (bitBuf << codeLen) | code
+            resetPrev = [NextValue(prev, 0)]
+            loadPrev = [NextValue(prev, dat)]
+
+        self.sync += [
+            self.o_done.eq(0)
         ]
 
         self.submodules.fsm = fsm = FSM()
         fsm.act("IDLE",
             If(self.i_trig,
+                self.o_start.eq(1),
+                NextValue(wordInd, 0),
+                NextValue(nBits, 0),
+                NextValue(is_last_word, 0),
+                *resetPrev,
                 NextState("SYNC")
             )
         )
@@ -58,40 +133,83 @@ class MemoryDumper(Module):
             phy.sink.data.eq(syncWord),
             NextState("WAIT")
         )
+        fsm.act("NEXT",
+            If(nBits >= 8,
+                NextState("SEND")
+            ).Elif(~is_last_word,
+                # Append the next word below the waiting bits
+                NextValue(bitBuf, bitBufNext),
+                NextValue(nBits, nBits + codeLen),
+                *loadPrev,
+                If(wordInd + 1 >= self.i_nWords + nHeader,
+                    NextValue(is_last_word, 1)
+                ).Else(
+                    NextValue(wordInd, wordInd + 1)
+                ),
+                NextState("LOAD")
+            ).Elif(nBits > 0,
+                # Zero pad the last byte
+                NextValue(bitBuf, bitBuf << padShift),
+                NextValue(nBits, 8)
+            ).Else(
+                NextValue(self.o_done, 1),
+                NextState("IDLE")
+            )
+        )
+        fsm.act("LOAD",     # Give the memory a cycle to fetch the next word
+            NextState("NEXT")
+        )
         fsm.act("SEND",
             phy.sink.valid.eq(1),
-            phy.sink.data.eq(dataByte),
-            NextValue(byteInd_ce, 1),
+            phy.sink.data.eq(bitBuf >> sendShift),
+            NextValue(nBits, nBits - 8),
             NextState("WAIT")
         )
         fsm.act("WAIT",
             If(phy.sink.ready,
-                If(is_last_byte,
-                    NextState("IDLE"),
-                    NextValue(self.o_done, 1),
-                    NextValue(is_last_byte, 0)
-                ).Else(
-                    NextState("SEND")
-                )
+                NextState("NEXT")
             )
         )
         self.comb += [
-            chooser(        # Selects one byte of the dat_r word
-                p.dat_r,
-                byteInd,
-                dataByte,
-                n=ceil(mem.width / 8),
-                reverse=True
-            )
+            p.adr.eq(self.i_adrOffset + wordInd - nHeader),
+            sendShift.eq(nBits - 8),
+            padShift.eq(8 - nBits)
         ]
 
 
 class UartMemoryDumper(MemoryDumper, AutoCSR):
-    def __init__(self, pads, mem, clk_freq=100e6, baudrate=115200):
+    def __init__(self, pads, mem, clk_freq=100e6, baudrate=115200, **kwargs):
         twVal = int((baudrate / clk_freq) * 2**32)
         self.tuneWord = CSRStorage(size=32, reset=twVal)
         self.submodules.uart = uart.RS232PHYTX(pads, self.tuneWord.storage)
-        MemoryDumper.__init__(self, self.uart, mem)
+        MemoryDumper.__init__(self, self.uart, mem, **kwargs)
+
+
+class FrameHeader(Module):
+    '''
+    Header fields of the frame completed with i_done (HEADER_LAYOUT).
+    o_header goes with the frame through FrameBanks (i_wr_meta) to the
+    MemoryDumper (i_header)
+    '''
+    def __init__(self, tauWidth=32):
+        self.i_done = Signal()          # Pulse: frame is complete
+        self.i_tau = Signal(tauWidth)   # Integration time of the sensor
+        self.o_header = Signal(HEADER_BITS)
+
+        ###
+
+        fields = {
+            "seq": Signal(16),          # Frames completed before this one
+            "time": Signal(32),         # Free running cycle counter
+            "tau": self.i_tau
+        }
+        self.sync += [
+            fields["time"].eq(fields["time"] + 1),
+            If(self.i_done,
+                fields["seq"].eq(fields["seq"] + 1)
+            )
+        ]
+        self.comb += self.o_header.eq(Cat(*[fields[n][:b] for n, b in HEADER_LAYOUT]))
 
 
 def dut_tb(dut):
@@ -106,10 +224,25 @@ def dut_tb(dut):
     for i in range(500):
         yield
 
-def getDut():
+
+@passive
+def monitor_tb(phy, frameLen, frames):
+    ''' collects the bytes handed to the UART phy into frames '''
+    buf = []
+    while True:
+        # The phy latches a byte whenever valid is high
+        if (yield phy.sink.valid):
+            buf.append((yield phy.sink.data))
+            if len(buf) == frameLen:
+                frames.append(buf)
+                buf = []
+        yield
+
+
+def getDut(**kwargs):
     mem = Memory(16, 4, init=[0x1122, 0x3344, 0x5566, 0x7788])
     # mem = Memory(32, 2, init=[0x11223344, 0x55667788])
-    dut = UartMemoryDumper(uart.UARTPads(), mem)
+    dut = UartMemoryDumper(uart.UARTPads(), mem, **kwargs)
     dut.specials += mem
     return dut
 
@@ -118,7 +251,19 @@ def main():
     dut = getDut()
     convert(dut, ios={dut.i_trig, dut.o_done}).write(fName + ".v")
     dut = getDut()
-    run_simulation(dut, dut_tb(dut), vcd_name=fName+".vcd", clocks={"sys": 50} )
+    frames = []
+    run_simulation(
+        dut, [dut_tb(dut), monitor_tb(dut.uart, 9, frames)],
+        vcd_name=fName+".vcd", clocks={"sys": 50}
+    )
+    print(["{:02x}".format(b) for b in frames[0]])
+    assert frames[0] == [0x42, 0x11, 0x22, 0x33, 0x44, 0x55, 0x66, 0x77, 0x88]
+    # Packed mode, 12 bits / word
+    dut = getDut(wordWidth=12, packed=True)
+    frames = []
+    run_simulation(dut, [dut_tb(dut), monitor_tb(dut.uart, 7, frames)])
+    print(["{:02x}".format(b) for b in frames[0]])
+    assert frames[0] == [0x42, 0x12, 0x23, 0x44, 0x56, 0x67, 0x88]
 
 if __name__ == '__main__':
     main()
@@ -8,13 +8,21 @@ from litex.soc.tools.remote import RemoteClient
 from time import sleep
 from numpy import *
 from matplotlib.pyplot import *
+from matplotlib.animation import FuncAnimation
 import threading
 import argparse
 from subprocess import Popen, call
 from serial import Serial
 import atexit
-
-rollBuffer = zeros((1024, 128), dtype=float)
+from FrameDecoder import FrameDecoder, RiceFrameDecoder
+from RingBuffer import RingBuffer
+from FrameRecorder import FrameRecorder
+from CsrClient import CsrClient
+from UartBridge import UartBridge
+from Calibration import Calibration
+from Features import recordLen, parseRecords
+from FrameStats import FrameStats
+from Profiler import Profiler
 
 
 def main():
@@ -23,43 +31,127 @@ def main():
     parser.add_argument("--tty_dump", default="/dev/ttyUSB2", help="UartMemoryDumper for data")
     parser.add_argument("--br_ctrl", default=115200, type=int, help="UartWishboneBridge baudrate")
     parser.add_argument("--br_dump", default=115200, type=int, help="UartMemoryDumper baudrate")
+    parser.add_argument("--direct", action="store_true", help="Talk to the UartWishboneBridge directly, without litex_server")
+    parser.add_argument("--depth", default=1024, type=int, help="Number of lines shown in the waterfall")
+    parser.add_argument("--dtype", default="uint16", help="Sample type of the frame store")
+    parser.add_argument("--fps", default=30, type=float, help="Display refresh rate")
+    parser.add_argument("--max_width", default=512, type=int, help="Longer frames are shown in the waterfall with the maximum of adjacent pixels")
+    parser.add_argument("--packed", action="store_true", help="Gateware was built with --packed")
+    parser.add_argument("--word_width", default=12, type=int, help="Gateware was built with --word_width")
+    parser.add_argument("--rice_k", type=int, help="Gateware was built with --rice_k")
+    parser.add_argument("--overlap", action="store_true", help="Integrate during readout, tau counts from the 18th CLK")
+    parser.add_argument("--n_lines", default=1, type=int, help="Sensor lines summed into one frame")
+    parser.add_argument("--shift", default=0, type=int, help="Divide the sum of lines by 2**shift")
+    parser.add_argument("--bin_log2", default=0, type=int, help="Sum 2**bin_log2 adjacent pixels")
+    parser.add_argument("--planar", action="store_true", help="Colour sensors: frames hold the channels one after the other, instead of interleaved. Needed for --bin_log2")
+    parser.add_argument("--features", action="store_true", help="FPGA sends FeatureExtractor records instead of lines")
+    parser.add_argument("--header", action="store_true", help="Gateware was built with --header: count lost frames and measure latencies")
+    parser.add_argument("--latency_file", help="With --header: save the latency histograms to this .npz file on exit")
+    parser.add_argument("--thr", default=2048, type=int, help="FeatureExtractor threshold")
+    parser.add_argument("--calib", help="Dark / flat field correction from this .npz file")
+    parser.add_argument("--cal_dark", default=0, type=int, help="Average this many frames into the dark frame of the current tau, save to --calib")
+    parser.add_argument("--cal_flat", default=0, type=int, help="Average this many frames into the flat field of the current tau, save to --calib")
+    parser.add_argument("--record", help="Also append all frames to the recording <RECORD>.dat / .idx / .json")
+    parser.add_argument("--profile", default=0, type=float, help="Print the time spent per stage every PROFILE seconds")
+    parser.add_argument("--profile_file", help="With --profile: also append the summaries to this file as JSON lines")
     args = parser.parse_args()
+    vMax = 2**args.word_width - 1
+    prof = Profiler(args.profile > 0, args.profile, args.profile_file).start()
+    atexit.register(prof.close)
 
     #----------------------------------------------
     # Setup litex_server
     #----------------------------------------------
-    call(["pkill", "litex_server*"])
-    Popen(["litex_server", "uart", args.tty_ctrl, str(args.br_ctrl)])
-    sleep(0.5)
-    wishbone = RemoteClient(csr_csv="./build/csr.csv")
+    if args.direct:
+        wishbone = UartBridge(args.tty_ctrl, args.br_ctrl, csr_csv="./build/csr.csv")
+    else:
+        call(["pkill", "litex_server*"])
+        Popen(["litex_server", "uart", args.tty_ctrl, str(args.br_ctrl)])
+        sleep(0.5)
+        wishbone = RemoteClient(csr_csv="./build/csr.csv")
     atexit.register(wishbone.close)
     wishbone.open()
+    ctrl = CsrClient(wishbone)
+    atexit.register(lambda: print("control path:", ctrl))
     fclk = wishbone.constants.system_clock_frequency
+    # Frame length comes from the gateware, builds before LinearCcd are TSL1401
+    nPixels = ctrl.read("ccd_o_nPixels") if "ccd_o_nPixels" in ctrl.regs else 128
+    # Colour sensors send nChannels words per pixel
+    nChannels = ctrl.read("ccd_o_nChannels") if "ccd_o_nChannels" in ctrl.regs else 1
+    nRaw = nPixels * nChannels      # words of an unbinned frame
+    nWords = nRaw >> args.bin_log2
+    if args.features:
+        # One record of the whole frame
+        nWords = recordLen(nRaw)
+        nChannels = 1
+    elif nChannels > 1 and args.bin_log2 and not args.planar:
+        print("Warning: binning mixes the channels of interleaved frames, use --planar")
+    print("pixels: {} channels: {} words / frame: {}".format(nPixels, nChannels, nWords))
+    # Frames are stored with the channels one after the other
+    ring = RingBuffer(args.depth, nWords, dtype(args.dtype))
+    # When the FPGA completed the frame in each row of ring, on the host clock
+    tRing = RingBuffer(args.depth, 1, float64)
+    setup = {
+        "ccd_i_overlap": args.overlap,
+        "acc_i_nLines": args.n_lines,
+        "acc_i_shift": args.shift,
+        "acc_i_binLog2": args.bin_log2
+    }
+    if "ccd_i_planar" in ctrl.regs:
+        setup["ccd_i_planar"] = args.planar
+    # Builds before FeatureExtractor don't have these
+    if "feat_i_enable" in ctrl.regs:
+        setup["feat_i_enable"] = args.features
+        setup["feat_i_thr"] = args.thr
+    ctrl.writeMany(setup)
 
     #----------------------------------------------
     # Setup Matplotlib
     #----------------------------------------------
     def get_tau():
-        intVal = wishbone.regs.ccd_i_tau.read()
+        intVal = ctrl.read("ccd_i_tau")
         tau = intVal / fclk / 1e-3
         return tau
 
     def set_tau(tau):
         intVal = int(tau * 1e-3 * fclk)
-        wishbone.regs.ccd_i_tau.write(intVal)
+        ctrl.write("ccd_i_tau", intVal)
+
+    # Long frames are reduced to at most max_width rows of the waterfall
+    nPx = nWords // nChannels   # per channel
+    decim = int(ceil(nPx / args.max_width))
+    binStarts = arange(0, nPx, decim)
+
+    def waterfallRows(frames):
+        """ (N, nWords) -> (rows, N) image columns, (rows, N, RGB) in colour """
+        frames = frames.reshape(frames.shape[0], nChannels, nPx)
+        if decim > 1:
+            frames = maximum.reduceat(frames, binStarts, axis=2)
+        if nChannels == 1:
+            return frames[:, 0].transpose()
+        # Channels 0, 1, 2 show up as red, green, blue
+        rgb = zeros((frames.shape[2], frames.shape[0], 3), float32)
+        rgb[:, :, :nChannels] = frames[:, :3].transpose(2, 0, 1) / vMax
+        return clip(rgb, 0, 1)
 
     fig, axs = subplots(2, 1, figsize=(10, 6))
-    # Rolling image
+    # Waterfall, sweeps from left to right. The write position is marked
     i = axs[0].imshow(
-        rollBuffer.transpose(),
-        vmin=0, vmax=4095,
+        waterfallRows(ring.buf),
+        vmin=0, vmax=vMax,
         aspect="equal",
         animated=True,
         # cmap="gnuplot2"
     )
-    # Line plot
-    l, = axs[1].plot(arange(128), zeros(128), "-o")
-    axs[1].axis((-1, 128, -1, 4096))
+    # Only rows which changed are copied into the image
+    imgDat = i.get_array()
+    cursor = axs[0].axvline(0, color="w", animated=True)
+    # Line plot, at full resolution, one line per channel
+    if nChannels > 1:
+        axs[1].set_prop_cycle(color=["r", "g", "b", "k", "c", "m"][:nChannels])
+    ls = axs[1].plot(arange(nPx), zeros((nPx, nChannels)), "-o" if nPx <= 256 else "-", animated=True)
+    txt = axs[1].text(0.01, 0.9, "", transform=axs[1].transAxes, animated=True)
+    axs[1].axis((-1, nPx, -1, vMax + 1))
     fig.tight_layout()
     # GUI slider
     axfreq = axes([0.13, 0.9, 0.7, 0.05])
@@ -69,26 +161,106 @@ def main():
     #----------------------------------------------
     # Setup serial reader thread
     #----------------------------------------------
-    wishbone.regs.mem_dump_tuneWord.write(
-        int(args.br_dump / fclk * 2**32)
-    )
+    ctrl.write("mem_dump_tuneWord", int(args.br_dump / fclk * 2**32))
     serial = Serial(args.tty_dump, args.br_dump)
+    # (N, nChannels, nPx) frames, binning keeps the layout
+    if args.rice_k is None:
+        dec = FrameDecoder(nWords, nBits=args.word_width, packed=args.packed, nChannels=nChannels, planar=args.planar, header=args.header)
+    else:
+        dec = RiceFrameDecoder(nWords, nBits=args.word_width, k=args.rice_k, nChannels=nChannels, planar=args.planar, header=args.header)
+    # The fastest frames spend the time of the shortest frame on the wire
+    stats = FrameStats(fclk, tMin=dec.frameLen * 10 / args.br_dump)
+    if args.header:
+        atexit.register(lambda: print("frame stats:", stats))
+        if args.latency_file:
+            atexit.register(stats.save, args.latency_file)
+
+    def readFrames(minFrames=1):
+        """ (N, nWords) frames, channels one after the other """
+        frames = dec.read(serial, minFrames, prof)
+        return frames.reshape(frames.shape[0], nWords)
+    rec = None
+    if args.record:
+        rec = FrameRecorder(args.record, nWords, dtype(args.dtype))
+        atexit.register(rec.close)
+    cal = None
+    if args.calib:
+        cal = Calibration(args.calib, nWords, args.word_width)
+        for kind, n in (("dark", args.cal_dark), ("flat", args.cal_flat)):
+            if n > 0:
+                input("Capturing the {} frame, press enter when ready".format(kind))
+                serial.reset_input_buffer()
+                frames = readFrames(n)
+                cal.capture(kind, frames, ctrl.read("ccd_i_tau"))
+                cal.save()
+        print("Calibration:", cal)
+    isInt = dtype(args.dtype).kind in "ui"
 
     def read_from_port():
-        global rollBuffer
+        """ producer: only decodes frames and stores them """
         while serial.isOpen():
-            serial.read_until(b"\x42")
-            buf = serial.read(256)
-            readData = fromstring(buf, dtype=">u2")
-            rollBuffer = roll(rollBuffer, 1, 0)
-            rollBuffer[0, :] = readData
-            l.set_ydata(readData)
-            i.set_array(rollBuffer.transpose())
-            fig.canvas.draw_idle()
-            # print("*", end="", flush=True)
+            frames = readFrames()
+            n = frames.shape[0]
+            if n > 0:
+                if args.header:
+                    seq, tDev = stats.received(dec.header)
+                else:
+                    # Host side numbering, frames lost before this block count
+                    seq = dec.nFrames + dec.nDropped - n + arange(n)
+                    tDev = full(n, nan)
+                prof.count("frames", n)
+                if rec:
+                    with prof.stage("record"):
+                        rec.push(frames, seq=seq)
+                if cal:
+                    with prof.stage("calib"):
+                        # ccd_i_tau comes from the cache, no bus access
+                        frames = cal.apply(frames, ctrl.read("ccd_i_tau"), isInt)
+                # Before the frames, update() only looks at rows of ring
+                tRing.push(tDev[:, newaxis])
+                ring.push(frames)
+
+    #----------------------------------------------
+    # Display loop, runs in the GUI thread
+    #----------------------------------------------
+    nSeen = 0       # ring.nTotal at the last display update
+    nShown = 0      # number of display updates with a new frame
+
+    def update(frame):
+        """ consumer: copy new rows into the plots at a fixed rate """
+        # Without the blitting FuncAnimation does after this returns
+        with prof.stage("draw"):
+            return updatePlots()
+
+    def updatePlots():
+        nonlocal nSeen, nShown
+        rows, nSeen = ring.rowsSince(nSeen)
+        if rows.size > 0:
+            # Copies, the reader thread keeps writing into the ring
+            frames = ring.get(rows)
+            imgDat[:, rows] = waterfallRows(frames)
+            i.changed()
+            cursor.set_xdata([rows[-1] + 0.5] * 2)
+            for l, y in zip(ls, frames[-1].reshape(nChannels, nPx)):
+                l.set_ydata(y)
+            nShown += 1
+            if args.header:
+                # Drawn at the end of this call, close enough
+                stats.latency("display", tRing.get(rows)[:, 0])
+        info = ""
+        if args.features and nSeen > 0:
+            f = parseRecords(ring.latest(), args.thr, nRaw)
+            info = "  peak: {}  centroid: {:.2f}  rise: {:.2f}  fall: {:.2f}".format(
+                f["peakIdx"][0], f["centroid"][0], f["risePos"][0], f["fallPos"][0]
+            )
+        txt.set_text("received: {}  displayed: {}  dropped: {}{}".format(
+            nSeen, nShown, stats.nDropped if args.header else dec.nDropped, info
+        ))
+        return (i, cursor, *ls, txt)
 
     atexit.register(serial.close)
-    threading.Thread(target=read_from_port).start()
+    threading.Thread(target=read_from_port, daemon=True).start()
+    ani = FuncAnimation(fig, update, interval=1000 / args.fps, blit=True)
     show()
 
 
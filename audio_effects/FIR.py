@@ -1,42 +1,138 @@
 from numpy import *
-import scipy.signal
+import threading
 
 
 def getMiddle(arr, N):
-    """ return N elements from the center of arr """
-    iStart = arr.size // 2 - N // 2
-    iStop = arr.size // 2 + N // 2
+    """ return N elements from the center of arr (along the last axis) """
+    iStart = arr.shape[-1] // 2 - N // 2
+    iStop = arr.shape[-1] // 2 + N // 2
     if N % 2:
         iStop += 1
-    return arr[iStart: iStop]
+    return arr[..., iStart: iStop]
+
+
+class OverlapSave(object):
+    """
+    uniformly partitioned overlap-save convolution engine
+
+    The impulse response is split into P partitions of blockSize taps.
+    The spectra of the partitions are cached and only recomputed when
+    setCoeffs() is called. Each block of input costs one FFT, one IFFT and
+    P complex multiply-adds, so long filters work with small blocks.
+    """
+
+    def __init__(self, nTaps, blockSize):
+        B = self.blockSize = blockSize
+        P = self.nParts = int(ceil(nTaps / B))
+        self.xBuf = zeros(2 * B)                    # last 2 input blocks
+        self.X = zeros((P, B + 1), dtype=complex)   # freq. domain delay line
+        self.H = zeros((P, B + 1), dtype=complex)   # filter partitions
+        self.Hnext = None       # pending coefficients, crossfaded in
+        self.tmp = zeros_like(self.X)
+        self.acc = zeros(B + 1, dtype=complex)
+        self.fade = arange(1, B + 1) / B
+        self.lock = threading.Lock()
+
+    def spectra(self, h):
+        """
+        cut impulse response h into partitions, return their spectra.
+        h can also be a (M, nTaps) table, giving (M, P, blockSize + 1)
+        """
+        B = self.blockSize
+        hp = zeros(h.shape[:-1] + (self.nParts * B,))
+        hp[..., :h.shape[-1]] = h
+        hp = hp.reshape(h.shape[:-1] + (self.nParts, B))
+        return fft.rfft(hp, 2 * B, axis=-1)
+
+    def setCoeffs(self, h, fade=True, H=None):
+        """
+        load a new impulse response, crossfade over the next block.
+        H: precomputed spectra(h), skips the FFTs
+        """
+        Hn = self.spectra(h) if H is None else H
+        with self.lock:
+            if fade:
+                self.Hnext = Hn
+            else:
+                self.H, self.Hnext = Hn, None
+
+    def _conv(self, H):
+        multiply(self.X, H, out=self.tmp)
+        self.tmp.sum(0, out=self.acc)
+        return fft.irfft(self.acc, self.xBuf.size)[self.blockSize:]
+
+    def process(self, x):
+        """ filter one block of blockSize samples """
+        B = self.blockSize
+        self.xBuf[:B] = self.xBuf[B:]
+        self.xBuf[B:] = x
+        self.X[1:] = self.X[:-1]
+        self.X[0] = fft.rfft(self.xBuf)
+        with self.lock:
+            Hn, self.Hnext = self.Hnext, None
+        y = self._conv(self.H)
+        if Hn is not None:
+            y += self.fade * (self._conv(Hn) - y)
+            self.H = Hn
+        return y
 
 
 class FIR(object):
     """ helper class for simple real time FIR filters """
 
-    def __init__(self, coeffs=zeros(128)):
+    def __init__(self, coeffs=zeros(128), blockSize=None):
         self.coeffs = coeffs
         self.X = zeros_like(self.coeffs)
-        self.scratch = zeros(self.coeffs.size - 1)  # For overlap save algo.
+        self.window = hamming(self.coeffs.size)
+        # Overlap save engine. Without blockSize it is created on the first
+        # filtChunk() call, with the size of that chunk.
+        self.blockSize = blockSize
+        self.ols = None
+        if blockSize:
+            self.ols = OverlapSave(self.coeffs.size, blockSize)
+            self.ols.setCoeffs(self.coeffs, fade=False)
+        self.yOut = zeros(0)
 
-    def setCoeffs(self, row, normalize=True):
-        """ row is one line of pixels from an image / CCD """
+    def designBatch(self, rows, normalize=True):
+        """
+        rows is a (M, nPixels) block of image lines / CCD frames.
+        Returns the (M, nTaps) table of their impulse responses.
+        """
+        h_f = atleast_2d(rows).astype(float)
         if normalize:
             # Normalize amplitudes for maximum effect
-            h_f = row - amin(row)
-            h_f /= amax(h_f)
-        else:
-            h_f = row
-        # Get impulse response
-        h_t = fft.irfft(h_f, 256)
-        # Truncate and window impulse response
+            h_f -= amin(h_f, 1, keepdims=True)
+            h_f /= amax(h_f, 1, keepdims=True)
+        # Long filters need a finer frequency grid than the CCD provides
+        nFFT = 256
+        if self.coeffs.size > nFFT:
+            nFFT = self.coeffs.size + self.coeffs.size % 2
+            x = linspace(0, h_f.shape[1] - 1, nFFT // 2 + 1)
+            i0 = minimum(x.astype(int), h_f.shape[1] - 2)
+            h_f = h_f[:, i0] + (x - i0) * (h_f[:, i0 + 1] - h_f[:, i0])
+        # Get impulse responses
+        h_t = fft.irfft(h_f, nFFT, axis=1)
+        # Truncate and window impulse responses
         # according to http://www.dspguide.com/ch17/1.htm
-        h_t = roll(h_t, h_t.size // 2)
+        h_t = roll(h_t, nFFT // 2, axis=1)
         h_t = getMiddle(h_t, self.coeffs.size)
-        h_t *= hamming(h_t.size)
-        self.coeffs[:] = h_t
+        return h_t * self.window
+
+    def setCoeffs(self, row, normalize=True):
+        """ row is one line of pixels from an image / CCD """
+        h_t = self.designBatch(row, normalize)[0]
+        self.loadCoeffs(h_t)
         return h_t
 
+    def loadCoeffs(self, h_t, H=None):
+        """
+        use the impulse response h_t, a row from designBatch().
+        H: the matching row of self.ols.spectra(), skips the FFTs
+        """
+        self.coeffs[:] = h_t
+        if self.ols is not None:
+            self.ols.setCoeffs(self.coeffs, H=H)
+
     def filt(self, xIn):
         """ process a single sample (very slow!) """
         self.X[:] = roll(self.X, 1)
@@ -44,9 +140,22 @@ class FIR(object):
         return sum(self.X * self.coeffs)
 
     def filtChunk(self, xIn):
-        """ process a chunk of samples """
-        res = scipy.signal.convolve(
-            hstack((self.scratch, xIn)), self.coeffs, mode="valid"
-        )
-        self.scratch[:] = xIn[-self.scratch.size:]
-        return res
+        """
+        process a chunk of samples, its size must be a multiple of blockSize.
+        The returned array is reused on the next call.
+        """
+        if self.ols is None:
+            self.ols = OverlapSave(self.coeffs.size, self.blockSize or xIn.size)
+            self.ols.setCoeffs(self.coeffs, fade=False)
+        B = self.ols.blockSize
+        if xIn.size % B:
+            raise ValueError(
+                "chunk of {} samples is not a multiple of blockSize {}".format(
+                    xIn.size, B
+                )
+            )
+        if self.yOut.size != xIn.size:
+            self.yOut = zeros(xIn.size)
+        for i in range(0, xIn.size, B):
+            self.yOut[i: i + B] = self.ols.process(xIn[i: i + B])
+        return self.yOut
@@ -0,0 +1,128 @@
+"""
+Additive synthesizers for mapping CCD pixels to a bank of tones.
+
+OscillatorBank evaluates every partial in the time domain, which is exact
+but costs chunkSize * nPartials sin() calls per chunk.
+
+AdditiveSynth places each partial as a window main lobe into a spectrum
+and does one inverse FFT plus overlap-add per chunk. Its cost hardly grows
+with the number of partials, so thousands of tones are no problem.
+"""
+from numpy import *
+
+
+class OscillatorBank(object):
+    """ time domain oscillator bank with wrapped phase accumulators """
+
+    def __init__(self, freqs, fSample=44100, chunkSize=64, tau=0.02):
+        """
+        freqs: frequency of each partial [Hz]
+        tau: time constant [s] of the amplitude smoothing
+        """
+        self.chunkSize = chunkSize
+        self.omega = freqs * 2 * pi / fSample   # normalized frequency
+        self.phs = zeros_like(self.omega)       # phase at start of chunk
+        self.amps = zeros_like(self.omega)      # current amplitude
+        self.target = zeros_like(self.omega)    # set by setAmps()
+        # Fraction of the way to target amplitude done in one chunk
+        self.alpha = 1 - exp(-chunkSize / (tau * fSample))
+        n = arange(chunkSize)
+        self.ramp = (n + 1) / chunkSize
+        self.phsInc = outer(n, self.omega)      # phase offset of each sample
+        self.buf = zeros_like(self.phsInc)
+
+    def setAmps(self, amps):
+        """ new amplitudes, faded in smoothly over the next chunks """
+        self.target[:] = amps
+
+    def render(self):
+        """ return the next chunk of samples in the range -1 .. 1 """
+        add(self.phsInc, self.phs, out=self.buf)
+        sin(self.buf, out=self.buf)
+        # Amplitude ramps linearly from amps to newAmps over the chunk
+        dA = self.alpha * (self.target - self.amps)
+        samples = self.buf.dot(self.amps) + self.ramp * self.buf.dot(dA)
+        samples /= self.omega.size
+        self.amps += dA
+        self.phs += self.omega * self.chunkSize
+        self.phs %= 2 * pi
+        return samples
+
+
+def getBhLobe(x, N):
+    """
+    main lobe of the 4 term Blackman-Harris window transform at x bins
+    offset, normalized to 1 at x = 0
+    """
+    consts = [0.35875, 0.48829, 0.14128, 0.01168]
+    f = x * 2 * pi / N
+    df = 2 * pi / N
+    y = zeros_like(f)
+    for m, c in enumerate(consts):
+        for fm in (f - df * m, f + df * m):
+            with errstate(divide="ignore", invalid="ignore"):
+                s = sin(N * fm / 2) / sin(fm / 2)
+            s[abs(fm) < 1e-12] = N
+            y += c / 2 * s
+    return y / N / consts[0]
+
+
+class AdditiveSynth(OscillatorBank):
+    """
+    inverse FFT / overlap-add synthesizer (FFT^-1 method by Rodet & Depalle)
+
+    Each partial becomes a 9 bin wide Blackman-Harris main lobe in a
+    spectrum of nFFT bins. The inverse FFT gives nFFT windowed sinusoids,
+    the window is swapped for a triangle and overlap-added with a hop of
+    chunkSize samples.
+    """
+
+    def __init__(self, freqs, fSample=44100, chunkSize=256, tau=0.02, nFFT=None):
+        OscillatorBank.__init__(self, freqs, fSample, chunkSize, tau)
+        H = chunkSize
+        N = self.nFFT = nFFT or 4 * H
+        self.bins = self.omega * N / (2 * pi)   # partial positions in bins
+        self.lobeOffs = arange(-4, 5)
+        # Each partial touches these bins, folded into 0 .. N/2
+        b = around(self.bins)[:, newaxis].astype(int) + self.lobeOffs
+        self.lobe = getBhLobe(b - self.bins[:, newaxis], N)
+        self.isMirror = (b < 0) | (b > N // 2)
+        b = abs(b)
+        b[b > N // 2] = N - b[b > N // 2]
+        self.lobeBins = b
+        # DC and Nyquist bins get both halves of the spectrum
+        self.isEdge = (b == 0) | (b == N // 2)
+        # Synthesis window: triangle / Blackman-Harris around the center
+        bh = blackman_harris(N)
+        bh /= sum(bh)
+        self.sw = zeros(N)
+        self.sw[N // 2 - H: N // 2 + H] = bartlett(2 * H + 1)[:-1]
+        self.sw[N // 2 - H: N // 2 + H] /= bh[N // 2 - H: N // 2 + H]
+        self.olaTail = zeros(H)
+
+    def render(self):
+        """ return the next chunk of samples in the range -1 .. 1 """
+        dA = self.alpha * (self.target - self.amps)
+        self.amps += dA
+        # phs is the phase at the center of the frame
+        vals = (self.amps / 2 * exp(1j * self.phs))[:, newaxis] * self.lobe
+        vals[self.isMirror] = conj(vals[self.isMirror])
+        vals[self.isEdge] = 2 * vals[self.isEdge].real
+        nBins = self.nFFT // 2 + 1
+        Y = bincount(self.lobeBins.ravel(), vals.real.ravel(), nBins) + \
+            1j * bincount(self.lobeBins.ravel(), vals.imag.ravel(), nBins)
+        yw = fft.fftshift(fft.irfft(Y, self.nFFT)) * self.sw
+        H = self.chunkSize
+        yw = yw[self.nFFT // 2 - H: self.nFFT // 2 + H]
+        samples = (self.olaTail + yw[:H]) / self.omega.size
+        self.olaTail[:] = yw[H:]
+        self.phs += self.omega * H
+        self.phs %= 2 * pi
+        return samples
+
+
+def blackman_harris(N):
+    """ 4 term Blackman-Harris window """
+    consts = [0.35875, 0.48829, 0.14128, 0.01168]
+    n = arange(N) * 2 * pi / N
+    return sum([(-1)**m * c * cos(m * n) for m, c in enumerate(consts)], 0)
@@ -14,10 +14,17 @@ import soundfile as sf
 import pyaudio
 from FIR import FIR
 
-from time import sleep
+from time import sleep, perf_counter
 import threading
 from serial import Serial
 import atexit
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from FrameDecoder import FrameDecoder
+from Calibration import Calibration
+from FrameStats import FrameStats
+from Profiler import Profiler
 
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
@@ -27,12 +34,36 @@ def main():
         help="UartMemoryDumper for data")
     parser.add_argument("--br_dump", default=115200, type=int,
         help="UartMemoryDumper baudrate")
+    parser.add_argument("--chunk_size", default=64, type=int,
+        help="Audio samples per block. Sets the latency")
+    parser.add_argument("--n_taps", default=512, type=int,
+        help="FIR filter length")
+    parser.add_argument("--packed", action="store_true",
+        help="Gateware was built with --packed")
+    parser.add_argument("--n_words", default=128, type=int,
+        help="Words per frame, ccd_o_nPixels of the gateware")
+    parser.add_argument("--calib",
+        help="Dark / flat field correction from this .npz file, see app.py")
+    parser.add_argument("--tau", default=0, type=int,
+        help="ccd_i_tau the sensor runs with, selects the calibration")
+    parser.add_argument("--header", action="store_true",
+        help="Gateware was built with --header: count lost frames and measure the latency to the speaker")
+    parser.add_argument("--fclk", default=10e6, type=float,
+        help="System clock of the gateware, for --header timestamps")
+    parser.add_argument("--latency_file",
+        help="With --header: save the latency histograms to this .npz file on exit")
+    parser.add_argument("--profile", default=0, type=float,
+        help="Print the time spent per stage and the audio underruns every PROFILE seconds")
+    parser.add_argument("--profile_file",
+        help="With --profile: also append the summaries to this file as JSON lines")
     args = parser.parse_args()
+    prof = Profiler(args.profile > 0, args.profile, args.profile_file).start()
+    atexit.register(prof.close)
 
     #----------------------------------
     # Read soundfile
     #----------------------------------
-    chunkSize = 256
+    chunkSize = args.chunk_size
     if args.audio_file:
         aDat, fSample = sf.read(args.audio_file, always_2d=True)
         # Make it mono
@@ -59,16 +90,35 @@ def main():
         format=p.get_format_from_width(2),
         channels=1,
         rate=fSample,
-        output=True
+        output=True,
+        frames_per_buffer=chunkSize
     )
-    f = FIR(zeros(128))
+    f = FIR(zeros(args.n_taps), blockSize=chunkSize)
+    dec = FrameDecoder(args.n_words, packed=args.packed, header=args.header)
+    stats = FrameStats(args.fclk, tMin=dec.frameLen * 10 / args.br_dump)
+    if args.header:
+        atexit.register(lambda: print("frame stats:", stats))
+        if args.latency_file:
+            atexit.register(stats.save, args.latency_file)
+    # When the FPGA completed the frame behind the last setCoeffs(), not played yet
+    tPending = [None]
 
     def audioPlayer():
         for chunk in aDat:
+            tDev, tPending[0] = tPending[0], None
             # Filter the chunk of samples
-            sOut = f.filtChunk(chunk)
+            with prof.stage("filter"):
+                sOut = f.filtChunk(chunk)
             # Play result
-            stream.write((sOut * 2**15).astype(int16).tostring())
+            with prof.stage("write"):
+                try:
+                    stream.write((sOut * 2**15).astype(int16).tostring(), exception_on_underflow=prof.enabled)
+                except IOError:
+                    # The samples went out, but the output had run dry before
+                    prof.count("underrun")
+            if tDev is not None:
+                # Leaves the speaker once the buffered samples are played
+                stats.latency("audio", tDev, perf_counter() + stream.get_output_latency())
     threading.Thread(target=audioPlayer).start()
 
     #----------------------------------------------
@@ -80,21 +130,33 @@ def main():
     ax.axis((0, 1, 0, 1))
     fig.tight_layout()
     ser = Serial(args.tty_dump, args.br_dump)
+    cal = Calibration(args.calib) if args.calib else None
 
     def read_from_port():
         while ser.isOpen():
-            ser.read_until(b"\x42")
-            buf = ser.read(256)
-            readData = fromstring(buf, dtype=">u2").astype(float) / 4096
+            frames = dec.read(ser, prof=prof)
+            if frames.shape[0] == 0:
+                continue
+            prof.count("frames", frames.shape[0])
+            if args.header:
+                _, tDev = stats.received(dec.header)
+            # Only the most recent frame is of interest
+            if cal:
+                frames = cal.apply(frames[-1:], args.tau)
+            readData = frames[-1].astype(float) / 4096
             # readData = roll(readData, 64)
             readData = (readData)**2
             # Update the filter coefficients
-            h_t = f.setCoeffs(readData, False)
+            with prof.stage("coeffs"):
+                h_t = f.setCoeffs(readData, False)
+            if args.header:
+                tPending[0] = tDev[-1]
             # Update plot
-            w, h_ff = scipy.signal.freqz(h_t)
-            l.set_data(w / pi, abs(h_ff))
-            # l.set_ydata(h_t)
-            fig.canvas.draw_idle()
+            with prof.stage("draw"):
+                w, h_ff = scipy.signal.freqz(h_t)
+                l.set_data(w / pi, abs(h_ff))
+                # l.set_ydata(h_t)
+                fig.canvas.draw_idle()
     atexit.register(ser.close)
     threading.Thread(target=read_from_port).start()
     show()
@@ -57,7 +57,10 @@ def main():
     samplesPerUpdate = int(samplesPerScan / imgDat.shape[0])
     print("Filter update rate: {:.1f} Hz".format(fSample / samplesPerUpdate))
 
-    f = FIR(ones(imgDat.shape[1]))
+    f = FIR(ones(imgDat.shape[1]), blockSize=samplesPerUpdate)
+    # Design the filters for all image rows at once
+    coeffTable = f.designBatch(imgDat)
+    specTable = f.ols.spectra(coeffTable)
     rowIndex = 0
     # Split aDat up in `samplesPerUpdate` sized chunks
     aDat.resize(int(ceil(aDat.size / samplesPerUpdate)), samplesPerUpdate)
@@ -67,7 +70,7 @@ def main():
         # Play result
         stream.write((sOut * 2**15).astype(int16).tostring())
         # Update the filter coefficients
-        f.setCoeffs(imgDat[rowIndex, :].astype("float"))
+        f.loadCoeffs(coeffTable[rowIndex], specTable[rowIndex])
         # Scan through the image line by line
         rowIndex += 1
         if rowIndex >= imgDat.shape[0]:
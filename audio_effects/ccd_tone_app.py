@@ -10,6 +10,15 @@ import pyaudio
 import threading
 from serial import Serial
 import atexit
+import time
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from FrameDecoder import FrameDecoder
+from Calibration import Calibration
+from FrameStats import FrameStats
+from Profiler import Profiler
+from Synth import OscillatorBank, AdditiveSynth
 
 
 def main():
@@ -20,7 +29,20 @@ def main():
     parser.add_argument("--base_freq", default=25, type=float, help="Pentatonic scale: fundamental frequency in Hz")
     parser.add_argument("--n_octaves", default=7, type=int, help="Pentatonic scale: number of octaves")
     parser.add_argument("--ch_width", default=2, type=int, help="Bytes per sample")
+    parser.add_argument("--synth", default="osc", choices=["osc", "ifft"], help="osc: oscillator bank, ifft: inverse FFT additive synthesis (for many tones)")
+    parser.add_argument("--chunk_size", default=64, type=int, help="Samples generated per iteration")
+    parser.add_argument("--packed", action="store_true", help="Gateware was built with --packed")
+    parser.add_argument("--n_words", default=128, type=int, help="Words per frame, ccd_o_nPixels of the gateware")
+    parser.add_argument("--calib", help="Dark / flat field correction from this .npz file, see app.py")
+    parser.add_argument("--tau", default=0, type=int, help="ccd_i_tau the sensor runs with, selects the calibration")
+    parser.add_argument("--header", action="store_true", help="Gateware was built with --header: count lost frames and measure the latency to the speaker")
+    parser.add_argument("--fclk", default=10e6, type=float, help="System clock of the gateware, for --header timestamps")
+    parser.add_argument("--latency_file", help="With --header: save the latency histograms to this .npz file on exit")
+    parser.add_argument("--profile", default=0, type=float, help="Print the time spent per stage and the audio underruns every PROFILE seconds")
+    parser.add_argument("--profile_file", help="With --profile: also append the summaries to this file as JSON lines")
     args = parser.parse_args()
+    prof = Profiler(args.profile > 0, args.profile, args.profile_file).start()
+    atexit.register(prof.close)
 
     #----------------------------------
     # Setup pyaudio, write audio stream
@@ -51,26 +73,36 @@ def main():
         for i in range(args.n_octaves):
             scale.extend(args.base_freq * ratios * 2**i)
         freq = array(scale)
-    omega = freq * 2 * pi / F_SAMPLE    # Tone normalized frequency
     amps = zeros_like(freq)             # Tone amplitude
-    phs = zeros_like(freq)              # Tone initial phase
-    # phs = 2 * pi * (random.rand(freq.size) * 2 - 1)
     W = 2**((CH_WIDTH * 8) - 1)
+    if args.synth == "ifft":
+        synth = AdditiveSynth(freq, F_SAMPLE, args.chunk_size)
+    else:
+        synth = OscillatorBank(freq, F_SAMPLE, args.chunk_size)
+    dec = FrameDecoder(args.n_words, packed=args.packed, header=args.header)
+    stats = FrameStats(args.fclk, tMin=dec.frameLen * 10 / args.br_dump)
+    if args.header:
+        atexit.register(lambda: print("frame stats:", stats))
+        if args.latency_file:
+            atexit.register(stats.save, args.latency_file)
+    # When the FPGA completed the frame behind the last setAmps(), not rendered yet
+    tPending = [None]
 
     def audioPlayer():
-        chunk = arange(64)  # How many samples to generate per iteration
-        iSample = 1         # Sample index
-        omega_v, chunk_v = meshgrid(omega, chunk)
-        minValue = maxValue = 0
         while True:
-            dats = amps * sin(omega_v * (iSample + chunk_v) + phs)
-            samples = mean(dats, 1)
-            maxValue = amax(hstack((maxValue, samples)))
-            minValue = amin(hstack((minValue, samples)))
-            print(minValue, maxValue)
-            samples_bytes = (samples * (W - 1)).astype('<i{}'.format(CH_WIDTH))
-            stream.write(samples_bytes.tobytes())
-            iSample += chunk.size
+            tDev, tPending[0] = tPending[0], None
+            with prof.stage("render"):
+                samples = synth.render()
+                samples_bytes = (samples * (W - 1)).astype('<i{}'.format(CH_WIDTH))
+            with prof.stage("write"):
+                try:
+                    stream.write(samples_bytes.tobytes(), exception_on_underflow=prof.enabled)
+                except IOError:
+                    # The samples went out, but the output had run dry before
+                    prof.count("underrun")
+            if tDev is not None:
+                # Leaves the speaker once the buffered samples are played
+                stats.latency("audio", tDev, time.perf_counter() + stream.get_output_latency())
     threading.Thread(target=audioPlayer).start()
 
     #----------------------------------------------
@@ -84,18 +116,30 @@ def main():
     # ax.set_xscale("log")
     fig.tight_layout()
     ser = Serial(args.tty_dump, args.br_dump)
+    cal = Calibration(args.calib) if args.calib else None
 
     def read_from_port():
-        ccdPos = linspace(freq[0], freq[-1], 128)
+        ccdPos = linspace(freq[0], freq[-1], args.n_words)
         while ser.isOpen():
-            ser.read_until(b"\x42")
-            buf = ser.read(256)
-            ccdData = fromstring(buf, dtype=">u2").astype(float) / 4096
-            # linearly map the CCD pixel 0 ... 128 to freq[0] ... freq[-1]
-            amps[:] = interp(freq, ccdPos, ccdData**2)
+            frames = dec.read(ser, prof=prof)
+            if frames.shape[0] == 0:
+                continue
+            prof.count("frames", frames.shape[0])
+            if args.header:
+                _, tDev = stats.received(dec.header)
+            if cal:
+                frames = cal.apply(frames[-1:], args.tau)
+            with prof.stage("amps"):
+                ccdData = frames[-1].astype(float) / 4096
+                # linearly map the CCD pixel 0 ... n_words to freq[0] ... freq[-1]
+                amps[:] = interp(freq, ccdPos, ccdData**2)
+                synth.setAmps(amps)
+            if args.header:
+                tPending[0] = tDev[-1]
             # Update plot
-            l.set_ydata(amps)
-            fig.canvas.draw_idle()
+            with prof.stage("draw"):
+                l.set_ydata(amps)
+                fig.canvas.draw_idle()
     atexit.register(ser.close)
     threading.Thread(target=read_from_port).start()
     show()
@@ -0,0 +1,189 @@
+"""
+Cycle accurate throughput benchmark of the whole capture chain.
+
+LinearCcd (incl. Adcs7476) -> [FeatureExtractor] -> LineAccumulator -> FrameBanks
+-> UartMemoryDumper
+are wired up like in target_cmodA7.py and simulated for every combination
+of integration time i_tau, UART baudrate (tuneWord) and number of frame
+banks. For each one it reports the achieved line rate, ADC duty cycle,
+UART utilization and the number of dropped frames as one JSON object per
+line, for sizing a configuration before building a bitstream.
+
+Rates are measured between the first and the last frame sent by the dumper,
+so start up does not count. migen simulates a few 100 cycles per second,
+runs are spread over --jobs processes.
+"""
+import argparse
+import itertools
+import json
+import time
+from multiprocessing import Pool
+from migen import *
+from litex.soc.cores import uart
+from LinearCcd import LinearCcd
+from Sensors import SENSORS
+from LineAccumulator import LineAccumulator
+from FeatureExtractor import FeatureExtractor
+from FrameBanks import FrameBanks
+from UartMemoryDumper import UartMemoryDumper, FrameHeader
+from HeaderLayout import HEADER_BITS
+
+
+class CaptureChain(Module):
+    ''' same wiring as target_cmodA7.BaseSoC, without the SoC '''
+    def __init__(self, nBanks=2, sysClk=10e6, baudrate=115200, wordWidth=12, sensor="tsl1401", header=False, **kwargs):
+        self.submodules.ccd = LinearCcd(sensor)
+        nWords = self.ccd.nWords
+        mem = Memory(wordWidth, nWords * nBanks)
+        self.specials += mem
+        self.submodules.banks = FrameBanks(nBanks, nWords, HEADER_BITS if header else 0)
+        self.submodules.acc = LineAccumulator(mem, nWords)
+        self.submodules.feat = FeatureExtractor(nWords)
+        isFeat = self.feat.i_enable.storage
+        self.submodules.mem_dump = UartMemoryDumper(
+            uart.UARTPads(), mem, sysClk, baudrate=baudrate, nWords=nWords,
+            header=header, **kwargs
+        )
+        if header:
+            self.submodules.hdr = FrameHeader()
+            self.comb += [
+                self.hdr.i_done.eq(self.acc.o_eof),
+                self.hdr.i_tau.eq(self.ccd.i_tau.storage),
+                self.banks.i_wr_meta.eq(self.hdr.o_header),
+                self.mem_dump.i_header.eq(self.banks.o_rd_meta)
+            ]
+        self.comb += [
+            self.ccd.i_trig.eq(~self.banks.o_wr_stall),
+            self.feat.i_valid.eq(self.ccd.o_valid),
+            self.feat.i_dat.eq(self.ccd.o_dat),
+            self.feat.i_pixel.eq(self.ccd.o_pixel),
+            self.feat.i_eol.eq(self.ccd.o_eof),
+            self.acc.i_bypass.eq(isFeat),
+            If(isFeat,
+                self.acc.i_valid.eq(self.feat.o_valid),
+                self.acc.i_dat.eq(self.feat.o_dat),
+                self.acc.i_pixel.eq(self.feat.o_pixel),
+                self.acc.i_eol.eq(self.feat.o_eol),
+                self.mem_dump.i_nWords.eq(self.feat.o_nWords)
+            ).Else(
+                self.acc.i_valid.eq(self.ccd.o_valid),
+                self.acc.i_dat.eq(self.ccd.o_dat),
+                self.acc.i_pixel.eq(self.ccd.o_pixel),
+                self.acc.i_eol.eq(self.ccd.o_eof),
+                self.mem_dump.i_nWords.eq(self.acc.o_nWords)
+            ),
+            self.acc.i_adrOffset.eq(self.banks.o_wr_offset),
+            self.banks.i_wr_done.eq(self.acc.o_eof),
+            self.mem_dump.i_adrOffset.eq(self.banks.o_rd_offset),
+            self.mem_dump.i_trig.eq(self.banks.o_rd_valid),
+            self.banks.i_rd_start.eq(self.mem_dump.o_start),
+            self.banks.i_rd_done.eq(self.mem_dump.o_done)
+        ]
+
+
+def bench_tb(dut, tau, nLines, nSent, maxCycles, res, features=False):
+    '''
+    counts events until the dumper has sent nSent frames (or maxCycles).
+    res gets the counts between the first and the last sent frame.
+    '''
+    yield dut.ccd.i_tau.storage.eq(tau)
+    yield dut.acc.i_nLines.storage.eq(nLines)
+    yield dut.feat.i_enable.storage.eq(features)
+    phy = dut.mem_dump.uart
+    n = dict(cycles=0, lines=0, frames=0, sent=0, dropped=0, bytes=0, adcBusy=0, stall=0)
+    n0 = dict(n)
+    for i in range(maxCycles):
+        # Sensor noise, so compressed modes don't look too good
+        yield dut.ccd.adc.i_SDATA.eq((i * 2654435761 >> 7) & 1)
+        yield
+        n["cycles"] += 1
+        n["lines"] += (yield dut.ccd.o_eof)
+        isWrDone = (yield dut.banks.i_wr_done)
+        n["frames"] += isWrDone
+        # The waiting frame is replaced before the dumper took it
+        if isWrDone and (yield dut.banks.o_rd_valid) and not (yield dut.banks.i_rd_start):
+            n["dropped"] += 1
+        # The phy takes a byte whenever valid is high
+        n["bytes"] += (yield phy.sink.valid)
+        n["adcBusy"] += 1 - (yield dut.ccd.adc.o_nCS)
+        n["stall"] += (yield dut.banks.o_wr_stall)
+        if (yield dut.mem_dump.o_done):
+            n["sent"] += 1
+            if n["sent"] == 1:
+                n0 = dict(n)
+            if n["sent"] > nSent:
+                break
+    if n["sent"] < 2:
+        n0 = {k: 0 for k in n}
+    res.update({k: n[k] - n0[k] for k in n})
+
+
+def runOne(tau, baud, nBanks, nLines=1, nSent=3, maxCycles=10**6, sysClk=10e6, features=False, **kwargs):
+    dut = CaptureChain(nBanks, sysClk, baud, **kwargs)
+    n = {}
+    t0 = time.time()
+    run_simulation(dut, bench_tb(dut, tau, nLines, nSent, maxCycles, n, features))
+    nCycles = n["cycles"]
+    T = nCycles / sysClk
+    return {
+        "i_tau": tau,
+        "baud": baud,
+        "tuneWord": dut.mem_dump.tuneWord.storage.reset.value,
+        "sensor": kwargs.get("sensor", "tsl1401"),
+        "n_banks": nBanks,
+        "n_lines": nLines,
+        "features": features,
+        "header": kwargs.get("header", False),
+        "cycles": nCycles,
+        "frames_sent": n["sent"],
+        "line_rate": round(n["lines"] / T, 1),
+        "frame_rate": round(n["frames"] / T, 1),
+        "sent_rate": round(n["sent"] / T, 1),
+        "adc_duty": round(n["adcBusy"] / nCycles, 4),
+        "uart_util": round(n["bytes"] * 10 / (baud * T), 4),
+        "stall": round(n["stall"] / nCycles, 4),
+        "frames_dropped": n["dropped"],
+        "sim_time": round(time.time() - t0, 2)
+    }
+
+
+def runArgs(kwargs):
+    return runOne(**kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--taus", default=[0, 20000], type=int, nargs="+", help="i_tau values [cycles]")
+    parser.add_argument("--bauds", default=[1000000, 3000000], type=int, nargs="+", help="UART baudrates")
+    parser.add_argument("--n_banks", default=[2, 3], type=int, nargs="+", help="Frame banks (memory size)")
+    parser.add_argument("--n_lines", default=1, type=int, help="Lines summed by LineAccumulator")
+    parser.add_argument("--n_sent", default=3, type=int, help="Measure over this many sent frames")
+    parser.add_argument("--max_cycles", default=10**6, type=int, help="Give up after this many cycles")
+    parser.add_argument("--sys_clk", default=10e6, type=float, help="System clock [Hz]")
+    parser.add_argument("--packed", action="store_true", help="Packed 12 bit words")
+    parser.add_argument("--rice_k", type=int, help="Rice coded words with this parameter")
+    parser.add_argument("--features", action="store_true", help="Send FeatureExtractor records instead of lines")
+    parser.add_argument("--header", action="store_true", help="Frame header with sequence number, timestamp and tau")
+    parser.add_argument("--sensor", default="tsl1401", choices=list(SENSORS), help="Sensor preset. The Toshiba ones simulate for minutes per line")
+    parser.add_argument("--jobs", default=None, type=int, help="Parallel simulations. Default: number of CPUs")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    runs = [dict(
+        tau=tau, baud=baud, nBanks=nBanks, nLines=args.n_lines,
+        nSent=args.n_sent, maxCycles=args.max_cycles, sysClk=args.sys_clk,
+        packed=args.packed, riceK=args.rice_k, features=args.features, sensor=args.sensor,
+        header=args.header
+    ) for tau, baud, nBanks in itertools.product(args.taus, args.bauds, args.n_banks)]
+    results = []
+    with Pool(args.jobs) as pool:
+        for r in pool.imap(runArgs, runs):
+            results.append(r)
+            print(json.dumps(r), flush=True)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
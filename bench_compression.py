@@ -0,0 +1,118 @@
+"""
+Compression ratio of the Rice coded MemoryDumper output.
+
+Encodes recorded (.npy file of (N, 128) frames) or synthetic frames for a
+range of Rice parameters k and reports bytes per frame, compression ratio
+and the resulting line rate over the UART. The first few frames are also
+pushed through the gateware in simulation to check that it is bit exact
+with the Python model, and everything is decoded again with
+RiceFrameDecoder to check that it is lossless.
+"""
+import argparse
+import json
+from numpy import *
+from migen import *
+from litex.soc.cores import uart
+from UartMemoryDumper import UartMemoryDumper, monitor_tb
+from FrameDecoder import riceEncode, RiceFrameDecoder
+
+
+def synthFrames(nFrames, nPixels=128, noise=4.0, seed=0):
+    """ smooth illumination profiles with a moving shadow, plus noise """
+    rnd = random.RandomState(seed)
+    x = arange(nPixels)
+    fr = []
+    for i in range(nFrames):
+        light = 2500 + 800 * cos((x - 64) / 40)
+        edge = 30 + 60 * (0.5 + 0.5 * sin(i / 50))
+        light /= 1 + exp((x - edge) / 3)
+        fr.append(light + 150 + rnd.randn(nPixels) * noise)
+    return clip(around(fr), 0, 4095).astype(uint16)
+
+
+def toJson(o):
+    """ numpy scalars -> python """
+    return o.item()
+
+
+def simEncode(frames, k, qMax, nBits=12):
+    """ bytes which the gateware sends for frames, from simulation """
+    nWords = frames.shape[1]
+    mem = Memory(16, frames.size, init=[int(v) for v in frames.ravel()])
+    dut = UartMemoryDumper(
+        uart.UARTPads(), mem, nWords=nWords, wordWidth=nBits,
+        riceK=k, riceQMax=qMax
+    )
+    dut.specials += mem
+    nBytes = len(riceEncode(frames, k, qMax, nBits))
+    out = []
+
+    def tb():
+        yield dut.tuneWord.storage.eq(0x80000000)
+        for i in range(frames.shape[0]):
+            yield dut.i_adrOffset.eq(i * nWords)
+            yield dut.i_trig.eq(1)
+            yield
+            yield dut.i_trig.eq(0)
+            while not (yield dut.o_done):
+                yield
+        for i in range(100):
+            yield
+
+    run_simulation(dut, [tb(), monitor_tb(dut.uart, nBytes, out)])
+    return bytes(out[0]) if out else b""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--frames", help=".npy file with (N, 128) recorded frames. Default: synthetic")
+    parser.add_argument("--n_frames", default=1000, type=int, help="Number of synthetic frames")
+    parser.add_argument("--noise", default=4.0, type=float, help="Noise of synthetic frames [LSB rms]")
+    parser.add_argument("--k", default=[1, 2, 3, 4, 5, 6], type=int, nargs="+", help="Rice parameters to try")
+    parser.add_argument("--q_max", default=8, type=int, help="Unary length where the escape code is used")
+    parser.add_argument("--n_sim", default=3, type=int, help="Frames to check against the gateware")
+    parser.add_argument("--baud", default=115200, type=int, help="UART baudrate")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    if args.frames:
+        frames = load(args.frames).astype(uint16)
+    else:
+        frames = synthFrames(args.n_frames, noise=args.noise)
+    nFrames, nWords = frames.shape
+    # 10 bits per byte on the wire (start + stop bit)
+    bytesPerSec = args.baud / 10
+    raw = 1 + 2 * nWords
+    packed = 1 + (nWords * 12 + 7) // 8
+    results = []
+    for k in args.k:
+        stream = riceEncode(frames, k, args.q_max)
+        sim = simEncode(frames[:args.n_sim], k, args.q_max)
+        isExact = sim == riceEncode(frames[:args.n_sim], k, args.q_max)
+        dec = RiceFrameDecoder(nWords, k=k, qMax=args.q_max)
+        res = dec.decode(stream)
+        isLossless = res.shape[0] == nFrames - 1 and array_equal(res, frames[:-1])
+        perFrame = len(stream) / nFrames
+        r = {
+            "k": k,
+            "q_max": args.q_max,
+            "frames": nFrames,
+            "bytes_per_frame": round(perFrame, 2),
+            "ratio_vs_raw": round(raw / perFrame, 3),
+            "ratio_vs_packed": round(packed / perFrame, 3),
+            "lines_per_s": round(bytesPerSec / perFrame, 1),
+            "gateware_exact": isExact,
+            "lossless": isLossless
+        }
+        results.append(r)
+        print(json.dumps(r, default=toJson))
+    print("raw: {} B/frame {:.1f} lines/s, packed: {} B/frame {:.1f} lines/s".format(
+        raw, bytesPerSec / raw, packed, bytesPerSec / packed
+    ))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, default=toJson)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Throughput of the Features.py position extraction.
+
+Runs edges, centroids and both peak fits on blocks of synthetic (or
+recorded, .npy file of (N, nPixels)) frames and reports frames per second
+for every block size. headroom is that rate divided by the maximum line
+rate of the sensor, fclk / readout cycles (Sensors.readoutCycles, TSL1401:
+128 elements of 17 cycles), so > 1 means a single core keeps up with the
+sensor running flat out.
+"""
+import argparse
+import json
+import time
+from numpy import *
+import Features
+from Sensors import SENSORS, readoutCycles
+
+
+def spotFrames(nFrames, nPixels=128, noise=4.0, seed=0):
+    """ a gaussian light spot at a random position, plus noise """
+    rnd = random.RandomState(seed)
+    x = arange(nPixels)
+    pos = rnd.uniform(5, nPixels - 5, (nFrames, 1))
+    y = 200 + 3000 * exp(-(x - pos)**2 / 18) + rnd.randn(nFrames, nPixels) * noise
+    return clip(around(y), 0, 4095).astype(uint16)
+
+
+def timeIt(fct, frames, block, minTime):
+    """ frames / s of fct, called on consecutive blocks of frames """
+    nDone = 0
+    t0 = time.perf_counter()
+    while True:
+        for i in range(0, frames.shape[0], block):
+            fct(frames[i: i + block])
+        nDone += frames.shape[0]
+        dt = time.perf_counter() - t0
+        if dt >= minTime:
+            return nDone / dt
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--frames", help=".npy file with (N, nPixels) recorded frames. Default: synthetic")
+    parser.add_argument("--sensor", default="tsl1401", choices=list(SENSORS), help="Frame length and readout time")
+    parser.add_argument("--n_frames", type=int, help="Number of synthetic frames. Default: 2.5 M pixels worth")
+    parser.add_argument("--blocks", default=[1, 16, 256, 4096], type=int, nargs="+", help="Frames per call")
+    parser.add_argument("--fclk", default=10e6, type=float, help="System clock [Hz]")
+    parser.add_argument("--readout", type=int, help="Cycles per sensor line. Default: from --sensor")
+    parser.add_argument("--min_time", default=0.5, type=float, help="Time each measurement for at least this long [s]")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    nPixels = SENSORS[args.sensor]["nPixels"]
+    if args.frames:
+        frames = load(args.frames).astype(uint16)
+    else:
+        frames = spotFrames(args.n_frames or 20000 * 128 // nPixels, nPixels)
+    maxRate = args.fclk / (args.readout or readoutCycles(args.sensor))
+    thr = (amin(frames) + amax(frames)) / 2
+    fcts = {
+        "edges": lambda f: Features.edges(f, thr),
+        "centroids": lambda f: Features.centroids(f, thr),
+        "peaks_parabolic": lambda f: Features.peaks(f, "parabolic"),
+        "peaks_gauss": lambda f: Features.peaks(f, "gauss"),
+    }
+    results = []
+    for name, fct in fcts.items():
+        for block in args.blocks:
+            fps = timeIt(fct, frames, block, args.min_time)
+            r = {
+                "feature": name,
+                "block": block,
+                "frames_per_s": float(around(fps)),
+                "headroom": float(around(fps / maxRate, 2))
+            }
+            results.append(r)
+            print(json.dumps(r))
+    print("max. line rate: {:.0f} lines / s".format(maxRate))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
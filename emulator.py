@@ -0,0 +1,423 @@
+"""
+Hardware emulator for running the host applications without a CmodA7.
+
+Opens two pseudo terminals:
+  * dump: sends the UartMemoryDumper byte stream (sync byte + frames),
+    raw, packed or Rice coded, at a given baudrate / frame rate.
+    Patterns, noise and faults (dropped bytes, corrupted bursts) can be set
+  * ctrl: answers UARTWishboneBridge read / write commands from a register
+    table like csr.csv, so `litex_server uart <ctrl pty>` and RemoteClient
+    work. ccd_i_tau, acc_* and mem_dump_tuneWord act on the dump stream.
+
+Example:
+    python emulator.py --baud 0 --fps 2000 --drop_prob 0.01
+    python emulator.py --sensor tcd2905 --baud 3000000
+    (3 colour channels, the layout follows ccd_i_planar)
+    python emulator.py --header --drop_prob 0.01
+    (frame header: seq. number, timestamp and tau, like --header of the target)
+    python app.py --tty_ctrl <ctrl pty> --tty_dump <dump pty>
+"""
+import argparse
+import csv
+import os
+import threading
+import time
+import tty
+import fcntl
+from numpy import *
+from FrameDecoder import packWords, riceEncode, makeHeader
+from Sensors import SENSORS, readoutCycles
+
+# UARTWishboneBridge commands
+CMD_WRITE = 0x01
+CMD_READ = 0x02
+
+# name, reset value, mode. Same names as the cmodA7 target
+DEFAULT_REGS = {
+    "ctrl": [("scratch", 0x12345678, "rw")],
+    "ccd": [
+        ("i_tau", 128, "rw"),
+        ("i_overlap", 0, "rw"),
+        ("o_linePeriod", 0, "ro"),
+        ("o_nPixels", 128, "ro"),
+        ("o_nChannels", 1, "ro"),
+        ("i_planar", 0, "rw")
+    ],
+    "acc": [
+        ("i_nLines", 1, "rw"),
+        ("i_shift", 0, "rw"),
+        ("i_binLog2", 0, "rw")
+    ],
+    "mem_dump": [("tuneWord", 0, "rw")]
+}
+CSR_BASE = 0xe0000000
+CCD_MEM_BASE = 0x50000000
+
+
+def openPty():
+    """ returns (master fd, slave path) of a new raw mode pty """
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    return master, os.ttyname(slave)
+
+
+class RegisterFile(object):
+    """ 32 bit registers by byte address, like the CSR bus behind the bridge """
+
+    def __init__(self, csrCsv=None, fclk=10e6, baud=115200, nPixels=128, nChannels=1):
+        self.nPixels = nPixels
+        self.nChannels = nChannels
+        self.regs = {}          # address: value
+        self.names = {}         # name: address
+        self.modes = {}         # address: mode
+        self.mems = {}          # name: (base, size in bytes)
+        self.constants = {"system_clock_frequency": int(fclk)}
+        if csrCsv and os.path.isfile(csrCsv):
+            self.load(csrCsv)
+        else:
+            self.makeDefault()
+            if csrCsv:
+                self.save(csrCsv)
+        if "mem_dump_tuneWord" in self.names:
+            self["mem_dump_tuneWord"] = int(baud / self.fclk * 2**32)
+        if "ccd_o_nPixels" in self.names:
+            self["ccd_o_nPixels"] = nPixels
+        if "ccd_o_nChannels" in self.names:
+            self["ccd_o_nChannels"] = nChannels
+        self.lock = threading.Lock()
+
+    @property
+    def fclk(self):
+        return self.constants["system_clock_frequency"]
+
+    def makeDefault(self):
+        for i, (mod, regs) in enumerate(DEFAULT_REGS.items()):
+            base = CSR_BASE + i * 0x800
+            for j, (name, val, mode) in enumerate(regs):
+                adr = base + 4 * j
+                self.names[mod + "_" + name] = adr
+                self.regs[adr] = val
+                self.modes[adr] = mode
+        self.mems["ccd"] = (CCD_MEM_BASE, 4 * self.nPixels * self.nChannels * 2)
+
+    def load(self, fName):
+        """ take over register addresses from a csr.csv of a real build """
+        for row in csv.reader(open(fName)):
+            if not row or row[0].startswith("#"):
+                continue
+            group, name, val = row[:3]
+            if group == "csr_register":
+                adr = int(val, 16)
+                self.names[name] = adr
+                self.modes[adr] = row[4]
+                self.regs[adr] = 0
+            elif group == "constant":
+                try:
+                    self.constants[name] = int(val)
+                except ValueError:
+                    self.constants[name] = val
+            elif group == "memory_region":
+                self.mems[name] = (int(val, 16), int(row[3]))
+        # Reset values of the registers we know about
+        for mod, regs in DEFAULT_REGS.items():
+            for name, val, mode in regs:
+                if mod + "_" + name in self.names:
+                    self[mod + "_" + name] = val
+
+    def save(self, fName):
+        """ write a csr.csv which RemoteClient can use """
+        d = os.path.dirname(fName)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        with open(fName, "w") as f:
+            w = csv.writer(f, lineterminator="\n")
+            for i, mod in enumerate(DEFAULT_REGS):
+                w.writerow(["csr_base", mod, hex(CSR_BASE + i * 0x800), "", ""])
+            for name, adr in self.names.items():
+                w.writerow(["csr_register", name, hex(adr), 1, self.modes[adr]])
+            for name, val in self.constants.items():
+                w.writerow(["constant", name, val, "", ""])
+            w.writerow(["constant", "config_csr_data_width", 32, "", ""])
+            w.writerow(["constant", "config_bus_address_width", 32, "", ""])
+            for name, (base, size) in self.mems.items():
+                w.writerow(["memory_region", name, hex(base), size, "cached"])
+
+    def __getitem__(self, name):
+        return self.regs[self.names[name]]
+
+    def __setitem__(self, name, val):
+        self.regs[self.names[name]] = val & 0xFFFFFFFF
+
+    def get(self, name, default=0):
+        if name in self.names:
+            return self[name]
+        return default
+
+
+class BridgeEmulator(threading.Thread):
+    """ answers UARTWishboneBridge commands on a pty """
+
+    def __init__(self, regs, getFrame):
+        threading.Thread.__init__(self, daemon=True)
+        self.regs = regs
+        self.getFrame = getFrame    # returns the current frame for mem reads
+        self.fd, self.name = openPty()
+        self.nRead = 0
+        self.nWrite = 0
+
+    def _readN(self, n):
+        buf = b""
+        while len(buf) < n:
+            buf += os.read(self.fd, n - len(buf))
+        return buf
+
+    def _readWord(self, adr):
+        r = self.regs
+        for base, size in r.mems.values():
+            if base <= adr < base + size:
+                frame = self.getFrame()
+                i = (adr - base) // 4
+                return int(frame[i]) if i < frame.size else 0
+        return r.regs.get(adr, 0)
+
+    def run(self):
+        while True:
+            cmd, n = self._readN(2)
+            adr = int.from_bytes(self._readN(4), "big") * 4
+            with self.regs.lock:
+                if cmd == CMD_WRITE:
+                    for i in range(n):
+                        val = int.from_bytes(self._readN(4), "big")
+                        if self.regs.modes.get(adr + 4 * i) != "ro":
+                            self.regs.regs[adr + 4 * i] = val
+                    self.nWrite += n
+                elif cmd == CMD_READ:
+                    out = b"".join(
+                        self._readWord(adr + 4 * i).to_bytes(4, "big")
+                        for i in range(n)
+                    )
+                    os.write(self.fd, out)
+                    self.nRead += n
+
+
+class LineSource(object):
+    """ synthetic sensor lines """
+
+    def __init__(self, pattern="gauss", noise=8.0, nPixels=128, fName=None, seed=0):
+        self.pattern = pattern
+        self.noise = noise
+        self.x = arange(nPixels)
+        self.rnd = random.RandomState(seed)
+        self.k = 0
+        if pattern == "file":
+            self.fileFrames = load(fName)
+
+    def lines(self, n, gain=1.0):
+        """ next n lines as (n, nPixels) float """
+        k = self.k + arange(n)[:, newaxis]
+        self.k += n
+        if self.pattern == "ramp":
+            # Exact values, for checking the data path
+            return ((k + self.x) % 4096).astype(float)
+        if self.pattern == "file":
+            return self.fileFrames[k[:, 0] % self.fileFrames.shape[0]].astype(float)
+        if self.pattern == "gauss":
+            # Light spot moving back and forth, same shape for any length
+            w = self.x.size
+            pos = w / 2 + 0.39 * w * sin(k / 200)
+            y = 200 + 3000 * exp(-(self.x - pos)**2 / (50 * (w / 128)**2))
+        else:
+            y = 2000 + zeros_like(k + self.x)
+        y = y * gain + self.rnd.randn(n, self.x.size) * self.noise
+        return clip(y, 0, 4095)
+
+
+class FaultInjector(object):
+    """ drops bytes and corrupts bursts of bytes in the stream """
+
+    def __init__(self, dropProb=0, dropMax=8, burstProb=0, burstLen=16, seed=1):
+        self.dropProb = dropProb
+        self.dropMax = dropMax
+        self.burstProb = burstProb
+        self.burstLen = burstLen
+        self.rnd = random.RandomState(seed)
+        self.nDrops = 0
+        self.nBursts = 0
+
+    def apply(self, dat):
+        """ dat: bytes of one frame """
+        if not (self.dropProb or self.burstProb):
+            return dat
+        dat = bytearray(dat)
+        if self.rnd.rand() < self.dropProb:
+            n = self.rnd.randint(1, self.dropMax + 1)
+            i = self.rnd.randint(len(dat))
+            del dat[i: i + n]
+            self.nDrops += 1
+        if self.rnd.rand() < self.burstProb and len(dat) > 0:
+            i = self.rnd.randint(len(dat))
+            dat[i: i + self.burstLen] = self.rnd.bytes(len(dat[i: i + self.burstLen]))
+            self.nBursts += 1
+        return bytes(dat)
+
+
+class DumpEmulator(threading.Thread):
+    """ sends frames like UartMemoryDumper on a pty """
+
+    def __init__(self, regs, source, faults, fps=0, baud=None, nBits=12,
+                 packed=False, riceK=None, readout=2177, isBlocking=False, nChannels=1,
+                 header=False):
+        """
+        nChannels: colour channels, the source line with less gain in each
+        header: prepend FrameHeader words. The timestamp counts cycles of
+        regs.fclk on perf_counter
+        fps: fixed frame rate. 0: set by ccd_i_tau and the baudrate
+        baud: fixed byte rate. 0: unlimited, None: from mem_dump_tuneWord
+        readout: cycles to read out one line, see Sensors.readoutCycles
+        isBlocking: wait when the pty is full instead of losing the bytes
+        (like the real UART does)
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.regs = regs
+        self.source = source
+        self.faults = faults
+        self.fps = fps
+        self.baud = baud
+        self.nBits = nBits
+        self.packed = packed
+        self.riceK = riceK
+        self.readout = readout
+        self.nChannels = nChannels
+        self.header = header
+        self.fd, self.name = openPty()
+        if not isBlocking:
+            fl = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+            fcntl.fcntl(self.fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+        self.frame = zeros(source.x.size * nChannels, dtype=uint16)   # last one sent
+        self.nFrames = 0
+        self.nBytes = 0
+        self.nOverrun = 0   # bytes lost because nobody read the pty
+
+    def makeFrame(self):
+        r = self.regs
+        tau = r.get("ccd_i_tau", 128)
+        nLines = int(maximum(r.get("acc_i_nLines", 1), 1))
+        shift = r.get("acc_i_shift", 0)
+        binLog2 = r.get("acc_i_binLog2", 0)
+        # Brightness goes with the integration time
+        gain = (self.readout + tau) / (self.readout + 128)
+        lines = self.source.lines(nLines, gain)
+        if self.nChannels > 1:
+            # (nLines, nChannels, nPixels), in the frame like LinearCcd does
+            lines = lines[:, newaxis] * (1 - 0.3 * arange(self.nChannels))[:, newaxis]
+            if not r.get("ccd_i_planar", 0):
+                lines = lines.transpose(0, 2, 1)
+            lines = lines.reshape(nLines, -1)
+        lines = lines.astype(int64)
+        frame = lines.sum(0).reshape(-1, 1 << binLog2).sum(1) >> shift
+        return minimum(frame, (1 << self.nBits) - 1).astype(uint16)
+
+    def encode(self, frame):
+        if self.header:
+            hdr = makeHeader(
+                self.nBits,
+                seq=self.nFrames,
+                time=time.perf_counter() * self.regs.fclk,
+                tau=self.regs.get("ccd_i_tau", 128)
+            )
+            frame = concatenate((hdr, frame))
+        if self.riceK is not None:
+            return riceEncode(frame[newaxis], self.riceK, nBits=self.nBits)
+        if self.packed:
+            dat = packWords(frame[newaxis], self.nBits)
+        else:
+            dat = frame.astype(">u2")
+        return b"\x42" + dat.tobytes()
+
+    def interval(self, nBytes):
+        """ seconds between frames """
+        if self.fps:
+            return 1 / self.fps
+        r = self.regs
+        fclk = r.fclk
+        nLines = int(maximum(r.get("acc_i_nLines", 1), 1))
+        tLine = nLines * (self.readout + r.get("ccd_i_tau", 128)) / fclk
+        baud = self.baud
+        if baud is None:
+            baud = r.get("mem_dump_tuneWord", 0) * fclk / 2**32
+        tLink = nBytes * 10 / baud if baud else 0
+        return float(maximum(tLine, tLink))
+
+    def run(self):
+        tNext = time.perf_counter()
+        while True:
+            with self.regs.lock:
+                frame = self.makeFrame()
+            dat = self.faults.apply(self.encode(frame))
+            try:
+                n = os.write(self.fd, dat)
+            except BlockingIOError:
+                n = 0
+            self.nOverrun += len(dat) - n
+            self.frame = frame
+            self.nFrames += 1
+            self.nBytes += n
+            tNext += self.interval(len(dat))
+            dt = tNext - time.perf_counter()
+            if dt > 0:
+                time.sleep(dt)
+            elif dt < -0.1:
+                tNext = time.perf_counter()    # Can't keep up, don't catch up
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--csr_csv", default="./build/csr.csv", help="Register map. Written with the default map if it does not exist")
+    parser.add_argument("--fclk", default=10e6, type=float, help="Emulated system clock [Hz]")
+    parser.add_argument("--baud", default=115200, type=int, help="Dump baudrate, 0: unlimited. Can be changed through mem_dump_tuneWord")
+    parser.add_argument("--fps", default=0, type=float, help="Fixed frame rate. Default: from ccd_i_tau and baudrate")
+    parser.add_argument("--sensor", default="tsl1401", choices=list(SENSORS), help="Emulated sensor: frame length and readout time")
+    parser.add_argument("--pattern", default="gauss", choices=["gauss", "flat", "ramp", "file"], help="Frame content")
+    parser.add_argument("--file", help=".npy file with (N, nPixels) frames for --pattern file")
+    parser.add_argument("--noise", default=8.0, type=float, help="Noise [LSB rms]")
+    parser.add_argument("--n_bits", default=12, type=int, help="Bits per word, like --word_width of the target")
+    parser.add_argument("--packed", action="store_true", help="Packed words")
+    parser.add_argument("--rice_k", type=int, help="Rice coded words")
+    parser.add_argument("--drop_prob", default=0.0, type=float, help="Probability per frame to drop 1..drop_max bytes")
+    parser.add_argument("--drop_max", default=8, type=int, help="Most bytes dropped at once")
+    parser.add_argument("--burst_prob", default=0.0, type=float, help="Probability per frame to corrupt a burst of bytes")
+    parser.add_argument("--burst_len", default=16, type=int, help="Bytes per corrupted burst")
+    parser.add_argument("--header", action="store_true", help="Frame header with sequence number, timestamp and tau")
+    parser.add_argument("--block", action="store_true", help="Wait for the reader instead of losing bytes when it is too slow")
+    parser.add_argument("--stats", default=1.0, type=float, help="Print statistics every STATS seconds")
+    args = parser.parse_args()
+
+    nPixels = SENSORS[args.sensor]["nPixels"]
+    nChannels = SENSORS[args.sensor]["nChannels"]
+    regs = RegisterFile(args.csr_csv, args.fclk, args.baud, nPixels, nChannels)
+    source = LineSource(args.pattern, args.noise, nPixels, args.file)
+    faults = FaultInjector(args.drop_prob, args.drop_max, args.burst_prob, args.burst_len)
+    dump = DumpEmulator(
+        regs, source, faults, args.fps, None if args.baud else 0,
+        args.n_bits, args.packed, args.rice_k, readoutCycles(args.sensor), args.block,
+        nChannels, args.header
+    )
+    ctrl = BridgeEmulator(regs, lambda: dump.frame)
+    print("ctrl: {}  dump: {}  csr: {}".format(ctrl.name, dump.name, args.csr_csv))
+    dump.start()
+    ctrl.start()
+    t0 = time.perf_counter()
+    n0 = b0 = 0
+    while True:
+        time.sleep(args.stats)
+        t1 = time.perf_counter()
+        print("frames: {} ({:.0f} / s) bytes: {} ({:.0f} / s) overrun: {} drops: {} bursts: {} csr r/w: {} / {}".format(
+            dump.nFrames, (dump.nFrames - n0) / (t1 - t0),
+            dump.nBytes, (dump.nBytes - b0) / (t1 - t0),
+            dump.nOverrun, faults.nDrops, faults.nBursts, ctrl.nRead, ctrl.nWrite
+        ), flush=True)
+        t0, n0, b0 = t1, dump.nFrames, dump.nBytes
+
+
+if __name__ == '__main__':
+    main()
@@ -10,7 +10,12 @@ from migen.genlib.resetsync import AsyncResetSynchronizer
 from litex.soc.cores.uart import UARTWishboneBridge
 from UartMemoryDumper import *
 from Adcs7476 import Adcs7476
-from Tsl1401 import Tsl1401
+from LinearCcd import LinearCcd
+from Sensors import SENSORS
+from FrameBanks import FrameBanks
+from LineAccumulator import LineAccumulator
+from FeatureExtractor import FeatureExtractor
+from HeaderLayout import HEADER_BITS
 
 
 class BaseSoC(SoCCore):
@@ -18,16 +23,18 @@ class BaseSoC(SoCCore):
     csr_peripherals = [
         # "adc"
         "ccd",
+        "acc",
         "ccd_mem",
         "mem_dump_mem",
-        "mem_dump"
+        "mem_dump",
+        "feat"
     ]
     sInd = max(SoCCore.csr_map.values()) + 1
     for v, name in enumerate(csr_peripherals, start=sInd):
         SoCCore.csr_map[name] = v
     print(SoCCore.csr_map)
 
-    def __init__(self, **kwargs):
+    def __init__(self, sensor="tsl1401", nBanks=2, packed=False, wordWidth=12, riceK=None, header=False, **kwargs):
         print("BaseSoC:", kwargs)
         platform = cmod_a7.Platform()
         platform.add_source("./xilinx7_clocks.v")
@@ -75,19 +82,36 @@ class BaseSoC(SoCCore):
         ))
         self.add_wb_master(self.cpu_or_bridge.wishbone)
 
+        #----------------------------
+        # CCD module (includes ADC)
+        #----------------------------
+        # The host reads the frame length from ccd_o_nPixels and
+        # ccd_o_nChannels. All colour outputs are converted in lockstep
+        self.submodules.ccd = LinearCcd(sensor)
+        self.ccd.connectToCmod(platform)
+        nWords = self.ccd.nWords
+
         #----------------------------
         # Shared memory for CCD data
         #----------------------------
-        mem = Memory(16, 128)
+        # nBanks frames of nWords, see FrameBanks
+        mem = Memory(wordWidth, nWords * nBanks)
         self.specials += mem
         self.submodules.ccd_ram = SRAM(mem, read_only=True)
-        self.register_mem("ccd", 0x50000000, self.ccd_ram.bus, 128)
+        self.register_mem("ccd", 0x50000000, self.ccd_ram.bus, nWords * nBanks)
+        self.submodules.banks = FrameBanks(nBanks, nWords, HEADER_BITS if header else 0)
 
         #----------------------------
-        # CCD module (includes ADC)
+        # Sum / average N lines into one frame
         #----------------------------
-        self.submodules.ccd = Tsl1401(mem)
-        self.ccd.connectToCmod(platform)
+        self.submodules.acc = LineAccumulator(mem, nWords)
+
+        #----------------------------
+        # Optionally send features of each line instead of the pixels
+        # (of the whole frame, all channels)
+        #----------------------------
+        self.submodules.feat = FeatureExtractor(nWords)
+        isFeat = self.feat.i_enable.storage
 
         #----------------------------
         # Serial memory dumper
@@ -96,23 +120,76 @@ class BaseSoC(SoCCore):
             Subsignal("tx", Pins("A16"), IOStandard("LVCMOS33"))
         )])
         self.submodules.mem_dump = UartMemoryDumper(
-            platform.request("serial", 1), mem, sys_clk_freq, baudrate=115200
+            platform.request("serial", 1), mem, sys_clk_freq, baudrate=115200,
+            nWords=nWords, packed=packed, riceK=riceK, header=header
         )
 
+        #----------------------------
+        # Frame header: sequence number, timestamp and tau of each frame
+        #----------------------------
+        if header:
+            self.submodules.hdr = FrameHeader()
+            self.comb += [
+                self.hdr.i_done.eq(self.acc.o_eof),
+                self.hdr.i_tau.eq(self.ccd.i_tau.storage),
+                self.banks.i_wr_meta.eq(self.hdr.o_header),
+                self.mem_dump.i_header.eq(self.banks.o_rd_meta)
+            ]
+
         self.comb += [
-            self.ccd.i_trig.eq(~self.platform.request("user_btn", 1)),
+            self.ccd.i_trig.eq(
+                ~self.platform.request("user_btn", 1) & ~self.banks.o_wr_stall
+            ),
             platform.request("user_led", 1).eq(self.ccd.adc.i_trig),
-            self.mem_dump.i_trig.eq(1)
+            self.feat.i_valid.eq(self.ccd.o_valid),
+            self.feat.i_dat.eq(self.ccd.o_dat),
+            self.feat.i_pixel.eq(self.ccd.o_pixel),
+            self.feat.i_eol.eq(self.ccd.o_eof),
+            # Feature records go through the accumulator unchanged
+            self.acc.i_bypass.eq(isFeat),
+            If(isFeat,
+                self.acc.i_valid.eq(self.feat.o_valid),
+                self.acc.i_dat.eq(self.feat.o_dat),
+                self.acc.i_pixel.eq(self.feat.o_pixel),
+                self.acc.i_eol.eq(self.feat.o_eol),
+                self.mem_dump.i_nWords.eq(self.feat.o_nWords)
+            ).Else(
+                self.acc.i_valid.eq(self.ccd.o_valid),
+                self.acc.i_dat.eq(self.ccd.o_dat),
+                self.acc.i_pixel.eq(self.ccd.o_pixel),
+                self.acc.i_eol.eq(self.ccd.o_eof),
+                self.mem_dump.i_nWords.eq(self.acc.o_nWords)
+            ),
+            # Sensor fills one bank, dumper sends the last completed one
+            self.acc.i_adrOffset.eq(self.banks.o_wr_offset),
+            self.banks.i_wr_done.eq(self.acc.o_eof),
+            self.mem_dump.i_adrOffset.eq(self.banks.o_rd_offset),
+            self.mem_dump.i_trig.eq(self.banks.o_rd_valid),
+            self.banks.i_rd_start.eq(self.mem_dump.o_start),
+            self.banks.i_rd_done.eq(self.mem_dump.o_done)
         ]
 
 
 def main():
     parser = argparse.ArgumentParser(description="CmodA7 basic system")
+    parser.add_argument("--sensor", default="tsl1401", choices=list(SENSORS),
+        help="Line sensor connected to the DIP pins, see Sensors.py")
+    parser.add_argument("--n_banks", default=2, type=int,
+        help="Frame buffers between sensor and dumper (2: double buffering)")
+    parser.add_argument("--packed", action="store_true",
+        help="Send 12 bit samples back to back (1.5 instead of 2 bytes each)")
+    parser.add_argument("--word_width", default=12, type=int,
+        help="Bits per sample in frame memory and on the wire. Accumulated lines saturate at this width")
+    parser.add_argument("--rice_k", type=int,
+        help="Send lossless Rice coded pixel differences with this parameter")
+    parser.add_argument("--header", action="store_true",
+        help="Start every frame with sequence number, timestamp and tau, see FrameStats.py")
     builder_args(parser)
     soc_core_args(parser)
     args = parser.parse_args()
     print(args)
-    soc = BaseSoC(**soc_core_argdict(args))
+    soc = BaseSoC(sensor=args.sensor, nBanks=args.n_banks, packed=args.packed,
+        wordWidth=args.word_width, riceK=args.rice_k, header=args.header, **soc_core_argdict(args))
     builder = Builder(soc, **builder_argdict(args))
     builder.build()
 
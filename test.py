@@ -4,14 +4,17 @@ from numpy import *
 from matplotlib.animation import FuncAnimation
 from serial import Serial
 import atexit
+from FrameDecoder import FrameDecoder
+from CsrClient import CsrClient
 
 def startAni():
-    xdata = arange(128)
-    ydata = zeros(128)
+    xdata = arange(nPixels)
+    ydata = zeros(nPixels)
     ydata[1] = 4096
     l, = plot(xdata, ydata, "-o")
     def update(frame):
-        dat = ws.read(ws.mems.ccd.base, ws.mems.ccd.size)
+        # First of the FrameBanks banks
+        dat = ctrl.readMem("ccd", nPixels)
         print(dat[0])
         l.set_ydata(dat)
         return l
@@ -19,18 +22,20 @@ def startAni():
     return ani
 
 def startAni2():
-    xdata = arange(128)
-    ydata = zeros(128)
+    xdata = arange(nPixels)
+    ydata = zeros(nPixels)
     ydata[1] = 4096
     l, = plot(xdata, ydata, "-o")
 
+    dec = FrameDecoder(nPixels)
+
     def update(frame):
-        b = s.read_until(b"\x42")
-        if len(b) == 257:
-            dat = fromstring(b[1:], dtype=uint16)
-            l.set_ydata(dat)
-        else:
+        frames = dec.decode(s.read(s.in_waiting))
+        if frames.shape[0] > 0:
+            l.set_ydata(frames[-1])
+        if dec.nResync:
             print("E", end="", flush=True)
+            dec.nResync = 0
         return l
     ani = FuncAnimation(gcf(), update, interval=10)
     return ani
@@ -38,6 +43,11 @@ def startAni2():
 ws = RemoteClient(csr_csv="./build/csr.csv")
 atexit.register(ws.close)
 ws.open()
+ctrl = CsrClient(ws)
+nPixels = ctrl.read("ccd_o_nPixels") if "ccd_o_nPixels" in ctrl.regs else 128
+# Colour sensors: words of all channels
+if "ccd_o_nChannels" in ctrl.regs:
+    nPixels *= ctrl.read("ccd_o_nChannels")
 print("ws.regs.")
 for k in ws.regs.__dict__.keys():
     print(k)